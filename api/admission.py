@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Adaptive admission control of the requests which start new work.
+
+The load is judged from the lag of the event loop, the latency of upstream services (the
+metastore) and the number of streams in flight. While the worker is overloaded the number of
+concurrent requests admitted per kind is decreased multiplicatively, and increased again while
+it is healthy. Requests over the limit are shed right away instead of piling up in handlers.
+Streams already started are never affected.
+
+"""
+
+import asyncio
+from contextlib import contextmanager
+import math
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+# Kinds of admitted requests
+TOKENS = 'tokens'
+UPLOADS = 'uploads'
+
+
+class Gate:
+    """Concurrency limit of one kind of request."""
+
+    def __init__(self, limit: float):
+        self.limit = limit
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed = 0
+
+
+class AdmissionController:
+    """Cap concurrent requests adaptively and tell when the worker is degraded.
+
+    Args:
+        kinds (Iterable[str]): Kinds of requests to cap.
+        min_limit (int): Lowest concurrency a limit is decreased to.
+        max_limit (int): Highest concurrency a limit is increased to.
+        target_lag (float): Event-loop lag (seconds) above which the worker is overloaded.
+        target_upstream_latency (float): Upstream latency (seconds) above which the worker is overloaded.
+        upstream_half_life (float): Seconds after which the weight of an upstream latency sample is halved.
+        max_streams (int): Streams in flight above which the worker is overloaded. 0 means no limit.
+        streams (Optional[Callable[[], int]]): Function returning the number of streams in flight.
+        interval (float): Seconds between measurements of the lag and adjustments of the limits.
+        degraded_period (float): Seconds the worker is reported degraded after it was overloaded.
+
+    """
+
+    def __init__(
+        self,
+        kinds: Iterable[str] = (TOKENS, UPLOADS),
+        min_limit: int = 4,
+        max_limit: int = 256,
+        target_lag: float = 0.1,
+        target_upstream_latency: float = 1.0,
+        upstream_half_life: float = 10.0,
+        max_streams: int = 0,
+        streams: Optional[Callable[[], int]] = None,
+        interval: float = 0.5,
+        degraded_period: float = 5.0,
+    ):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.target_lag = target_lag
+        self.target_upstream_latency = target_upstream_latency
+        self.upstream_half_life = upstream_half_life
+        self.max_streams = max_streams
+        self.streams = streams or (lambda: 0)
+        self.interval = interval
+        self.degraded_period = degraded_period
+        self.gates: Dict[str, Gate] = {kind: Gate(self.max_limit) for kind in kinds}
+        self.lag = 0.0
+        self.upstream_latency = 0.0
+        self._upstream_sampled = (0.0, time.monotonic())
+        self.overloaded = False
+        self.degraded_until = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def try_acquire(self, kind: str) -> Optional[int]:
+        """Admit a request.
+
+        Returns:
+            (Optional[int]): None if admitted (release() must be called when it finishes),
+                otherwise seconds the client should wait before retrying.
+
+        """
+        gate = self.gates[kind]
+        if gate.in_flight >= int(gate.limit):
+            gate.shed += 1
+            self.degraded_until = time.monotonic() + self.degraded_period
+            return self.retry_after()
+        gate.in_flight += 1
+        gate.admitted += 1
+        return None
+
+    def hold(self, kind: str):
+        """Take a slot regardless of the limit, for work outliving the request which was admitted for it.
+
+        release() must be called when the work finishes.
+
+        """
+        self.gates[kind].in_flight += 1
+
+    def release(self, kind: str):
+        self.gates[kind].in_flight -= 1
+
+    def retry_after(self) -> int:
+        """Seconds to ask shed clients to wait, growing with the lag and the upstream latency."""
+        return int(min(30, max(1, math.ceil(max(self.lag * 10, self.upstream_latency * 2)))))
+
+    @contextmanager
+    def upstream(self):
+        """Measure the latency of a call to an upstream service."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record_upstream_latency(time.monotonic() - started)
+
+    def _decayed_upstream_latency(self, now: float) -> float:
+        # Samples age with time, not only with newer samples: while the worker sheds requests, few
+        # upstream calls are made, and the average would otherwise keep it degraded indefinitely
+        latency, sampled_at = self._upstream_sampled
+        if self.upstream_half_life <= 0:
+            return latency
+        return latency * 0.5 ** (max(0.0, now - sampled_at) / self.upstream_half_life)
+
+    def record_upstream_latency(self, seconds: float, now: Optional[float] = None):
+        # Exponentially weighted moving average
+        now = time.monotonic() if now is None else now
+        latency = self._decayed_upstream_latency(now)
+        latency += 0.2 * (seconds - latency)
+        self._upstream_sampled = (latency, now)
+        self.upstream_latency = latency
+
+    def adjust(self, lag: float, now: Optional[float] = None):
+        """Update the load with a measured lag and adjust the limits (additive increase, multiplicative decrease)."""
+        now = time.monotonic() if now is None else now
+        self.lag += 0.5 * (lag - self.lag)
+        self.upstream_latency = self._decayed_upstream_latency(now)
+        self.overloaded = (
+            self.lag > self.target_lag
+            or self.upstream_latency > self.target_upstream_latency
+            or (self.max_streams > 0 and self.streams() > self.max_streams)
+        )
+        for gate in self.gates.values():
+            if self.overloaded:
+                gate.limit = max(self.min_limit, gate.limit * 0.75)
+            else:
+                gate.limit = min(self.max_limit, gate.limit + max(1.0, gate.limit * 0.05))
+        if self.overloaded:
+            self.degraded_until = now + self.degraded_period
+
+    async def _measure(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.adjust(max(0.0, time.monotonic() - started - self.interval))
+
+    def start(self):
+        """Start measuring the lag of the running event loop."""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._measure())
+
+    @property
+    def degraded(self) -> bool:
+        return self.overloaded or time.monotonic() < self.degraded_until
+
+    def stats(self) -> dict:
+        return {
+            'degraded': self.degraded,
+            'lag': self.lag,
+            'upstream_latency': self.upstream_latency,
+            'streams': self.streams(),
+            'gates': {
+                kind: {'limit': int(gate.limit), 'in_flight': gate.in_flight, 'admitted': gate.admitted,
+                       'shed': gate.shed}
+                for kind, gate in self.gates.items()
+            },
+        }
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Token-bucket bandwidth shaping for streamed downloads."""
+
+import asyncio
+import json
+import os
+import time
+from typing import Dict, Optional, Set, Tuple
+
+
+class TokenBucket:
+    """Token bucket which lets callers go into debt and wait it off.
+
+    Every reservation is granted immediately and the caller sleeps for the time needed to pay
+    back the deficit, so concurrent streams interleave chunk by chunk and share the rate evenly.
+    When a stream finishes, the remaining ones get its share without any reconfiguration.
+
+    Args:
+        rate (float): Bytes per second. 0 means unlimited.
+        burst (Optional[float]): Maximum amount of saved-up tokens. Defaults to one second of rate.
+
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = 0.0
+        self.burst = burst
+        self.capacity = 0.0
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.set_rate(rate)
+        self.tokens = self.capacity
+
+    def set_rate(self, rate: float):
+        self.rate = max(0.0, float(rate))
+        self.capacity = self.burst if self.burst is not None else self.rate
+        self.tokens = min(self.tokens, self.capacity)
+
+    def reserve(self, amount: int, now: Optional[float] = None) -> float:
+        """Take tokens for the amount and return how long to wait (in seconds) before sending it."""
+        now = time.monotonic() if now is None else now
+        if self.rate <= 0:
+            self.updated = now
+            return 0.0
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def full_at(self) -> float:
+        """Return when (in time.monotonic) the bucket will be full again, i.e. as good as a new one."""
+        if self.rate <= 0:
+            return self.updated
+        return self.updated + max(0.0, self.capacity - self.tokens) / self.rate
+
+
+class ShapedStream:
+    """A single streamed response registered in a BandwidthShaper."""
+
+    def __init__(self, shaper: 'BandwidthShaper', keys: Tuple[tuple, ...]):
+        self.shaper = shaper
+        self.keys = keys
+        self.closed = False
+
+    async def throttle(self, amount: int):
+        """Wait until the amount of bytes may be sent."""
+        self.shaper.maybe_reload()
+        for key in self.keys:
+            bucket = self.shaper.buckets.get(key)
+            if bucket is None:
+                continue
+            delay = bucket.reserve(amount)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.shaper.release(self.keys)
+
+
+class BandwidthShaper:
+    """Rate limits streams per user, per database and globally.
+
+    Limits are read from the environment defaults and, if given, from a JSON file which is
+    re-read when it changes so that limits can be tuned without a restart::
+
+        {
+            "global": 125000000,
+            "per_user": 20000000,
+            "per_database": 50000000,
+            "users": {"<sub of JWT>": 5000000},
+            "databases": {"<database_id>": 0}
+        }
+
+    All values are bytes per second and 0 means unlimited.
+
+    Args:
+        global_limit (float): Limit of all streams of this worker.
+        per_user_limit (float): Default limit of all streams of a user.
+        per_database_limit (float): Default limit of all streams of a database.
+        config_file (Optional[str]): Path to the JSON file overriding the limits.
+        reload_interval (float): Minimum interval in seconds between checks of the file.
+
+    """
+
+    def __init__(
+        self,
+        global_limit: float = 0,
+        per_user_limit: float = 0,
+        per_database_limit: float = 0,
+        config_file: Optional[str] = None,
+        reload_interval: float = 1.0,
+    ):
+        self.defaults = {
+            'global': global_limit,
+            'per_user': per_user_limit,
+            'per_database': per_database_limit,
+            'users': {},
+            'databases': {},
+        }
+        self.config = dict(self.defaults)
+        self.config_file = config_file
+        self.reload_interval = reload_interval
+        self.buckets: Dict[tuple, TokenBucket] = {}
+        self.active: Dict[tuple, int] = {}
+        # Buckets without streams are kept until they have refilled, so that closing and
+        # reopening streams does not reset the debt of a user or a database
+        self.idle: Set[tuple] = set()
+        self._config_mtime: Optional[int] = None
+        self._checked_at = 0.0
+        self.maybe_reload()
+
+    def limit_for(self, key: tuple) -> float:
+        kind = key[0]
+        if kind == 'global':
+            return float(self.config.get('global') or 0)
+        if kind == 'user':
+            return float(self.config.get('users', {}).get(key[1], self.config.get('per_user')) or 0)
+        return float(self.config.get('databases', {}).get(key[1], self.config.get('per_database')) or 0)
+
+    def update(self, config: dict):
+        """Replace the limits and apply them to the streams already running.
+
+        Args:
+            config (dict): Limits in the format of the config file. Missing keys fall back to the defaults.
+
+        """
+        self.config = {**self.defaults, **config}
+        for key, bucket in self.buckets.items():
+            bucket.set_rate(self.limit_for(key))
+
+    def maybe_reload(self):
+        if not self.config_file:
+            return
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(self.config_file).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._config_mtime:
+            return
+        config = {}
+        if mtime is not None:
+            try:
+                with open(self.config_file, 'r') as f:
+                    config = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f'Failed to load bandwidth config ({self.config_file}): {e}')
+                return
+        self._config_mtime = mtime
+        self.update(config)
+
+    def open_stream(self, user_id: Optional[str], database_id: Optional[str]) -> ShapedStream:
+        """Register a stream and return a handle to throttle it with.
+
+        Args:
+            user_id (Optional[str]): Identity of the requesting user.
+            database_id (Optional[str]): Database the file belongs to.
+
+        Returns:
+            (ShapedStream): Handle which must be closed when the stream ends.
+
+        """
+        self.maybe_reload()
+        self.evict_idle()
+        keys = []
+        if user_id:
+            keys.append(('user', user_id))
+        if database_id:
+            keys.append(('database', database_id))
+        keys.append(('global',))
+        for key in keys:
+            self.idle.discard(key)
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(self.limit_for(key))
+            self.active[key] = self.active.get(key, 0) + 1
+        return ShapedStream(self, tuple(keys))
+
+    def release(self, keys: Tuple[tuple, ...]):
+        for key in keys:
+            self.active[key] = self.active.get(key, 1) - 1
+            if self.active[key] <= 0:
+                del self.active[key]
+                if key != ('global',):
+                    self.idle.add(key)
+        self.evict_idle()
+
+    def evict_idle(self, now: Optional[float] = None):
+        """Drop the buckets without streams which have refilled since their last stream."""
+        now = time.monotonic() if now is None else now
+        for key in list(self.idle):
+            bucket = self.buckets.get(key)
+            if bucket is None or bucket.full_at() <= now:
+                self.idle.discard(key)
+                self.buckets.pop(key, None)
+
+    def connection_limit(self, user_id: Optional[str], database_id: Optional[str]) -> float:
+        """Return the strictest limit applying to a stream, for proxies limiting each connection.
+
+        Returns:
+            (float): Bytes per second. 0 means unlimited.
+
+        """
+        self.maybe_reload()
+        keys = [('global',)]
+        if user_id:
+            keys.append(('user', user_id))
+        if database_id:
+            keys.append(('database', database_id))
+        limits = [limit for limit in (self.limit_for(key) for key in keys) if limit > 0]
+        return min(limits) if limits else 0.0
+
+    def stats(self) -> dict:
+        """Return active streams and limits for metrics."""
+        return {
+            'limits': {k: v for k, v in self.config.items() if k in ('global', 'per_user', 'per_database')},
+            'active_streams': self.active.get(('global',), 0),
+            'active_users': sum(1 for key in self.active if key[0] == 'user'),
+            'active_databases': sum(1 for key in self.active if key[0] == 'database'),
+        }
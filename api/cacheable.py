@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Download URLs which shared caches (reverse proxies, CDNs) can reuse.
+
+A cacheable token carries no issue time or user, and expires at the end of a time bucket, so
+the same file gets the same URL from every request within the bucket. Authorization is still
+checked for each user when a token is issued.
+
+"""
+
+import math
+import os
+import time
+from typing import Optional
+
+
+def bucketed_expiry(window: float, now: Optional[float] = None) -> int:
+    """Return an expiry which is the same for all the tokens issued within a window.
+
+    Tokens stay valid for at least one window and less than two.
+
+    Args:
+        window (float): Length of a bucket in seconds.
+        now (Optional[float]): Current UNIX time.
+
+    Returns:
+        (int): Expiry as UNIX time.
+
+    """
+    now = time.time() if now is None else now
+    return int((math.floor(now / window) + 2) * window)
+
+
+def etag_for(stat: os.stat_result, digest: Optional[str] = None) -> str:
+    """Return the ETag of a file.
+
+    Args:
+        stat (os.stat_result): Status of the file.
+        digest (Optional[str]): Digest of the content, if known (e.g., from the manifest).
+
+    Returns:
+        (str): A strong ETag derived from the digest, or a weak one derived from size and mtime.
+
+    """
+    if digest:
+        return f'"{digest}"'
+    return f'W/"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def matches_etag(if_none_match: Optional[str], etag: str) -> bool:
+    """Return whether an If-None-Match header matches the ETag (weak comparison)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if (candidate[2:] if candidate.startswith('W/') else candidate) == opaque:
+            return True
+    return False
+
+
+def cache_headers(etag: str, expires_at: float, now: Optional[float] = None) -> dict:
+    """Return the headers letting shared caches keep a response until its URL expires."""
+    now = time.time() if now is None else now
+    return {
+        'ETag': etag,
+        'Cache-Control': f'public, max-age={max(0, int(expires_at - now))}, immutable',
+        'Vary': 'Accept-Encoding',
+    }
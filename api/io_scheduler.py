@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Bounded file I/O executor with per-mount concurrency limits."""
+
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import heapq
+import itertools
+import os
+import re
+import traceback
+from typing import Callable, Dict, List, Optional, Tuple
+
+from api.paths import is_within
+
+# Priorities of I/O operations. Lower values are admitted first.
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BULK: 'bulk'}
+
+
+def parse_mount_limits(value: str) -> Dict[str, int]:
+    """Parse per-mount limits given as `path=limit,path=limit`.
+
+    Args:
+        value (str): Comma-separated list of `path=limit`.
+
+    Returns:
+        (Dict[str, int]): Limits keyed by normalized path.
+
+    """
+    limits = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        path, _, limit = item.rpartition('=')
+        if not path:
+            raise ValueError(f'Invalid mount limit: {item}')
+        limits[os.path.normpath(path.strip())] = int(limit)
+    return limits
+
+
+def read_mount_points(mountinfo_path: str = '/proc/self/mountinfo') -> Dict[int, str]:
+    """Return the mount points keyed by device number, or an empty dict if unknown (e.g., not on Linux)."""
+    mount_points = {}
+    try:
+        with open(mountinfo_path) as f:
+            for line in f:
+                fields = line.split()
+                major, minor = fields[2].split(':')
+                # Spaces and the like are escaped as octal
+                mount_point = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), fields[4])
+                mount_points.setdefault(os.makedev(int(major), int(minor)), mount_point)
+    except (OSError, ValueError, IndexError):
+        pass
+    return mount_points
+
+
+def _call_and_stat(directory: str, call: Callable) -> Tuple[object, Optional[int]]:
+    """Run call, then return its result and the device of the directory (None if it cannot be stat)."""
+    result = call()
+    try:
+        device = os.stat(directory).st_dev
+    except OSError:
+        device = None
+    return result, device
+
+
+class PriorityLimiter:
+    """Concurrency limiter for asyncio which admits waiters in priority order.
+
+    Args:
+        limit (int): Maximum number of concurrent holders.
+
+    """
+
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self.active = 0
+        self._waiters: List[tuple] = []
+        self._counter = itertools.count()
+
+    def queued(self, priority: Optional[int] = None) -> int:
+        """Return the number of pending waiters, optionally only for a priority."""
+        return sum(
+            1 for p, _, fut in self._waiters
+            if not fut.done() and (priority is None or p == priority)
+        )
+
+    async def acquire(self, priority: int = BULK):
+        if self.active < self.limit and not self.queued():
+            self.active += 1
+            return
+        fut = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # The slot was handed over right before the cancellation
+                self.release()
+            raise
+
+    def release(self):
+        self.active -= 1
+        while self._waiters and self.active < self.limit:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                self.active += 1
+                fut.set_result(None)
+
+
+class IOScheduler:
+    """Run blocking file I/O on dedicated read and write pools.
+
+    Every operation is admitted through the limiter of the storage device the path lives on,
+    so that a bulk transfer on one device cannot use up all the threads. Interactive operations
+    (e.g., Range reads) are admitted before bulk ones (full downloads and uploads).
+
+    Mount points are read once from the mount table, so finding the mount of a path costs no
+    I/O on the event loop. The first operation in a directory is charged to the mount its path
+    is under; the device of the directory is then stat on the pool, so that later operations
+    are charged to the mount the directory actually is on, even if reached through a symlink.
+
+    Args:
+        read_workers (int): Number of threads for reads.
+        write_workers (int): Number of threads for writes.
+        mount_concurrency (int): Default limit of concurrent operations per mount.
+        mount_limits (Optional[Dict[str, int]]): Limits for specific roots, overriding
+            the detected mount point for paths under them.
+        max_directories (int): Maximum number of directories whose device is remembered.
+
+    """
+
+    def __init__(
+        self,
+        read_workers: int,
+        write_workers: int,
+        mount_concurrency: int,
+        mount_limits: Optional[Dict[str, int]] = None,
+        max_directories: int = 65536,
+    ):
+        self.read_workers = read_workers
+        self.write_workers = write_workers
+        self.mount_concurrency = mount_concurrency
+        self.mount_limits = dict(mount_limits or {})
+        self.max_directories = max_directories
+        self.mount_points = read_mount_points()
+        # Longest first, so that the first mount point a path is under is the one it is on
+        self._mount_paths = sorted(set(self.mount_points.values()) | {os.sep}, key=len, reverse=True)
+        self._devices: 'OrderedDict[str, int]' = OrderedDict()
+        self._pools: Dict[str, ThreadPoolExecutor] = {}
+        self._limiters: Dict[str, PriorityLimiter] = {}
+
+    def mount_of(self, path: str) -> str:
+        """Return the configured root or mount point the path belongs to."""
+        path = os.path.abspath(path)
+        roots = [root for root in self.mount_limits
+                 if path == root or path.startswith(os.path.join(root, ''))]
+        if roots:
+            return max(roots, key=len)
+        device = self._devices.get(os.path.dirname(path))
+        if device is not None:
+            self._devices.move_to_end(os.path.dirname(path))
+            return self.mount_points.get(device, f'device:{os.major(device)}:{os.minor(device)}')
+        return next(mount_path for mount_path in self._mount_paths if is_within(path, mount_path))
+
+    def _pool(self, kind: str) -> ThreadPoolExecutor:
+        if kind not in self._pools:
+            workers = self.read_workers if kind == 'read' else self.write_workers
+            self._pools[kind] = ThreadPoolExecutor(max_workers=max(1, workers),
+                                                   thread_name_prefix=f'io-{kind}')
+        return self._pools[kind]
+
+    def _limiter(self, mount: str) -> PriorityLimiter:
+        if mount not in self._limiters:
+            self._limiters[mount] = PriorityLimiter(self.mount_limits.get(mount, self.mount_concurrency))
+        return self._limiters[mount]
+
+    async def run(self, kind: str, path: str, func: Callable, *args, priority: int = BULK, **kwargs):
+        """Run func(*args, **kwargs) on the pool of the kind once the mount admits it.
+
+        Args:
+            kind (str): Either 'read' or 'write'.
+            path (str): Path the operation works on, used to find the mount.
+            func (Callable): Blocking function to run.
+            priority (int): INTERACTIVE or BULK.
+
+        Returns:
+            (any): The return value of func.
+
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        limiter = self._limiter(self.mount_of(path))
+        await limiter.acquire(priority)
+        try:
+            loop = asyncio.get_event_loop()
+            call = functools.partial(func, *args, **kwargs)
+            if directory in self._devices:
+                return await loop.run_in_executor(self._pool(kind), call)
+            result, device = await loop.run_in_executor(self._pool(kind), _call_and_stat, directory, call)
+        finally:
+            limiter.release()
+        if device is not None:
+            self._devices[directory] = device
+            while len(self._devices) > self.max_directories:
+                self._devices.popitem(last=False)
+        return result
+
+    async def read(self, path: str, func: Callable, *args, priority: int = BULK, **kwargs):
+        return await self.run('read', path, func, *args, priority=priority, **kwargs)
+
+    async def write(self, path: str, func: Callable, *args, priority: int = BULK, **kwargs):
+        return await self.run('write', path, func, *args, priority=priority, **kwargs)
+
+    def submit_write(self, path: str, func: Callable, *args, **kwargs) -> asyncio.Future:
+        """Schedule a bulk write without waiting for it, logging any failure."""
+        future = asyncio.ensure_future(self.write(path, func, *args, **kwargs))
+
+        def on_done(fut):
+            if fut.cancelled() or fut.exception() is None:
+                return
+            exc = fut.exception()
+            traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+        future.add_done_callback(on_done)
+        return future
+
+    def stats(self) -> dict:
+        """Return queue depths for metrics."""
+        pools = {}
+        for kind in ('read', 'write'):
+            pool = self._pools.get(kind)
+            pools[kind] = {
+                'workers': self.read_workers if kind == 'read' else self.write_workers,
+                'queued': pool._work_queue.qsize() if pool is not None else 0,
+            }
+        mounts = {}
+        for mount, limiter in self._limiters.items():
+            mounts[mount] = {
+                'limit': limiter.limit,
+                'active': limiter.active,
+                **{f'queued_{name}': limiter.queued(p) for p, name in PRIORITY_NAMES.items()},
+            }
+        return {'pools': pools, 'mounts': mounts}
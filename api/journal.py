@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Append-only JSON-lines logs shared by the workers of all the pods, and the locks guarding them."""
+
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import threading
+from typing import Iterator, List, Tuple
+
+
+class FileLock:
+    """Exclusive locks held through lock files.
+
+    fcntl.lockf excludes other processes, also on other hosts over NFS, but not other threads
+    of the same process, and closing any descriptor of the file releases it. So the threads of
+    a process are serialized by mutexes first, striped by the path of the lock file.
+
+    Args:
+        stripes (int): Number of mutexes shared by the lock files.
+
+    """
+
+    def __init__(self, stripes: int = 64):
+        self._mutexes = [threading.Lock() for _ in range(max(1, stripes))]
+
+    @contextmanager
+    def hold(self, lock_path: str):
+        """Hold the lock of a lock file, creating the file and its directory if needed.
+
+        Locks must not be nested, since two lock files may share a mutex.
+
+        """
+        with self._mutexes[hash(lock_path) % len(self._mutexes)]:
+            os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.lockf(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+
+
+def fsync_directory(dir_path: str):
+    """Make the entries of a directory (e.g., a file just created or renamed into it) durable."""
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def encode_records(records: List[dict]) -> bytes:
+    return b''.join(json.dumps(record).encode('utf-8') + b'\n' for record in records)
+
+
+def _complete_size(f, size: int, block_size: int = 65536) -> int:
+    """Return the size of the file up to its last newline."""
+    end = size
+    while end > 0:
+        start = max(0, end - block_size)
+        f.seek(start)
+        newline = f.read(end - start).rfind(b'\n')
+        if newline >= 0:
+            return start + newline + 1
+        end = start
+    return 0
+
+
+def append_records(log_path: str, records: List[dict]) -> int:
+    """Append records to a log durably. Must be called with the lock of the log held.
+
+    A line torn by a crash in the middle of an append is truncated first, so that it cannot
+    corrupt the records appended after it.
+
+    Returns:
+        (int): Size of the log after the append.
+
+    """
+    with open(log_path, 'a+b') as f:
+        size = f.seek(0, os.SEEK_END)
+        if size > 0:
+            f.seek(size - 1)
+            if f.read(1) != b'\n':
+                size = _complete_size(f, size)
+                f.truncate(size)
+        data = encode_records(records)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return size + len(data)
+
+
+def replace_records(log_path: str, records: List[dict]):
+    """Replace a log with the records atomically. Must be called with the lock of the log held."""
+    temp_path = f'{log_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(encode_records(records))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, log_path)
+
+
+def parse_records(data: bytes, log_path: str = '') -> Tuple[Iterator[dict], int]:
+    """Parse the complete lines of data read from a log.
+
+    Lines which cannot be decoded (e.g., torn by a crash) are logged and skipped.
+
+    Returns:
+        (Tuple[Iterator[dict], int]): The records, and the number of bytes they span. A line still
+            being appended is left for the next read.
+
+    """
+    complete = data.rfind(b'\n') + 1
+
+    def records():
+        for line in data[:complete].splitlines():
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                print(f'Skipped an undecodable line of {log_path}: {line[:100]!r}')
+
+    return records(), complete
@@ -2,21 +2,87 @@
 # Copyright API authors
 """The API server."""
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from distutils.util import strtobool
+import functools
 import json
+import mimetypes
+import mmap
 import os
+import threading
 from datetime import datetime, timedelta
-from typing import Optional, Tuple
+from typing import BinaryIO, List, Optional, Set, Tuple
 from urllib.parse import quote
 
-import aiofiles
 import jwt
 import requests
 import responder
 from dataware_tools_api_helper import get_forward_headers, get_jwt_payload_from_request
 import urllib.parse
 
-from api.settings import META_STORE_SERVICE, UPLOADED_FILE_PATH_PREFIX
-from api.utils import get_valid_filename, is_file_in_directory, is_valid_path, get_jwt_key, get_check_permission_client
+from api.admission import TOKENS, UPLOADS, AdmissionController
+from api.bandwidth import BandwidthShaper
+from api.cacheable import bucketed_expiry, cache_headers, etag_for, matches_etag
+from api.io_scheduler import BULK, INTERACTIVE, IOScheduler, parse_mount_limits
+from api.manifest import ManifestStore, content_digest
+from api.mmap_cache import MmapCache
+from api.offload import Offloader, parse_locations
+from api.packs import PackEntry, PackStore
+from api.openapi import LazyOpenAPI
+from api.paths import PathResolver, parse_roots
+from api.profiling import MemoryTracer, SamplingProfiler, dump_tasks
+from api.shared_cache import SharedCache
+from api.uploads import REGISTERED, UploadPipeline
+from api.settings import (
+    META_STORE_SERVICE,
+    UPLOADED_FILE_PATH_PREFIX,
+    MMAP_MAX_FILE_SIZE,
+    MMAP_CACHE_SIZE,
+    IO_READ_WORKERS,
+    IO_WRITE_WORKERS,
+    IO_MOUNT_CONCURRENCY,
+    IO_MOUNT_LIMITS,
+    BANDWIDTH_GLOBAL_LIMIT,
+    BANDWIDTH_PER_USER_LIMIT,
+    BANDWIDTH_PER_DATABASE_LIMIT,
+    BANDWIDTH_CONFIG_FILE,
+    UPLOAD_STATUS_DIR,
+    UPLOAD_STATUS_TTL,
+    UPLOAD_SWEEP_INTERVAL,
+    UPLOAD_TEMP_GRACE_PERIOD,
+    BULK_DELETE_CONCURRENCY,
+    BULK_DELETE_MAX_FILES,
+    SHARED_CACHE_URL,
+    SHARED_CACHE_LOCAL_SIZE,
+    SHARED_CACHE_LOCAL_TTL,
+    SHARED_CACHE_TTL,
+    SHARED_CACHE_MAX_VALUE_SIZE,
+    SHARED_CACHE_RETRY_INTERVAL,
+    PERMISSION_CACHE_TTL,
+    MANIFEST_DIR,
+    SERVED_ROOT_DIRECTORIES,
+    PATH_CACHE_TTL,
+    PATH_CACHE_SIZE,
+    CACHEABLE_DOWNLOAD_URLS,
+    CACHEABLE_URL_WINDOW,
+    OFFLOAD_MODE,
+    OFFLOAD_LOCATIONS,
+    DOWNLOAD_BATCH_MAX_FILES,
+    ADMISSION_MIN_CONCURRENCY,
+    ADMISSION_MAX_CONCURRENCY,
+    ADMISSION_TARGET_LAG,
+    ADMISSION_TARGET_UPSTREAM_LATENCY,
+    ADMISSION_UPSTREAM_HALF_LIFE,
+    ADMISSION_MAX_STREAMS,
+    PROFILING_PERMISSION,
+    PROFILING_MAX_SECONDS,
+    PACK_DIR,
+    PACK_MAX_FILE_SIZE,
+    PACK_COMPACT_RATIO,
+    PACK_COMPACT_MIN_BYTES,
+)
+from api.utils import get_valid_filename, get_jwt_key, get_check_permission_client
 
 # Metadata
 description = "An API for downloading files."
@@ -32,15 +98,8 @@ license = {
 }
 
 # Initialize app
+# The OpenAPI schema and docs are set up lazily (see api/openapi.py) to keep cold starts fast
 api = responder.API(
-    title="API for downloading files",
-    version="1.0",
-    openapi="3.0.2",
-    docs_route='/docs',
-    description=description,
-    terms_of_service=terms_of_service,
-    contact=contact,
-    license=license,
     cors=True,
     cors_params={
         'allow_origins': ['*'],
@@ -50,8 +109,78 @@ api = responder.API(
     },
     secret_key=os.environ.get('SECRET_KEY', os.urandom(12))
 )
+openapi = LazyOpenAPI(
+    api,
+    title="API for downloading files",
+    version="1.0",
+    openapi="3.0.2",
+    info={
+        'description': description,
+        'termsOfService': terms_of_service,
+        'contact': contact,
+        'license': license,
+    },
+)
 catalogs = {}
 debug = os.environ.get('API_DEBUG', '') in ['true', 'True', 'TRUE', '1']
+# Only uploads are written once; files elsewhere may be truncated in place while mapped
+mmap_cache = MmapCache(MMAP_MAX_FILE_SIZE, MMAP_CACHE_SIZE, roots=[UPLOADED_FILE_PATH_PREFIX])
+io_scheduler = IOScheduler(
+    read_workers=IO_READ_WORKERS,
+    write_workers=IO_WRITE_WORKERS,
+    mount_concurrency=IO_MOUNT_CONCURRENCY,
+    mount_limits=parse_mount_limits(IO_MOUNT_LIMITS),
+)
+bandwidth_shaper = BandwidthShaper(
+    global_limit=BANDWIDTH_GLOBAL_LIMIT,
+    per_user_limit=BANDWIDTH_PER_USER_LIMIT,
+    per_database_limit=BANDWIDTH_PER_DATABASE_LIMIT,
+    config_file=BANDWIDTH_CONFIG_FILE or None,
+)
+shared_cache = SharedCache(
+    url=SHARED_CACHE_URL or None,
+    local_size=SHARED_CACHE_LOCAL_SIZE,
+    local_ttl=SHARED_CACHE_LOCAL_TTL,
+    max_value_size=SHARED_CACHE_MAX_VALUE_SIZE,
+    retry_interval=SHARED_CACHE_RETRY_INTERVAL,
+)
+bulk_delete_executor = ThreadPoolExecutor(max_workers=BULK_DELETE_CONCURRENCY, thread_name_prefix='bulk-delete')
+upload_pipeline = UploadPipeline(
+    UPLOAD_STATUS_DIR,
+    io_scheduler,
+    status_ttl=UPLOAD_STATUS_TTL,
+    temp_grace_period=UPLOAD_TEMP_GRACE_PERIOD,
+    sweep_interval=UPLOAD_SWEEP_INTERVAL,
+)
+manifest_store = ManifestStore(UPLOADED_FILE_PATH_PREFIX, MANIFEST_DIR)
+pack_store = PackStore(
+    UPLOADED_FILE_PATH_PREFIX,
+    PACK_DIR,
+    max_file_size=PACK_MAX_FILE_SIZE,
+    compact_ratio=PACK_COMPACT_RATIO,
+    compact_min_bytes=PACK_COMPACT_MIN_BYTES,
+)
+served_roots = parse_roots(SERVED_ROOT_DIRECTORIES)
+path_resolver = PathResolver(
+    allowed_roots=[UPLOADED_FILE_PATH_PREFIX, *served_roots] if served_roots else [],
+    ttl=PATH_CACHE_TTL,
+    max_entries=PATH_CACHE_SIZE,
+    shared_cache=shared_cache,
+)
+offloader = Offloader(OFFLOAD_MODE, parse_locations(OFFLOAD_LOCATIONS))
+admission_controller = AdmissionController(
+    kinds=(TOKENS, UPLOADS),
+    min_limit=ADMISSION_MIN_CONCURRENCY,
+    max_limit=ADMISSION_MAX_CONCURRENCY,
+    target_lag=ADMISSION_TARGET_LAG,
+    target_upstream_latency=ADMISSION_TARGET_UPSTREAM_LATENCY,
+    upstream_half_life=ADMISSION_UPSTREAM_HALF_LIFE,
+    max_streams=ADMISSION_MAX_STREAMS,
+    streams=lambda: bandwidth_shaper.active.get(('global',), 0),
+)
+memory_tracer = MemoryTracer()
+profiling_lock = threading.Lock()
+_pending_compactions: Set[str] = set()
 
 # Disable GZIP to make sure that 'Content-Length' appears in response headers
 _app = api
@@ -65,6 +194,59 @@ while True:
         break
 
 
+@api.on_event('startup')
+def recover_uploads():
+    """Clean up temp files and states left by uploads interrupted by a crash, and expire old states."""
+    upload_pipeline.start()
+
+
+@api.on_event('startup')
+def start_shared_cache():
+    """Start listening to cache invalidations published by the other workers."""
+    shared_cache.start()
+
+
+@api.on_event('startup')
+def start_admission_control():
+    """Start measuring the load to admit requests by."""
+    admission_controller.start()
+
+
+def _admitted(kind: str):
+    """Shed requests of a handler with 503 while the worker is overloaded.
+
+    Args:
+        kind (str): Kind of the requests (see api/admission.py).
+
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(self, req, resp, *args, **kwargs):
+            retry_after = admission_controller.try_acquire(kind)
+            if retry_after is not None:
+                resp.status_code = 503
+                resp.headers['Retry-After'] = str(retry_after)
+                resp.media = {'detail': 'The server is overloaded. Retry later.'}
+                return
+            try:
+                return await handler(self, req, resp, *args, **kwargs)
+            finally:
+                admission_controller.release(kind)
+        return wrapper
+    return decorator
+
+
+@api.route('/schema.yml')
+def schema(_, resp):
+    resp.headers['Content-Type'] = 'application/x-yaml'
+    resp.content = openapi.schema
+
+
+@api.route('/docs')
+def docs(_, resp):
+    resp.html = openapi.docs
+
+
 @api.route('/')
 def index(req, resp):
     """Index page."""
@@ -85,86 +267,147 @@ def echo(_, resp, *, content, resp_type):
 
 @api.route('/healthz')
 def healthz(_, resp):
+    # Let load balancers route around a worker which is shedding load
+    if admission_controller.degraded:
+        resp.status_code = 503
+        resp.text = 'degraded'
+        return
     resp.text = 'ok'
 
 
+@api.route('/metrics')
+def metrics(_, resp):
+    """Return internal metrics of this worker."""
+    resp.media = {
+        'io': io_scheduler.stats(),
+        'bandwidth': bandwidth_shaper.stats(),
+        'shared_cache': shared_cache.stats(),
+        'paths': path_resolver.stats(),
+        'admission': admission_controller.stats(),
+        'packs': pack_store.stats(),
+    }
+
+
+@api.route('/debug/profile')
+async def profile(req, resp):
+    """Sample the stacks of this worker for a while and return them collapsed for flamegraphs."""
+    if not _check_admin(req, resp):
+        return
+    try:
+        seconds = float(req.params.get('seconds', '10'))
+        interval = float(req.params.get('interval', '0.005'))
+    except ValueError:
+        resp.status_code = 400
+        resp.media = {'detail': 'Param seconds and interval must be numbers.'}
+        return
+    if not 0 < seconds <= PROFILING_MAX_SECONDS or not 0 < interval <= 1:
+        resp.status_code = 400
+        resp.media = {'detail': f'Param seconds must be in (0, {PROFILING_MAX_SECONDS}] and interval in (0, 1].'}
+        return
+
+    if not profiling_lock.acquire(blocking=False):
+        resp.status_code = 409
+        resp.media = {'detail': 'Another profile is running.'}
+        return
+    try:
+        resp.text = await SamplingProfiler(interval).profile(seconds)
+    finally:
+        profiling_lock.release()
+
+
+@api.route('/debug/tasks')
+async def tasks(req, resp):
+    """Dump the asyncio tasks of this worker."""
+    if not _check_admin(req, resp):
+        return
+    resp.media = {'tasks': dump_tasks()}
+
+
+@api.route('/debug/memory')
+class Memory:
+    def on_get(self, req, resp):
+        """Compare the allocations of this worker with the snapshot taken when tracing started."""
+        if not _check_admin(req, resp):
+            return
+        if not memory_tracer.tracing:
+            resp.status_code = 409
+            resp.media = {'detail': 'Memory is not traced. Start tracing first.'}
+            return
+        group_by = req.params.get('group_by', 'traceback')
+        limit = req.params.get('limit', '20')
+        if group_by not in ('traceback', 'lineno', 'filename') or not limit.isdigit():
+            resp.status_code = 400
+            resp.media = {'detail': 'Param group_by must be traceback, lineno or filename and limit an integer.'}
+            return
+        resp.media = memory_tracer.diff(int(limit), group_by)
+
+    async def on_post(self, req, resp):
+        """Start (or restart from a new baseline) or stop tracing allocations."""
+        if not _check_admin(req, resp):
+            return
+        data = await req.media()
+        action = data.get('action')
+        if action == 'start':
+            memory_tracer.start()
+        elif action == 'stop':
+            memory_tracer.stop()
+        else:
+            resp.status_code = 400
+            resp.media = {'detail': 'Param action must be start or stop.'}
+            return
+        resp.media = {'tracing': memory_tracer.tracing}
+
+
 @api.route('/download')
 class Downloads:
+    @_admitted(TOKENS)
     async def on_post(self, req, resp):
         """Generate token for downloading a file.
 
+        With `cacheable`, the token is the same for every user and request within a time window
+        (CACHEABLE_URL_WINDOW), so that shared caches in front of the API can reuse responses.
+        The permission of the requesting user is checked either way.
+
+        Tokens for many files are issued at once if `files` (a list of objects with the same
+        params) is given; params outside `files` apply to every file.
+
         Args:
             req (any): Request object.
             resp (any): Response object.
 
         Returns:
-            (json): A dict containing a download token.
+            (json): A dict containing a download token, or `results` (token or status_code and
+                detail of each file) for `files`.
 
         """
         data = await req.media()
-        database_id = data.get('database_id', None)
-        file_uuid = data.get('file_uuid', None)
-        record_id = data.get('record_id', None)
-        content_type = data.get('content_type', None)
 
-        # Validation
-        if not file_uuid or not database_id:
-            resp.status_code = 400
+        # Issue tokens for many files at once
+        if 'files' in data:
+            files = data['files']
+            if not isinstance(files, list) or len(files) > DOWNLOAD_BATCH_MAX_FILES:
+                resp.status_code = 400
+                resp.media = {
+                    'detail': f'Param files must be a list of at most {DOWNLOAD_BATCH_MAX_FILES} files.',
+                }
+                return
+            # Validate the whole batch before issuing any token
+            common = {k: v for k, v in data.items() if k != 'files'}
+            items = [{**common, **item} for item in files if isinstance(item, dict)]
+            if len(items) != len(files) or not all(item.get('database_id') and item.get('file_uuid') for item in items):
+                resp.status_code = 400
+                resp.media = {
+                    'detail': 'Each item of files must be an object with file_uuid and database_id '
+                              '(given in the item or for all the files).',
+                }
+                return
+            results = await asyncio.gather(*[_issue_token(req, item) for item in items])
             resp.media = {
-                'detail': 'Param file_uuid and database_id must be specified.',
+                'results': [{'status_code': status_code, **media} for status_code, media in results],
             }
             return
 
-        # Get file path (also for checking existance of the file)
-        path = _get_file_path(req, database_id, file_uuid)
-        if not path:
-            resp.status_code = 404
-            resp.media = {'detail': 'No such file'}
-            return
-
-        # Check permission
-        permission_client = get_check_permission_client(req)
-        try:
-            permission_client.check_permissions('file:read', database_id)
-        except PermissionError:
-            resp.status_code = 403
-            resp.media = {'detail': 'Operation not permitted.'}
-            return
-
-        payload = {
-            'database_id': database_id,
-            'record_id': record_id,
-            'path': path,
-            'content_type': content_type
-        }
-
-        if all([database_id is not None, record_id is not None]):
-            payload['content_type'] = _get_content_type(req, database_id, record_id, path)
-
-        if not is_valid_path(path, check_existence=True):
-            resp.status_code = 404
-            resp.media = {'detail': 'No such file'}
-            return
-
-        # Encode payload
-        jwt_lifetime = float(os.environ.get('JWT_LIFETIME', '3600'))
-        payload.update({
-            'iss': 'api-file-provider',
-            'iat': datetime.utcnow(),
-            'nbf': datetime.utcnow(),
-            'exp': datetime.utcnow() + timedelta(seconds=jwt_lifetime)
-        })
-        key = get_jwt_key()
-        token = jwt.encode(payload, key, algorithm='HS256')
-
-        # Convert to str
-        if isinstance(token, bytes):
-            token = token.decode('utf-8')
-
-        # Returns
-        resp.media = {
-            'token': token
-        }
+        resp.status_code, resp.media = await _issue_token(req, data)
 
 
 @api.route('/download/{token}')
@@ -201,9 +444,46 @@ class Download:
         if payload.get('path', None) is None:
             raise ValueError('path not found')
 
-        # Get file size
+        # Check file
         path = payload.get('path')
-        file_size = os.path.getsize(path)
+        packed = await io_scheduler.read(path, pack_store.lookup, path, priority=INTERACTIVE)
+        if not path_resolver.is_valid(path, check_existence=packed is None):
+            resp.status_code = 404
+            resp.media = {'detail': 'No such file: {}'.format(path)}
+            return
+
+        try:
+            stat = packed.stat() if packed is not None else \
+                await io_scheduler.read(path, os.stat, path, priority=INTERACTIVE)
+        except FileNotFoundError:
+            resp.status_code = 404
+            resp.media = {'detail': 'No such file: {}'.format(path)}
+            return
+
+        # The ETag lets clients check that ranges fetched separately come from the same file.
+        # It was put in the token at issue time, so the manifest is read only if the file has changed since.
+        if payload.get('etag') is not None and payload.get('size') == stat.st_size \
+                and payload.get('mtime_ns') == stat.st_mtime_ns:
+            etag = payload['etag']
+        else:
+            etag = await io_scheduler.read(path, _get_etag, path, packed, stat, priority=INTERACTIVE)
+        resp.headers['ETag'] = etag
+
+        # Let shared caches keep responses of cacheable tokens until the tokens expire.
+        # Cacheable tokens are the ones without an issue time, which would make them differ.
+        if 'iat' not in payload and payload.get('etag') is not None:
+            if etag != payload['etag']:
+                resp.status_code = 404
+                resp.media = {'detail': 'The file has changed since the token was issued'}
+                return
+            resp.headers.update(cache_headers(etag, payload['exp']))
+            if matches_etag(req.headers.get('If-None-Match', None), etag):
+                resp.status_code = 304
+                resp.content = b''
+                return
+
+        # Get file size
+        file_size = stat.st_size
 
         # Prepare headers
         filename = urllib.parse.quote(os.path.basename(path))
@@ -215,10 +495,9 @@ class Download:
         if payload.get('content_type', None) is not None:
             resp.headers['Content-Type'] = payload.get('content_type')
 
-        # Check file
-        if not is_valid_path(path, check_existence=True):
-            resp.status_code = 404
-            resp.media = {'detail': 'No such file: {}'.format(path)}
+        # Let the fronting proxy send the file (a packed file is only a range of its pack, so it is sent here)
+        if packed is None and _offload(resp, path, user_id=payload.get('user_id'),
+                                       database_id=payload.get('database_id')):
             return
 
         # Get range request
@@ -240,23 +519,28 @@ class Download:
             resp.status_code = 206
 
         # Stream the file
-        resp.stream(_shout_stream, path, start=bytes_to_start, size=size)
+        priority = INTERACTIVE if asked_range is not None else BULK
+        resp.stream(_shout_stream, path, start=bytes_to_start, size=size, priority=priority,
+                    user_id=payload.get('user_id'), database_id=payload.get('database_id'),
+                    packed=packed is not None, stat=stat)
 
 
 @api.route('/upload')
 class Upload:
+    @_admitted(UPLOADS)
     async def on_post(self, req, resp):
+        """Upload a file and register it in the metastore.
 
-        @api.background.task
-        def save_file(save_file_path, file):
-            # Create directory if not exist
-            dir_path = os.path.dirname(save_file_path)
-            os.makedirs(dir_path, exist_ok=True)
+        The file is written to a temp file, fsynced and renamed before it is registered, so the
+        metastore never points to a partially written file. By default the response is returned
+        once the file is registered. With `wait=false`, 202 is returned right away and the
+        progress can be followed at `/upload/{upload_id}`.
 
-            # Save file
-            with open(save_file_path, 'wb') as f:
-                f.write(file['content'])
+        Args:
+            req (any): Request object.
+            resp (any): Response object.
 
+        """
         data = await req.media(format='files')
         file = data['file']
         if 'metadata' in data.keys():
@@ -265,9 +549,10 @@ class Upload:
             file_metadata = {}
         database_id = req.params.get('database_id', '')
         record_id = req.params.get('record_id', '')
+        wait = strtobool(req.params.get('wait', 'true'))
 
         # Check permission
-        permission_client = get_check_permission_client(req)
+        permission_client = get_check_permission_client(req, cache=shared_cache, ttl=PERMISSION_CACHE_TTL)
         try:
             permission_client.check_permissions('file:write:add', database_id)
         except PermissionError:
@@ -275,48 +560,97 @@ class Upload:
             resp.media = {'detail': 'Operation not permitted.'}
             return
 
-        save_file_path = os.path.join(
-            UPLOADED_FILE_PATH_PREFIX,
-            f'database_{get_valid_filename(database_id)}',
-            f'record_{get_valid_filename(record_id)}',
-            file['filename'],
-        )
-        if not is_valid_path(save_file_path, check_existence=False):
+        save_file_path = os.path.join(_get_record_dir(database_id, record_id), file['filename'])
+        if not path_resolver.is_valid(save_file_path, check_existence=False):
             resp.status_code = 403
             resp.media = {
                 'detail': f'Invalid path: {save_file_path}',
             }
             return
-        if os.path.exists(save_file_path):
+        if await io_scheduler.read(save_file_path, _file_exists, save_file_path, priority=INTERACTIVE):
             resp.status_code = 409
             resp.media = {
                 'detail': f'The file with the same path ({save_file_path}) already exists.',
             }
             return
-        else:
-            save_file(save_file_path, file)
 
-        # Add metadata to meta-store
-        fetch_success, fetch_res = _update_metastore(req, database_id, record_id, save_file_path,
-                                                     file_metadata)
+        # Save the file, then add metadata to meta-store
+        upload_id = await upload_pipeline.create(save_file_path, database_id, record_id)
+        register = functools.partial(_update_metastore, req, database_id, record_id, save_file_path, file_metadata)
+        content_type = file_metadata.get('content-type') or file.get('content-type') \
+            or mimetypes.guess_type(save_file_path)[0]
+        on_registered = functools.partial(_on_file_added, database_id, save_file_path, file['content'], content_type)
+        # Small files are appended to the pack of the record instead of being saved on their own
+        store, discard = (pack_store.add, pack_store.remove) if pack_store.should_pack(len(file['content'])) \
+            else (None, None)
+        pipeline = asyncio.ensure_future(upload_pipeline.run(upload_id, file['content'], register, on_registered,
+                                                             store=store, discard=discard))
+        if not wait:
+            # The upload keeps its admission slot until the pipeline finishes, not just until the 202
+            admission_controller.hold(UPLOADS)
+            pipeline.add_done_callback(lambda _: admission_controller.release(UPLOADS))
+            resp.status_code = 202
+            resp.media = {
+                'upload_id': upload_id,
+                'save_file_path': save_file_path,
+                'state': (await io_scheduler.read(UPLOAD_STATUS_DIR, upload_pipeline.get_status, upload_id,
+                                                  priority=INTERACTIVE))['state'],
+            }
+            return
 
-        if fetch_success and fetch_res is not None:
+        status, fetch_res = await pipeline
+        if status['state'] == REGISTERED:
             resp.status_code = fetch_res.status_code if fetch_res.status_code != 200 else 201
-            fetch_res_body = fetch_res.json()
             resp.media = {
                 'save_file_path': save_file_path,
-                **fetch_res_body
+                'upload_id': upload_id,
+                **status['file']
             }
             return
 
         else:
-            resp.status_code = 500
+            resp.status_code = status['status_code']
             resp.media = {
-                'detail': 'Metadata updating process returned no response'
+                'detail': status['detail'],
+                'upload_id': upload_id,
             }
             return
 
 
+@api.route('/upload/{upload_id}')
+class UploadStatus:
+    async def on_get(self, req, resp, *, upload_id):
+        """Return the state of an upload.
+
+        Args:
+            req (any): Request object.
+            resp (any): Response object.
+            *
+            upload_id (str): Id of the upload.
+
+        Returns:
+            (json): The state (receiving, fsynced, registered or failed) and details of the upload.
+
+        """
+        status = await io_scheduler.read(UPLOAD_STATUS_DIR, upload_pipeline.get_status, upload_id,
+                                         priority=INTERACTIVE)
+        if status is None:
+            resp.status_code = 404
+            resp.media = {'detail': 'No such upload'}
+            return
+
+        # Check permission
+        permission_client = get_check_permission_client(req, cache=shared_cache, ttl=PERMISSION_CACHE_TTL)
+        try:
+            permission_client.check_permissions('file:write:add', status['database_id'])
+        except PermissionError:
+            resp.status_code = 403
+            resp.media = {'detail': 'Operation not permitted.'}
+            return
+
+        resp.media = {k: v for k, v in status.items() if k not in ['host', 'pid']}
+
+
 @api.route('/delete')
 class DeleteFile:
     async def on_delete(self, req: responder.Request, resp: responder.Response):
@@ -347,7 +681,7 @@ class DeleteFile:
             return
 
         # Check if path is in the UPLOADED_FILE_PATH_PREFIX directory
-        if not is_file_in_directory(file_path, UPLOADED_FILE_PATH_PREFIX):
+        if not path_resolver.is_file_in_directory(file_path, UPLOADED_FILE_PATH_PREFIX):
             resp.status_code = 403
             resp.media = {
                 'detail': f'Deleting ({file_path}) is forbbiden.',
@@ -355,7 +689,7 @@ class DeleteFile:
             return
 
         # Check permission
-        permission_client = get_check_permission_client(req)
+        permission_client = get_check_permission_client(req, cache=shared_cache, ttl=PERMISSION_CACHE_TTL)
         try:
             permission_client.check_permissions('file:write:delete', database_id)
         except PermissionError:
@@ -364,23 +698,213 @@ class DeleteFile:
             return
 
         # Detele file
-        try:
-            os.remove(file_path)
-        except (PermissionError, IsADirectoryError):
-            resp.status_code = 403
+        status_code, detail, packed = _delete_file(file_path)
+        if detail is not None:
+            resp.status_code = status_code
             resp.media = {
-                'detail': f'Deleting ({file_path}) is forbbiden.',
+                'detail': detail,
             }
             return
-        except FileNotFoundError:
-            resp.status_code = 404
+        _invalidate_cached_file(database_id, file_path, file_uuid)
+        await io_scheduler.write(file_path, _remove_from_manifests, [file_path])
+        if packed:
+            _schedule_compaction(os.path.dirname(file_path))
+
+        resp.status_code = 200
+        return
+
+
+@api.route('/delete/bulk')
+class BulkDelete:
+    async def on_post(self, req: responder.Request, resp: responder.Response):
+        """Delete many files of a database at once.
+
+        Either `file_uuids` or `record_id` must be given in the body. With `record_id`, all the
+        files uploaded to the record are deleted. Files are processed in batches: their paths are
+        resolved concurrently and they are deleted on the write pool. Then `record_*` directories
+        left empty are removed.
+
+        Args:
+            req (responder.Request): Request object.
+            resp (responder.Response): Response object.
+
+        Returns:
+            (json): Result (status_code and detail) of each file.
+
+        """
+        data = await req.media()
+        database_id = data.get('database_id', None)
+        file_uuids = data.get('file_uuids', None)
+        record_id = data.get('record_id', None)
+
+        # Validation
+        if not database_id or (not file_uuids) == (not record_id) \
+                or (file_uuids and not isinstance(file_uuids, list)):
+            resp.status_code = 400
+            resp.media = {
+                'detail': 'Param database_id and either file_uuids (list) or record_id must be specified.',
+            }
+            return
+        if file_uuids and len(file_uuids) > BULK_DELETE_MAX_FILES:
+            resp.status_code = 400
             resp.media = {
-                'detail': f'The file ({file_path}) does not exist.',
+                'detail': f'At most {BULK_DELETE_MAX_FILES} file_uuids can be deleted at once.',
             }
             return
 
+        # Check permission
+        permission_client = get_check_permission_client(req, cache=shared_cache, ttl=PERMISSION_CACHE_TTL)
+        try:
+            permission_client.check_permissions('file:write:delete', database_id)
+        except PermissionError:
+            resp.status_code = 403
+            resp.media = {'detail': 'Operation not permitted.'}
+            return
+
+        loop = asyncio.get_event_loop()
+        if file_uuids:
+            items = [{'file_uuid': file_uuid} for file_uuid in file_uuids]
+        else:
+            record_path = _get_record_dir(database_id, record_id)
+            paths = await loop.run_in_executor(bulk_delete_executor, _list_uploaded_files, record_path)
+            items = [{'path': path} for path in paths]
+
+        packed_dirs = set()
+
+        async def delete(item):
+            if 'path' not in item:
+                # Get file path (also for checking existance of the file)
+                item = {**item, 'path': await loop.run_in_executor(
+                    bulk_delete_executor, _get_file_path, req, database_id, item['file_uuid'])}
+            file_path = item['path']
+            if not file_path:
+                return {**item, 'status_code': 404, 'detail': 'No such file'}
+            # Check if path is in the UPLOADED_FILE_PATH_PREFIX directory
+            in_directory = await loop.run_in_executor(
+                bulk_delete_executor, path_resolver.is_file_in_directory, file_path, UPLOADED_FILE_PATH_PREFIX)
+            if not in_directory:
+                return {**item, 'status_code': 403, 'detail': f'Deleting ({file_path}) is forbbiden.'}
+            status_code, detail, packed = await io_scheduler.write(file_path, _delete_file, file_path)
+            if status_code == 200:
+                _invalidate_cached_file(database_id, file_path, item.get('file_uuid'))
+            if packed:
+                packed_dirs.add(os.path.dirname(file_path))
+            return {**item, 'status_code': status_code, **({'detail': detail} if detail is not None else {})}
+
+        # Bound the number of pending operations however many files are deleted
+        results = []
+        for start in range(0, len(items), BULK_DELETE_CONCURRENCY):
+            results += await asyncio.gather(*[delete(item) for item in items[start:start + BULK_DELETE_CONCURRENCY]])
+        deleted_paths = [result['path'] for result in results if result['status_code'] == 200]
+        if deleted_paths:
+            await io_scheduler.write(UPLOADED_FILE_PATH_PREFIX, _remove_from_manifests, deleted_paths)
+
+        # Remove record directories left empty
+        record_dirs = {
+            os.path.dirname(result['path']) for result in results
+            if result['status_code'] == 200
+            and os.path.basename(os.path.dirname(result['path'])).startswith('record_')
+        }
+        removed_directories = [
+            dir_path for dir_path in sorted(record_dirs)
+            if await io_scheduler.write(dir_path, _remove_empty_directory, dir_path)
+        ]
+        for dir_path in sorted(packed_dirs):
+            _schedule_compaction(dir_path)
+
         resp.status_code = 200
-        return
+        resp.media = {
+            'results': results,
+            'removed_directories': removed_directories,
+        }
+
+
+@api.route('/list')
+class RecordFiles:
+    async def on_get(self, req: responder.Request, resp: responder.Response):
+        """List the files uploaded to a record.
+
+        The listing is served from the manifest of the record, which is updated on every upload
+        and delete, so the record directory is not scanned. If the record has no manifest yet,
+        it is built from the directory once (without digests).
+
+        Args:
+            req (responder.Request): Request object.
+            resp (responder.Response): Response object.
+
+        Returns:
+            (json): Name, path, size, mtime, content type and digest of each file.
+
+        """
+        database_id = req.params.get('database_id', '')
+        record_id = req.params.get('record_id', '')
+
+        # Validation
+        if not database_id or not record_id:
+            resp.status_code = 400
+            resp.media = {'detail': 'Param database_id and record_id must be specified.'}
+            return
+
+        # Check permission
+        permission_client = get_check_permission_client(req, cache=shared_cache, ttl=PERMISSION_CACHE_TTL)
+        try:
+            permission_client.check_permissions('file:read', database_id)
+        except PermissionError:
+            resp.status_code = 403
+            resp.media = {'detail': 'Operation not permitted.'}
+            return
+
+        record_dir = _get_record_dir(database_id, record_id)
+        entries = await io_scheduler.read(record_dir, manifest_store.list, record_dir, priority=INTERACTIVE)
+        if entries is None:
+            if not await io_scheduler.read(record_dir, os.path.isdir, record_dir, priority=INTERACTIVE):
+                resp.status_code = 404
+                resp.media = {'detail': 'No such record'}
+                return
+            entries = await io_scheduler.write(record_dir, _rebuild_manifest, record_dir, False)
+
+        resp.media = _format_listing(database_id, record_id, record_dir, entries)
+
+
+@api.route('/list/rebuild')
+class RebuildRecordFiles:
+    async def on_post(self, req: responder.Request, resp: responder.Response):
+        """Rebuild the manifest of a record from its directory.
+
+        Use this to recover after files were added or removed behind the API's back.
+        Digests are computed for files which changed unless `digest` is false.
+
+        Args:
+            req (responder.Request): Request object.
+            resp (responder.Response): Response object.
+
+        Returns:
+            (json): The rebuilt listing.
+
+        """
+        data = await req.media()
+        database_id = data.get('database_id', None)
+        record_id = data.get('record_id', None)
+        compute_digest = bool(data.get('digest', True))
+
+        # Validation
+        if not database_id or not record_id:
+            resp.status_code = 400
+            resp.media = {'detail': 'Param database_id and record_id must be specified.'}
+            return
+
+        # Check permission
+        permission_client = get_check_permission_client(req, cache=shared_cache, ttl=PERMISSION_CACHE_TTL)
+        try:
+            permission_client.check_permissions('file:write:add', database_id)
+        except PermissionError:
+            resp.status_code = 403
+            resp.media = {'detail': 'Operation not permitted.'}
+            return
+
+        record_dir = _get_record_dir(database_id, record_id)
+        entries = await io_scheduler.write(record_dir, _rebuild_manifest, record_dir, compute_digest)
+        resp.media = _format_listing(database_id, record_id, record_dir, entries)
 
 
 @api.route('/file')
@@ -402,7 +926,7 @@ async def get_file(req, resp):
     content_type = req.params.get('content_type', None)
 
     # Check permission
-    permission_client = get_check_permission_client(req)
+    permission_client = get_check_permission_client(req, cache=shared_cache, ttl=PERMISSION_CACHE_TTL)
     try:
         permission_client.check_permissions('file:read', database_id)
     except PermissionError:
@@ -416,13 +940,26 @@ async def get_file(req, resp):
     elif all([database_id is not None, record_id is not None]):
         resp.headers['Content-Type'] = _get_content_type(req, database_id, record_id, path)
 
-    if not is_valid_path(path, check_existence=True):
+    packed = await io_scheduler.read(path, pack_store.lookup, path, priority=INTERACTIVE) if path else None
+    if not path_resolver.is_valid(path, check_existence=packed is None):
         resp.status_code = 404
         resp.media = {'detail': 'No such file'}
         return
 
+    # Let the fronting proxy send the file (a packed file is only a range of its pack, so it is sent here)
+    if packed is None and _offload(resp, path, user_id=_get_user_id(req), database_id=database_id):
+        return
+
     # Get file size
-    file_size = os.path.getsize(path)
+    try:
+        stat = packed.stat() if packed is not None else \
+            await io_scheduler.read(path, os.stat, path, priority=INTERACTIVE)
+    except OSError:
+        # Deleted since its resolution was cached
+        resp.status_code = 404
+        resp.media = {'detail': 'No such file'}
+        return
+    file_size = stat.st_size
     resp.headers['Content-Length'] = str(file_size)
 
     # Get range request
@@ -443,24 +980,378 @@ async def get_file(req, resp):
         resp.headers['Content-Length'] = str(size)
         resp.status_code = 206
 
-    resp.stream(_shout_stream, path, start=bytes_to_start, size=size)
+    priority = INTERACTIVE if asked_range is not None else BULK
+    resp.stream(_shout_stream, path, start=bytes_to_start, size=size, priority=priority,
+                user_id=_get_user_id(req), database_id=database_id, packed=packed is not None, stat=stat)
+
+
+async def _shout_stream(filepath, chunk_size=8192, start=0, size=None, priority=BULK,
+                        user_id=None, database_id=None, packed=False, stat=None):
+    shaped_stream = bandwidth_shaper.open_stream(user_id, database_id)
+    try:
+        if packed:
+            # Read the range of the pack the file was appended to
+            opened = await io_scheduler.read(filepath, pack_store.open, filepath, priority=priority)
+            if opened is None:
+                return
+            f, entry = opened
+            offset = entry.offset
+            size = min(size, entry.size - start) if size is not None else entry.size - start
+        else:
+            # Small files are sliced out of a shared memory map in one piece
+            mapped = await _get_mapped(filepath, stat, priority) if stat is not None else None
+            if mapped is not None:
+                end = len(mapped) if size is None else min(start + size, len(mapped))
+                if start < end:
+                    # Copy the slice before yielding control, so that the map is never read across an await
+                    chunk = mapped[start:end]
+                    await shaped_stream.throttle(len(chunk))
+                    yield chunk
+                return
+
+            f = await io_scheduler.read(filepath, _open_served_file, filepath, priority=priority)
+            if f is None:
+                return
+            offset = 0
+        try:
+            bytes_read = 0
+            while size is None or bytes_read < size:
+                bytes_to_read = min(chunk_size, size - bytes_read) if size is not None else chunk_size
+                buffer = await io_scheduler.read(filepath, os.pread, f.fileno(), bytes_to_read,
+                                                 offset + start + bytes_read, priority=priority)
+                if buffer:
+                    bytes_read += len(buffer)
+                    await shaped_stream.throttle(len(buffer))
+                    yield buffer
+                else:
+                    break
+        finally:
+            f.close()
+    finally:
+        shaped_stream.close()
+
+
+async def _get_mapped(path: str, stat: os.stat_result, priority: int) -> Optional[mmap.mmap]:
+    """Return the cached memory map of a small file, mapping it on the read pool on a miss."""
+    mapped = mmap_cache.get(path, stat)
+    if mapped is None and mmap_cache.should_map(stat):
+        mapped = await io_scheduler.read(path, mmap_cache.load, path, stat, priority=priority)
+        if mapped is not None:
+            mmap_cache.add(path, stat, mapped)
+    return mapped
+
+
+def _open_served_file(path: str) -> Optional[BinaryIO]:
+    """Open a file to stream, or return None if what was opened may not be served.
+
+    Paths are validated against cached resolutions, which a symlink swapped since then makes
+    stale, so the file actually opened is checked again.
+
+    """
+    f = open(path, 'rb', buffering=0)
+    if not path_resolver.is_opened_file_allowed(f.fileno(), path):
+        f.close()
+        print(f'Refused to serve {path}: it no longer resolves to an allowed file')
+        return None
+    return f
+
+
+async def _issue_token(req: responder.Request, data: dict) -> Tuple[int, dict]:
+    """Issue a token for downloading a file.
 
+    Requests to the other services run on the default executor, and file I/O on the read pool
+    of the mount of the file.
 
-async def _shout_stream(filepath, chunk_size=8192, start=0, size=None):
-    async with aiofiles.open(filepath, 'rb') as f:
-        bytes_read = 0
-        await f.seek(start)
-        while size is None or bytes_read < size:
-            bytes_to_read = min(chunk_size, size - bytes_read) if size is not None else chunk_size
-            buffer = await f.read(bytes_to_read)
-            if buffer:
-                bytes_read += len(buffer)
-                yield buffer
-            else:
-                break
+    Args:
+        req (responder.Request): Request object.
+        data (dict): Params (database_id, file_uuid, record_id, content_type and cacheable).
+
+    Returns:
+        (Tuple[int, dict]): Status code and a dict containing the token or the detail of the error.
+
+    """
+    database_id = data.get('database_id', None)
+    file_uuid = data.get('file_uuid', None)
+    record_id = data.get('record_id', None)
+    content_type = data.get('content_type', None)
+    cacheable = bool(data.get('cacheable', CACHEABLE_DOWNLOAD_URLS))
+
+    # Validation
+    if not file_uuid or not database_id:
+        return 400, {'detail': 'Param file_uuid and database_id must be specified.'}
+
+    # Get file path (also for checking existance of the file)
+    loop = asyncio.get_event_loop()
+    path = await loop.run_in_executor(None, _get_file_path, req, database_id, file_uuid)
+    if not path:
+        return 404, {'detail': 'No such file'}
+
+    # Check permission
+    permission_client = get_check_permission_client(req, cache=shared_cache, ttl=PERMISSION_CACHE_TTL)
+    try:
+        await loop.run_in_executor(None, permission_client.check_permissions, 'file:read', database_id)
+    except PermissionError:
+        return 403, {'detail': 'Operation not permitted.'}
+
+    payload = {
+        'database_id': database_id,
+        'record_id': record_id,
+        'path': path,
+        'content_type': content_type,
+        'user_id': _get_user_id(req),
+    }
+
+    if all([database_id is not None, record_id is not None]):
+        payload['content_type'] = await loop.run_in_executor(None, _get_content_type, req, database_id, record_id,
+                                                             path)
+
+    described = await io_scheduler.read(path, _describe_file, path, priority=INTERACTIVE)
+    if described is None:
+        return 404, {'detail': 'No such file'}
+    stat, etag = described
+
+    # With the status of the file, downloads can tell whether the ETag is still valid with a single stat
+    payload.update({
+        'etag': etag,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    })
+
+    # Encode payload
+    if cacheable:
+        # Leave out anything specific to this request so that the token is stable
+        del payload['user_id']
+        payload.update({
+            'iss': 'api-file-provider',
+            'exp': bucketed_expiry(CACHEABLE_URL_WINDOW),
+        })
+    else:
+        jwt_lifetime = float(os.environ.get('JWT_LIFETIME', '3600'))
+        payload.update({
+            'iss': 'api-file-provider',
+            'iat': datetime.utcnow(),
+            'nbf': datetime.utcnow(),
+            'exp': datetime.utcnow() + timedelta(seconds=jwt_lifetime)
+        })
+    key = get_jwt_key()
+    token = jwt.encode(payload, key, algorithm='HS256')
+
+    # Convert to str
+    if isinstance(token, bytes):
+        token = token.decode('utf-8')
+
+    return 200, {'token': token}
+
+
+def _describe_file(path: str) -> Optional[Tuple[os.stat_result, str]]:
+    """Return the status and ETag of a file to serve, packed or not, or None if it may not be served."""
+    packed = pack_store.lookup(path)
+    if not path_resolver.is_valid(path, check_existence=packed is None):
+        return None
+    try:
+        stat = packed.stat() if packed is not None else os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat, _get_etag(path, packed, stat)
+
+
+def _offload(resp, path: str, user_id: Optional[str] = None, database_id: Optional[str] = None) -> bool:
+    """Hand the file over to the fronting proxy if offloading is enabled and covers its path.
+
+    Args:
+        resp (responder.Response): Response to set the header on.
+        path (str): Validated path of the file.
+        user_id (Optional[str]): Identity of the requesting user, for the rate limit.
+        database_id (Optional[str]): Database the file belongs to, for the rate limit.
+
+    Returns:
+        (bool): True if the proxy is going to send the file.
+
+    """
+    if not offloader.enabled:
+        return False
+    header = offloader.header_for(path_resolver.lookup(path)[0])
+    if header is None:
+        return False
+    # The proxy sets the length (and handles Range requests) itself
+    resp.headers.pop('Content-Length', None)
+    resp.headers[header[0]] = header[1]
+    limit = bandwidth_shaper.connection_limit(user_id, database_id)
+    if header[0] == 'X-Accel-Redirect' and limit > 0:
+        resp.headers['X-Accel-Limit-Rate'] = str(int(limit))
+    resp.content = b''
+    return True
+
+
+def _check_admin(req: responder.Request, resp: responder.Response) -> bool:
+    """Check that the request comes from an admin, otherwise respond with 403.
+
+    Args:
+        req (responder.Request): Request.
+        resp (responder.Response): Response to set the error to.
+
+    Returns:
+        (bool): Whether the request is permitted.
+
+    """
+    permission_client = get_check_permission_client(req, cache=shared_cache, ttl=PERMISSION_CACHE_TTL)
+    try:
+        permission_client.check_permissions(PROFILING_PERMISSION)
+    except PermissionError:
+        resp.status_code = 403
+        resp.media = {'detail': 'Operation not permitted.'}
+        return False
+    return True
+
+
+def _get_user_id(req) -> Optional[str]:
+    """Return the identity (`sub`) in the JWT of the request, if any."""
+    try:
+        jwt_payload = get_jwt_payload_from_request(req)
+    except Exception:
+        return None
+    if not isinstance(jwt_payload, dict):
+        return None
+    return jwt_payload.get('sub', None)
+
+
+def _file_exists(path: str) -> bool:
+    """Return whether a file exists at the path, saved on its own or packed."""
+    return os.path.exists(path) or pack_store.lookup(path) is not None
+
+
+def _delete_file(file_path: str) -> Tuple[int, Optional[str], bool]:
+    """Delete a file.
+
+    Args:
+        file_path (str): Path to the file.
+
+    Returns:
+        (Tuple[int, Optional[str], bool]): Status code, the detail of the error if failed, and whether
+            the file was packed.
+
+    """
+    try:
+        os.remove(file_path)
+    except (PermissionError, IsADirectoryError):
+        return 403, f'Deleting ({file_path}) is forbbiden.', False
+    except FileNotFoundError:
+        if not pack_store.remove(file_path):
+            return 404, f'The file ({file_path}) does not exist.', False
+        return 200, None, True
+    return 200, None, False
+
+
+def _list_uploaded_files(directory: str) -> List[str]:
+    """List files uploaded to a directory, packed or not, excluding hidden (e.g., in-progress) ones."""
+    try:
+        with os.scandir(directory) as entries:
+            paths = [
+                entry.path for entry in entries
+                if entry.is_file(follow_symlinks=False) and not entry.name.startswith('.')
+            ]
+    except FileNotFoundError:
+        paths = []
+    return sorted(paths + pack_store.paths(directory))
+
+
+def _get_record_dir(database_id: str, record_id: str) -> str:
+    """Return the directory files of a record are uploaded to."""
+    return os.path.join(
+        UPLOADED_FILE_PATH_PREFIX,
+        f'database_{get_valid_filename(database_id)}',
+        f'record_{get_valid_filename(record_id)}',
+    )
+
+
+def _format_listing(database_id: str, record_id: str, record_dir: str, entries: List[dict]) -> dict:
+    return {
+        'database_id': database_id,
+        'record_id': record_id,
+        'files': [{**entry, 'path': os.path.join(record_dir, entry['name'])} for entry in entries],
+        'total_size': sum(entry['size'] for entry in entries),
+    }
+
+
+def _on_file_added(database_id: str, save_file_path: str, content: bytes, content_type: Optional[str]):
+    """Update caches and the manifest of the record once an uploaded file is registered."""
+    _invalidate_cached_file(database_id, save_file_path)
+    packed = pack_store.lookup(save_file_path)
+    manifest_store.add(save_file_path, digest=content_digest(content), content_type=content_type,
+                       stat=packed.stat() if packed is not None else None)
+
+
+def _rebuild_manifest(record_dir: str, compute_digest: bool) -> List[dict]:
+    """Rebuild the manifest of a record from its directory and its pack."""
+    packed = {name: entry.stat() for name, entry in pack_store.files(record_dir).items()}
+    return manifest_store.rebuild(record_dir, compute_digest, packed=packed)
+
+
+def _schedule_compaction(record_dir: str):
+    """Compact the pack of a record in the background once enough of it is deleted.
+
+    Deletes arriving while a compaction of the record is pending do not schedule another one.
+
+    """
+    if record_dir in _pending_compactions:
+        return
+    _pending_compactions.add(record_dir)
+
+    def compact():
+        # Deletes from now on are not seen by this compaction, so let them schedule the next one
+        _pending_compactions.discard(record_dir)
+        try:
+            pack_store.compact(record_dir)
+        except (OSError, ValueError) as e:
+            print(f'Failed to compact the pack of {record_dir}: {e}')
+
+    io_scheduler.submit_write(record_dir, compact)
+
+
+def _remove_from_manifests(file_paths: List[str]):
+    """Remove deleted files from the manifests of their records, one update per record."""
+    names_by_dir = {}
+    for file_path in file_paths:
+        names_by_dir.setdefault(os.path.dirname(file_path), []).append(os.path.basename(file_path))
+    for dir_path, names in names_by_dir.items():
+        try:
+            manifest_store.remove(dir_path, names)
+        except ValueError:
+            # Not in UPLOADED_FILE_PATH_PREFIX, so it has no manifest
+            pass
+
+
+def _remove_empty_directory(dir_path: str) -> bool:
+    """Remove the directory if it is empty, and return whether it was removed."""
+    try:
+        os.rmdir(dir_path)
+    except OSError:
+        return False
+    return True
+
+
+def _get_etag(path: str, packed: Optional[PackEntry] = None, stat: Optional[os.stat_result] = None) -> str:
+    """Return the ETag of a file, derived from its digest if the manifest knows it."""
+    if stat is None:
+        stat = packed.stat() if packed is not None else os.stat(path)
+    entry = manifest_store.get(path)
+    digest = None
+    if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+        digest = entry.get('digest')
+    return etag_for(stat, digest)
 
 
 def _get_content_type(req, database_id, record_id, path):
+    cache_key = f'content_type:{database_id}:{path}'
+    content_type = shared_cache.get(cache_key)
+    if content_type is None:
+        content_type = _fetch_content_type(req, database_id, record_id, path)
+        if content_type is not None:
+            shared_cache.set(cache_key, content_type, SHARED_CACHE_TTL)
+    return content_type
+
+
+def _fetch_content_type(req, database_id, record_id, path):
     # Try to get content-type of the file from meta-data
     try:
         # TODO: Don't use catalogs
@@ -476,7 +1367,8 @@ def _get_content_type(req, database_id, record_id, path):
         request_url = '{}/{}/records/{}'.format(
             record_service, quote(database_id), quote(record_id)
         )
-        response = requests.get(request_url, headers=forward_header)
+        with admission_controller.upstream():
+            response = requests.get(request_url, headers=forward_header)
         record_info = json.loads(response.text)
         corresponding_file = next(filter(lambda x: x['path'] == path, record_info['files']))
         return corresponding_file['content-type']
@@ -521,8 +1413,9 @@ def _update_metastore(
         **file_metadata
     }
     try:
-        res = requests.post(f'{META_STORE_SERVICE}/databases/{database_id}/files',
-                            json=request_data, headers=headers)
+        with admission_controller.upstream():
+            res = requests.post(f'{META_STORE_SERVICE}/databases/{database_id}/files',
+                                json=request_data, headers=headers)
     except Exception:
         return (False, None)
 
@@ -553,12 +1446,36 @@ def _get_file_path(req: responder.Request, database_id: str, uuid: str) -> Optio
     except KeyError:
         return None
 
+    cache_key = f'file_path:{database_id}:{uuid}'
+    path = shared_cache.get(cache_key)
+    if path is not None:
+        return path
+
     try:
-        res = requests.get(f'{META_STORE_SERVICE}/databases/{database_id}/files/{uuid}', headers=headers)
+        with admission_controller.upstream():
+            res = requests.get(f'{META_STORE_SERVICE}/databases/{database_id}/files/{uuid}', headers=headers)
         res_data = json.loads(res.text)
-        return res_data['path']
+        path = res_data['path']
     except Exception:
         return None
+    shared_cache.set(cache_key, path, SHARED_CACHE_TTL)
+    return path
+
+
+def _invalidate_cached_file(database_id: str, path: str, file_uuid: Optional[str] = None):
+    """Drop what the workers cached about a file which has been added or deleted.
+
+    Args:
+        database_id (str)
+        path (str)
+        file_uuid (Optional[str])
+
+    """
+    keys = [f'content_type:{database_id}:{path}']
+    if file_uuid:
+        keys.append(f'file_path:{database_id}:{file_uuid}')
+    shared_cache.invalidate(*keys)
+    path_resolver.invalidate(path)
 
 
 if __name__ == '__main__':
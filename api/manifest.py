@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Manifests of the files uploaded to each record directory."""
+
+from collections import OrderedDict
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from api.journal import FileLock, append_records, encode_records, parse_records, replace_records
+
+LOG_SUFFIX = '.log'
+LOCK_SUFFIX = '.lock'
+
+
+def file_digest(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Return the sha256 digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return f'sha256:{digest.hexdigest()}'
+
+
+def content_digest(content: bytes) -> str:
+    """Return the sha256 digest of content."""
+    return f'sha256:{hashlib.sha256(content).hexdigest()}'
+
+
+class _Manifest:
+    """Entries of a manifest, as replayed from its log."""
+
+    def __init__(self, ino: int):
+        self.ino = ino
+        self.loaded = 0
+        self.entries: Dict[str, dict] = {}
+
+    def apply(self, record: dict):
+        if 'name' not in record:
+            # Header written by a compaction
+            return
+        if record.get('deleted'):
+            self.entries.pop(record['name'], None)
+        else:
+            self.entries[record['name']] = record
+
+
+class ManifestStore:
+    """Keep a manifest (name, size, mtime, content type and digest) per record directory.
+
+    Manifests are kept in a separate tree mirroring the uploaded files, so that record
+    directories contain nothing but the uploaded files. They are updated when files are added
+    or deleted, so that listing a record never needs to touch the record directory.
+
+    Each manifest is an append-only log of JSON lines: an entry per added file and a tombstone
+    per deleted one, so an update costs one append however many files the record has. The log
+    is compacted to its live entries once it has doubled in size since the last compaction.
+    Updates of a manifest are serialized with a lock file next to it.
+
+    Each worker keeps the manifests it replayed and follows their logs incrementally, like
+    the indexes of packs, so a lookup costs one stat of the log plus parsing what was
+    appended since. A log is replayed again only when a compaction has replaced it.
+
+    Args:
+        root (str): Directory the uploaded files are saved in.
+        manifest_dir (str): Directory to keep the manifests in.
+        compact_min_bytes (int): Size below which a manifest is never compacted.
+        max_manifests (int): Maximum number of manifests kept in memory.
+
+    """
+
+    def __init__(self, root: str, manifest_dir: str, compact_min_bytes: int = 64 * 1024, max_manifests: int = 256):
+        self.root = os.path.abspath(root)
+        self.manifest_dir = os.path.abspath(manifest_dir)
+        self.compact_min_bytes = compact_min_bytes
+        self.max_manifests = max_manifests
+        self._locks = FileLock()
+        self._manifests: 'OrderedDict[str, _Manifest]' = OrderedDict()
+        self._mutex = threading.Lock()
+
+    def manifest_path(self, record_dir: str) -> str:
+        relpath = os.path.relpath(os.path.abspath(record_dir), self.root)
+        if relpath.startswith(os.pardir):
+            raise ValueError(f'{record_dir} is not in {self.root}')
+        return os.path.join(self.manifest_dir, f'{relpath}{LOG_SUFFIX}')
+
+    @staticmethod
+    def entry_for(
+        path: str,
+        digest: Optional[str] = None,
+        content_type: Optional[str] = None,
+        stat: Optional[os.stat_result] = None,
+    ) -> dict:
+        """Return the manifest entry of a file, given its status if it is not saved on its own (e.g., packed)."""
+        stat = stat or os.stat(path)
+        return {
+            'name': os.path.basename(path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'content_type': content_type or mimetypes.guess_type(path)[0],
+            'digest': digest,
+        }
+
+    def _lock(self, manifest_path: str):
+        return self._locks.hold(manifest_path[:-len(LOG_SUFFIX)] + LOCK_SUFFIX)
+
+    def _refresh(self, manifest_path: str) -> Optional[_Manifest]:
+        """Bring a manifest up to date with its log. Must be called with _mutex held."""
+        try:
+            st = os.stat(manifest_path)
+        except FileNotFoundError:
+            self._manifests.pop(manifest_path, None)
+            return None
+
+        manifest = self._manifests.get(manifest_path)
+        if manifest is None or manifest.ino != st.st_ino or st.st_size < manifest.loaded:
+            # Not loaded yet, or replaced by a compaction
+            manifest = _Manifest(st.st_ino)
+        if st.st_size > manifest.loaded:
+            try:
+                with open(manifest_path, 'rb') as f:
+                    # A new log reusing the inode would not continue right after a complete line
+                    if manifest.loaded > 0:
+                        f.seek(manifest.loaded - 1)
+                        if f.read(1) != b'\n':
+                            manifest = _Manifest(st.st_ino)
+                    f.seek(manifest.loaded)
+                    data = f.read(st.st_size - manifest.loaded)
+            except FileNotFoundError:
+                self._manifests.pop(manifest_path, None)
+                return None
+            # A line being appended right now is left for the next refresh
+            records, complete = parse_records(data, manifest_path)
+            for record in records:
+                manifest.apply(record)
+            manifest.loaded += complete
+
+        self._manifests[manifest_path] = manifest
+        self._manifests.move_to_end(manifest_path)
+        while len(self._manifests) > self.max_manifests:
+            self._manifests.popitem(last=False)
+        return manifest
+
+    def _load(self, manifest_path: str) -> Optional[Dict[str, dict]]:
+        """Return a copy of the entries of a manifest, or None if it does not exist or has no entries."""
+        with self._mutex:
+            manifest = self._refresh(manifest_path)
+            return dict(manifest.entries) if manifest is not None and manifest.entries else None
+
+    @staticmethod
+    def _save(manifest_path: str, entries: Dict[str, dict]):
+        """Replace a manifest with the entries. Must be called with the lock held."""
+        if not entries:
+            try:
+                os.remove(manifest_path)
+            except FileNotFoundError:
+                pass
+            return
+        records = [entries[name] for name in sorted(entries)]
+        replace_records(manifest_path, [{'compacted_size': len(encode_records(records))}] + records)
+
+    @staticmethod
+    def _compacted_size(manifest_path: str) -> int:
+        with open(manifest_path, 'rb') as f:
+            line = f.readline()
+        try:
+            return json.loads(line).get('compacted_size', 0)
+        except (ValueError, AttributeError):
+            return 0
+
+    def _append(self, record_dir: str, records: List[dict], create: bool = True):
+        """Append records to a manifest, compacting it once it has doubled in size."""
+        manifest_path = self.manifest_path(record_dir)
+        with self._lock(manifest_path):
+            if not create and not os.path.exists(manifest_path):
+                return
+            size = append_records(manifest_path, records)
+            if size > max(2 * self._compacted_size(manifest_path), self.compact_min_bytes):
+                self._save(manifest_path, self._load(manifest_path) or {})
+
+    def add(
+        self,
+        path: str,
+        digest: Optional[str] = None,
+        content_type: Optional[str] = None,
+        stat: Optional[os.stat_result] = None,
+    ):
+        """Add (or replace) the entry of a file which has been saved."""
+        entry = self.entry_for(path, digest=digest, content_type=content_type, stat=stat)
+        self._append(os.path.dirname(path), [entry])
+
+    def remove(self, record_dir: str, names: Iterable[str]):
+        """Remove the entries of files which have been deleted."""
+        records = [{'name': name, 'deleted': True} for name in names]
+        if records:
+            self._append(record_dir, records, create=False)
+
+    def get(self, path: str) -> Optional[dict]:
+        """Return the entry of a file, or None if it is not in a manifest."""
+        try:
+            manifest_path = self.manifest_path(os.path.dirname(path))
+        except ValueError:
+            return None
+        with self._mutex:
+            manifest = self._refresh(manifest_path)
+            return manifest.entries.get(os.path.basename(path)) if manifest is not None else None
+
+    def list(self, record_dir: str) -> Optional[List[dict]]:
+        """Return the entries of a record sorted by name, or None if it has no manifest."""
+        manifest_path = self.manifest_path(record_dir)
+        with self._mutex:
+            manifest = self._refresh(manifest_path)
+            if manifest is None or not manifest.entries:
+                return None
+            return [manifest.entries[name] for name in sorted(manifest.entries)]
+
+    def rebuild(
+        self,
+        record_dir: str,
+        compute_digest: bool = True,
+        packed: Optional[Dict[str, os.stat_result]] = None,
+    ) -> List[dict]:
+        """Rebuild the manifest of a record by scanning its directory.
+
+        Content types and digests already in the manifest are kept for files whose size and
+        mtime did not change.
+
+        Args:
+            record_dir (str): Record directory to scan.
+            compute_digest (bool): Whether to compute digests missing from the manifest.
+            packed (Optional[Dict[str, os.stat_result]]): Status of the packed files of the record keyed by
+                name. Their digests are kept but not computed.
+
+        Returns:
+            (List[dict]): The new entries sorted by name.
+
+        """
+        manifest_path = self.manifest_path(record_dir)
+        with self._lock(manifest_path):
+            previous = self._load(manifest_path) or {}
+            entries = {}
+            try:
+                with os.scandir(record_dir) as scanned:
+                    files = [e for e in scanned if e.is_file(follow_symlinks=False) and not e.name.startswith('.')]
+            except FileNotFoundError:
+                files = []
+            for dir_entry in files:
+                stat = dir_entry.stat(follow_symlinks=False)
+                old = previous.get(dir_entry.name, {})
+                unchanged = old.get('size') == stat.st_size and old.get('mtime') == stat.st_mtime
+                digest = old.get('digest') if unchanged else None
+                if digest is None and compute_digest:
+                    digest = file_digest(dir_entry.path)
+                entries[dir_entry.name] = self.entry_for(
+                    dir_entry.path, digest=digest, content_type=old.get('content_type') if unchanged else None)
+            for name, stat in (packed or {}).items():
+                old = previous.get(name, {})
+                unchanged = old.get('size') == stat.st_size and old.get('mtime') == stat.st_mtime
+                entries[name] = self.entry_for(
+                    os.path.join(record_dir, name), digest=old.get('digest') if unchanged else None,
+                    content_type=old.get('content_type') if unchanged else None, stat=stat)
+            self._save(manifest_path, entries)
+        return [entries[name] for name in sorted(entries)]
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""LRU cache of read-only memory maps for serving small files."""
+
+from collections import OrderedDict
+import mmap
+import os
+from typing import Iterable, Optional, Tuple
+
+from api.paths import is_within, opened_realpath
+
+
+def _key(stat: os.stat_result) -> tuple:
+    return stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class MmapCache:
+    """Keep read-only memory maps of small files open across requests.
+
+    Maps are keyed by path and invalidated when the inode, mtime or size of the file changes.
+    Files are mapped on I/O threads, while cached maps are looked up on the event loop.
+    Reading a mapping of a file truncated in place faults (SIGBUS) and kills the worker, so
+    only files of write-once trees (uploads are written to a temp file and linked into place)
+    are mapped. Hidden files and directories under the roots (manifests, packs, temp files)
+    are never mapped, since they are rewritten or appended to.
+
+    Args:
+        max_file_size (int): Files larger than this (in bytes) are not mapped. 0 disables the cache.
+        max_entries (int): Maximum number of maps kept open.
+        roots (Iterable[str]): Write-once directories whose files may be mapped.
+
+    """
+
+    def __init__(self, max_file_size: int, max_entries: int, roots: Iterable[str] = ()):
+        self.max_file_size = max_file_size
+        self.max_entries = max_entries
+        self.roots = [os.path.realpath(root) for root in roots]
+        self._maps: 'OrderedDict[str, Tuple[tuple, mmap.mmap]]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._maps)
+
+    def should_map(self, stat: os.stat_result) -> bool:
+        """Return whether a file of the status is small enough to be mapped."""
+        return self.max_file_size > 0 and self.max_entries > 0 and 0 < stat.st_size <= self.max_file_size
+
+    def get(self, path: str, stat: os.stat_result) -> Optional[mmap.mmap]:
+        """Return the cached map of a file if it still maps the file of the status.
+
+        Only memory is touched, so this may be called on the event loop. On a miss, map the
+        file with load on an I/O thread and cache the map with add.
+
+        Args:
+            path (str): Path to the file.
+            stat (os.stat_result): Current status of the file.
+
+        Returns:
+            (Optional[mmap.mmap]): Read-only map of the whole file.
+
+        """
+        entry = self._maps.get(path)
+        if entry is None:
+            return None
+        if entry[0] != _key(stat):
+            self._close(path)
+            return None
+        self._maps.move_to_end(path)
+        return entry[1]
+
+    def load(self, path: str, stat: os.stat_result) -> Optional[mmap.mmap]:
+        """Map a file, or return None if it should not be mapped. Blocking, and does not cache the map.
+
+        Args:
+            path (str): Path to the file.
+            stat (os.stat_result): Status of the file the caller checked, which must still be the one opened.
+
+        """
+        if not self.should_map(stat):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                # The opened file is checked, since a symlink on the path may have been swapped
+                if _key(os.fstat(f.fileno())) != _key(stat) \
+                        or not self.is_mappable(opened_realpath(f.fileno()) or os.path.realpath(path)):
+                    return None
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+    def add(self, path: str, stat: os.stat_result, mapped: mmap.mmap):
+        """Cache a map returned by load, evicting the least recently used ones."""
+        self._close(path)
+        self._maps[path] = (_key(stat), mapped)
+        while len(self._maps) > self.max_entries:
+            self._close(next(iter(self._maps)))
+
+    def is_mappable(self, realpath: str) -> bool:
+        """Return whether a resolved path is in a write-once tree, outside any hidden directory."""
+        for root in self.roots:
+            if is_within(realpath, root):
+                relpath = os.path.relpath(realpath, root)
+                return not any(part.startswith('.') for part in relpath.split(os.sep))
+        return False
+
+    def clear(self):
+        """Close all the maps."""
+        for path in list(self._maps):
+            self._close(path)
+
+    def _close(self, path: str):
+        entry = self._maps.pop(path, None)
+        if entry is None:
+            return
+        try:
+            entry[1].close()
+        except BufferError:
+            # A slice is still exported; the map is released once it is garbage-collected
+            pass
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Hand file transfers over to a fronting proxy with X-Accel-Redirect or X-Sendfile.
+
+The API still authenticates and authorizes every request, then answers with an empty body and
+a header telling the proxy which file to send, so the proxy streams it with sendfile and
+handles Range requests itself.
+
+"""
+
+import os
+from typing import Dict, Optional, Tuple
+from urllib.parse import quote
+
+from api.paths import is_within
+
+X_ACCEL_REDIRECT = 'x-accel-redirect'
+X_SENDFILE = 'x-sendfile'
+MODES = (X_ACCEL_REDIRECT, X_SENDFILE)
+
+
+def parse_locations(value: str) -> Dict[str, str]:
+    """Parse mappings from served roots to internal locations given as `root=location,root=location`.
+
+    Args:
+        value (str): Comma-separated list of `root=location`.
+
+    Returns:
+        (Dict[str, str]): Internal locations keyed by normalized root.
+
+    """
+    locations = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        root, _, location = item.partition('=')
+        if not root.strip() or not location.strip():
+            raise ValueError(f'Invalid offload location: {item}')
+        locations[os.path.normpath(root.strip())] = location.strip().rstrip('/')
+    return locations
+
+
+class Offloader:
+    """Build the headers handing a file over to the proxy.
+
+    Args:
+        mode (str): `x-accel-redirect` (nginx) or `x-sendfile` (Apache, lighttpd). Empty disables offloading.
+        locations (Dict[str, str]): Internal locations (for X-Accel-Redirect) or paths as seen by the
+            proxy (for X-Sendfile) keyed by served root. For X-Sendfile, paths outside the roots are
+            passed as they are.
+
+    """
+
+    def __init__(self, mode: str = '', locations: Optional[Dict[str, str]] = None):
+        mode = (mode or '').lower()
+        if mode and mode not in MODES:
+            raise ValueError(f'Unknown offload mode: {mode}')
+        self.mode = mode
+        # Longest roots first so that nested roots win
+        self.locations = sorted(
+            ((os.path.realpath(root), location) for root, location in (locations or {}).items()),
+            key=lambda item: len(item[0]),
+            reverse=True,
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.mode)
+
+    def header_for(self, realpath: str) -> Optional[Tuple[str, str]]:
+        """Return the header (name, value) handing the file over, or None to stream it in-process.
+
+        Args:
+            realpath (str): Absolute path of the file with symlinks resolved.
+
+        """
+        if not self.enabled:
+            return None
+        for root, location in self.locations:
+            if is_within(realpath, root):
+                relpath = os.path.relpath(realpath, root)
+                if self.mode == X_ACCEL_REDIRECT:
+                    return 'X-Accel-Redirect', quote(f'{location}/{relpath}')
+                return 'X-Sendfile', _raw_header_value(os.path.join(location, relpath))
+        if self.mode == X_SENDFILE:
+            return 'X-Sendfile', _raw_header_value(realpath)
+        return None
+
+
+def _raw_header_value(path: str) -> str:
+    # Header values are encoded as latin-1, which passes the bytes of the path through unchanged
+    return os.fsencode(path).decode('latin-1')
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""OpenAPI schema and docs which are built on first use instead of at import time.
+
+The schema can be precomputed at build time so that no worker has to build it::
+
+    $ python -m api.openapi
+
+"""
+
+import os
+from typing import Optional
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'openapi.yml')
+DOCS_THEME = 'swaggerui'
+
+
+class LazyOpenAPI:
+    """Serve the OpenAPI schema and the docs of an API, importing their machinery lazily.
+
+    Args:
+        app (responder.API): The API to describe.
+        title (str): Title of the API.
+        version (str): Version of the API.
+        openapi (str): OpenAPI version.
+        info (Optional[dict]): Additional info (description, termsOfService, contact, license).
+        schema_file (Optional[str]): Precomputed schema to serve, if the file exists.
+        schema_url (str): URL the schema is served at, referred to from the docs.
+
+    """
+
+    def __init__(
+        self,
+        app,
+        title: str,
+        version: str,
+        openapi: str,
+        info: Optional[dict] = None,
+        schema_file: Optional[str] = SCHEMA_FILE,
+        schema_url: str = '/schema.yml',
+    ):
+        self.app = app
+        self.title = title
+        self.version = version
+        self.openapi_version = openapi
+        self.info = {k: v for k, v in (info or {}).items() if v is not None}
+        self.schema_file = schema_file
+        self.schema_url = schema_url
+        self._schema: Optional[str] = None
+        self._docs: Optional[str] = None
+
+    def build(self) -> str:
+        """Build the schema from the docstrings of the routes."""
+        from apispec import APISpec, yaml_utils
+        from apispec.ext.marshmallow import MarshmallowPlugin
+
+        spec = APISpec(
+            title=self.title,
+            version=self.version,
+            openapi_version=self.openapi_version,
+            plugins=[MarshmallowPlugin()],
+            info=self.info,
+        )
+        for route in self.app.router.routes:
+            if route.description:
+                operations = yaml_utils.load_operations_from_docstring(route.description)
+                spec.path(path=route.route, operations=operations)
+        return spec.to_yaml()
+
+    @property
+    def schema(self) -> str:
+        if self._schema is None:
+            if self.schema_file and os.path.isfile(self.schema_file):
+                with open(self.schema_file, 'r') as f:
+                    self._schema = f.read()
+            else:
+                self._schema = self.build()
+        return self._schema
+
+    @property
+    def docs(self) -> str:
+        if self._docs is None:
+            from pathlib import Path
+
+            import apistar
+            import jinja2
+            import yaml
+
+            theme_path = (Path(apistar.__file__).parent / 'themes' / DOCS_THEME / 'static').resolve()
+            self.app.static_app.add_directory(str(theme_path))
+
+            loader = jinja2.PrefixLoader({
+                DOCS_THEME: jinja2.PackageLoader('apistar', os.path.join('themes', DOCS_THEME, 'templates'))
+            })
+            env = jinja2.Environment(autoescape=True, loader=loader)
+            document = apistar.document.Document()
+            document.content = yaml.safe_load(self.schema)
+            template = env.get_template('/'.join([DOCS_THEME, 'index.html']))
+            self._docs = template.render(
+                document=document,
+                langs=['javascript', 'python'],
+                code_style=None,
+                static_url=lambda asset: f'{self.app.static_route}/{asset}',
+                schema_url=self.schema_url,
+            )
+        return self._docs
+
+    def save(self, path: Optional[str] = None):
+        """Build the schema and write it to the schema file."""
+        with open(path or self.schema_file, 'w') as f:
+            f.write(self.build())
+
+
+if __name__ == '__main__':
+    from api.main import openapi
+
+    openapi.save()
+    print(f'OpenAPI schema has been written to {openapi.schema_file}')
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Pack small uploaded files into one file per record.
+
+Records with tens of thousands of tiny files put a heavy load on the metadata servers of file
+systems such as NFS, and on backups. Small uploads are appended to a pack file of their record
+instead, with an index mapping each name to its offset and size, and are served as ranges of
+the pack. The index is an append-only log, which each worker replays once and then follows
+incrementally, so a lookup costs one stat of the log, or nothing while packing is disabled and
+no pack exists. Deleted files are tombstoned and their
+space is reclaimed by compaction, which copies the remaining files to a new pack.
+
+Packs are kept in a separate tree mirroring the record directories::
+
+    pack_dir/database_x/record_y/index.log
+    pack_dir/database_x/record_y/index.lock
+    pack_dir/database_x/record_y/pack-00000001.bin
+
+"""
+
+from collections import OrderedDict
+import os
+import stat
+import threading
+import time
+from typing import BinaryIO, Dict, List, NamedTuple, Optional, Tuple
+
+from api.journal import FileLock, append_records, fsync_directory, parse_records, replace_records
+
+INDEX_NAME = 'index.log'
+LOCK_NAME = 'index.lock'
+PACK_PREFIX = 'pack-'
+PACK_SUFFIX = '.bin'
+
+
+def _pack_name(generation: int) -> str:
+    return f'{PACK_PREFIX}{generation:08d}{PACK_SUFFIX}'
+
+
+class PackEntry(NamedTuple):
+    """Location of a packed file."""
+
+    pack_path: str
+    offset: int
+    size: int
+    mtime_ns: int
+
+    def stat(self) -> os.stat_result:
+        """Return the status the file would have if it were saved on its own."""
+        mtime = self.mtime_ns / 1e9
+        return os.stat_result(
+            (stat.S_IFREG | 0o644, 0, 0, 1, 0, 0, self.size, int(mtime), int(mtime), int(mtime)),
+            {'st_atime': mtime, 'st_mtime': mtime, 'st_ctime': mtime,
+             'st_atime_ns': self.mtime_ns, 'st_mtime_ns': self.mtime_ns, 'st_ctime_ns': self.mtime_ns},
+        )
+
+
+class _Index:
+    """State of the index of a record, as replayed from its log."""
+
+    def __init__(self, ino: int):
+        self.ino = ino
+        self.loaded = 0
+        self.generation = 0
+        self.pack = None
+        self.entries: Dict[str, dict] = {}
+        self.live_bytes = 0
+        self.dead_bytes = 0
+
+    def apply(self, record: dict):
+        if 'name' not in record:
+            # Header naming the pack entries refer to
+            self.generation = record['generation']
+            self.pack = record['pack']
+            return
+        old = self.entries.pop(record['name'], None)
+        if old is not None:
+            self.live_bytes -= old['size']
+            self.dead_bytes += old['size']
+        if not record.get('deleted'):
+            self.entries[record['name']] = record
+            self.live_bytes += record['size']
+
+
+class PackStore:
+    """Append small files to per-record packs and look them up through their indexes.
+
+    Appends and compactions of a record are serialized with a lock file in its pack directory,
+    so workers and pods sharing the directory can write concurrently.
+
+    Args:
+        root (str): Directory the uploaded files are saved in.
+        pack_dir (str): Directory to keep the packs in.
+        max_file_size (int): Uploads up to this size in bytes are packed. 0 disables packing of new uploads.
+        compact_ratio (float): Ratio of deleted bytes in a pack above which it is compacted.
+        compact_min_bytes (int): Deleted bytes below which a pack is not compacted (unless it has no files left).
+        max_indexes (int): Maximum number of indexes kept in memory.
+
+    """
+
+    def __init__(
+        self,
+        root: str,
+        pack_dir: str,
+        max_file_size: int = 0,
+        compact_ratio: float = 0.5,
+        compact_min_bytes: int = 1024 * 1024,
+        max_indexes: int = 1024,
+    ):
+        self.root = os.path.abspath(root)
+        self.pack_dir = os.path.abspath(pack_dir)
+        self.max_file_size = max_file_size
+        self.compact_ratio = compact_ratio
+        self.compact_min_bytes = compact_min_bytes
+        self.max_indexes = max_indexes
+        self._indexes: 'OrderedDict[str, _Index]' = OrderedDict()
+        self._mutex = threading.Lock()
+        self._locks = FileLock()
+        self._packs_seen: Optional[bool] = None
+        self.lookups = 0
+        self.hits = 0
+        self.compactions = 0
+        self.reclaimed_bytes = 0
+
+    def should_pack(self, size: int) -> bool:
+        """Return whether an upload of the size is packed."""
+        return 0 < self.max_file_size and size <= self.max_file_size
+
+    def pack_dir_for(self, record_dir: str) -> str:
+        relpath = os.path.relpath(os.path.abspath(record_dir), self.root)
+        if relpath == os.curdir or relpath.startswith(os.pardir):
+            raise ValueError(f'{record_dir} is not in {self.root}')
+        return os.path.join(self.pack_dir, relpath)
+
+    def _lock(self, dir_path: str):
+        return self._locks.hold(os.path.join(dir_path, LOCK_NAME))
+
+    def _has_packs(self) -> bool:
+        """Return whether any file may be packed.
+
+        While packing is disabled, the pack directory is only looked for once, so that stores
+        which never packed a file do not stat an index per lookup.
+
+        """
+        if self._packs_seen is None:
+            self._packs_seen = self.max_file_size > 0 or os.path.isdir(self.pack_dir)
+        return self._packs_seen
+
+    def _refresh(self, dir_path: str) -> Optional[_Index]:
+        """Bring the index of a pack directory up to date with its log. Must be called with _mutex held."""
+        index_path = os.path.join(dir_path, INDEX_NAME)
+        try:
+            st = os.stat(index_path)
+        except FileNotFoundError:
+            self._indexes.pop(dir_path, None)
+            return None
+
+        index = self._indexes.get(dir_path)
+        if index is None or index.ino != st.st_ino or st.st_size < index.loaded:
+            # Not loaded yet, or rewritten by a compaction
+            index = _Index(st.st_ino)
+        if st.st_size > index.loaded:
+            with open(index_path, 'rb') as f:
+                f.seek(index.loaded)
+                data = f.read(st.st_size - index.loaded)
+            # A line being appended right now is left for the next refresh
+            records, complete = parse_records(data, index_path)
+            for record in records:
+                index.apply(record)
+            index.loaded += complete
+
+        self._indexes[dir_path] = index
+        self._indexes.move_to_end(dir_path)
+        while len(self._indexes) > self.max_indexes:
+            self._indexes.popitem(last=False)
+        return index
+
+    def _index_of(self, record_dir: str) -> Tuple[Optional[str], Optional[_Index]]:
+        try:
+            dir_path = self.pack_dir_for(record_dir)
+        except ValueError:
+            return None, None
+        if not self._has_packs():
+            return None, None
+        with self._mutex:
+            return dir_path, self._refresh(dir_path)
+
+    @staticmethod
+    def _entry(dir_path: str, index: _Index, record: dict) -> PackEntry:
+        return PackEntry(os.path.join(dir_path, index.pack), record['offset'], record['size'], record['mtime_ns'])
+
+    def lookup(self, path: str) -> Optional[PackEntry]:
+        """Return where a file is packed, or None if it is not packed.
+
+        Args:
+            path (str): Path the file was uploaded to.
+
+        """
+        self.lookups += 1
+        dir_path, index = self._index_of(os.path.dirname(path))
+        if index is None:
+            return None
+        record = index.entries.get(os.path.basename(path))
+        if record is None:
+            return None
+        self.hits += 1
+        return self._entry(dir_path, index, record)
+
+    def open(self, path: str) -> Optional[Tuple[BinaryIO, PackEntry]]:
+        """Open the pack of a file to read it from the offset of the entry.
+
+        Returns:
+            (Optional[Tuple[BinaryIO, PackEntry]]): The opened pack and the entry, or None if the file is not packed.
+
+        """
+        for _ in range(2):
+            entry = self.lookup(path)
+            if entry is None:
+                return None
+            try:
+                return open(entry.pack_path, 'rb', buffering=0), entry
+            except FileNotFoundError:
+                # Compacted in the meantime, so the entry has moved to a new pack
+                continue
+        return None
+
+    def read(self, path: str) -> Optional[bytes]:
+        """Return the content of a packed file, or None if it is not packed."""
+        opened = self.open(path)
+        if opened is None:
+            return None
+        f, entry = opened
+        with f:
+            return os.pread(f.fileno(), entry.size, entry.offset)
+
+    def files(self, record_dir: str) -> Dict[str, PackEntry]:
+        """Return the packed files of a record keyed by name."""
+        dir_path, index = self._index_of(record_dir)
+        if index is None:
+            return {}
+        return {name: self._entry(dir_path, index, record) for name, record in index.entries.items()}
+
+    def paths(self, record_dir: str) -> List[str]:
+        """Return the paths of the packed files of a record, sorted."""
+        return sorted(os.path.join(record_dir, name) for name in self.files(record_dir))
+
+    def add(self, path: str, content: bytes) -> PackEntry:
+        """Append a file to the pack of its record.
+
+        Args:
+            path (str): Path the file is uploaded to.
+            content (bytes): File content.
+
+        Raises:
+            FileExistsError: If a file with the same path exists, packed or not.
+
+        """
+        record_dir, name = os.path.split(path)
+        dir_path = self.pack_dir_for(record_dir)
+        # Keep the record directory so that the record looks the same whether its files are packed or not
+        os.makedirs(record_dir, exist_ok=True)
+        index_path = os.path.join(dir_path, INDEX_NAME)
+        self._packs_seen = True
+        with self._lock(dir_path):
+            with self._mutex:
+                index = self._refresh(dir_path)
+            if (index is not None and name in index.entries) or os.path.lexists(path):
+                raise FileExistsError(path)
+
+            records = []
+            if index is None:
+                index = _Index(0)
+                records.append({'generation': 1, 'pack': _pack_name(1)})
+                index.apply(records[0])
+            pack_path = os.path.join(dir_path, index.pack)
+            with open(pack_path, 'ab') as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            record = {'name': name, 'offset': offset, 'size': len(content), 'mtime_ns': time.time_ns()}
+            append_records(index_path, records + [record])
+            if records:
+                fsync_directory(dir_path)
+        return self._entry(dir_path, index, record)
+
+    def remove(self, path: str) -> bool:
+        """Tombstone a packed file. Its bytes stay in the pack until it is compacted.
+
+        Returns:
+            (bool): Whether the file was packed.
+
+        """
+        record_dir, name = os.path.split(path)
+        try:
+            dir_path = self.pack_dir_for(record_dir)
+        except ValueError:
+            return False
+        if not self._has_packs() or not os.path.exists(os.path.join(dir_path, INDEX_NAME)):
+            return False
+        with self._lock(dir_path):
+            with self._mutex:
+                index = self._refresh(dir_path)
+            if index is None or name not in index.entries:
+                return False
+            append_records(os.path.join(dir_path, INDEX_NAME), [{'name': name, 'deleted': True}])
+        return True
+
+    def needs_compaction(self, record_dir: str) -> bool:
+        """Return whether enough of the pack of a record is deleted to compact it."""
+        _, index = self._index_of(record_dir)
+        if index is None or index.dead_bytes == 0:
+            return False
+        if not index.entries:
+            return True
+        total = index.live_bytes + index.dead_bytes
+        return index.dead_bytes >= self.compact_min_bytes and index.dead_bytes >= total * self.compact_ratio
+
+    def compact(self, record_dir: str, force: bool = False) -> int:
+        """Copy the remaining files of a record to a new pack and delete the old one.
+
+        Readers which already opened the old pack keep reading it; the others find the files
+        in the new pack through the rewritten index.
+
+        Args:
+            record_dir (str): Record directory whose pack is compacted.
+            force (bool): Whether to compact even if little of the pack is deleted.
+
+        Returns:
+            (int): Bytes reclaimed.
+
+        """
+        if not force and not self.needs_compaction(record_dir):
+            return 0
+        dir_path = self.pack_dir_for(record_dir)
+        index_path = os.path.join(dir_path, INDEX_NAME)
+        with self._lock(dir_path):
+            with self._mutex:
+                index = self._refresh(dir_path)
+            if index is None:
+                return 0
+            old_pack_path = os.path.join(dir_path, index.pack)
+            old_size = os.path.getsize(old_pack_path) if os.path.exists(old_pack_path) else 0
+
+            if not index.entries:
+                os.remove(index_path)
+                new_size = 0
+                current = None
+            else:
+                generation = index.generation + 1
+                current = _pack_name(generation)
+                records = [{'generation': generation, 'pack': current}]
+                with open(old_pack_path, 'rb') as src, open(os.path.join(dir_path, current), 'wb') as dst:
+                    # Keep the order of the files in the pack so that neighbours are read sequentially
+                    for record in sorted(index.entries.values(), key=lambda r: r['offset']):
+                        records.append({**record, 'offset': dst.tell()})
+                        dst.write(os.pread(src.fileno(), record['size'], record['offset']))
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                    new_size = dst.tell()
+                replace_records(index_path, records)
+                fsync_directory(dir_path)
+
+            # Remove the old pack, and any left by a compaction which crashed
+            for name in os.listdir(dir_path):
+                if name.startswith(PACK_PREFIX) and name.endswith(PACK_SUFFIX) and name != current:
+                    os.remove(os.path.join(dir_path, name))
+            with self._mutex:
+                self._indexes.pop(dir_path, None)
+
+        self.compactions += 1
+        self.reclaimed_bytes += old_size - new_size
+        return old_size - new_size
+
+    def stats(self) -> dict:
+        return {
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'indexes': len(self._indexes),
+            'compactions': self.compactions,
+            'reclaimed_bytes': self.reclaimed_bytes,
+        }
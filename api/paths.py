@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Validation of requested paths against the served root directories, with a cache of resolutions."""
+
+import os
+from typing import Iterable, List, Optional, Tuple
+
+from api.shared_cache import LocalLRU, SharedCache
+
+# Prefix of the keys published through the shared cache to invalidate resolutions
+INVALIDATION_KEY_PREFIX = 'path:'
+
+# Top-level directories never served when no allowlist is configured
+DENIED_TOP_LEVEL_DIRECTORIES = (
+    'bin', 'boot', 'dev', 'etc', 'home', 'lib', 'lib64', 'media', 'proc', 'root', 'run', 'sbin', 'srv',
+    'sys', 'tmp', 'usr', 'var',
+)
+
+
+def parse_roots(value: str) -> List[str]:
+    """Parse a comma-separated list of root directories.
+
+    >>> parse_roots('/mnt/data, /opt/uploaded_data/')
+    ['/mnt/data', '/opt/uploaded_data']
+    """
+    return [os.path.normpath(root.strip()) for root in value.split(',') if root.strip()]
+
+
+def is_within(path: str, directory: str) -> bool:
+    """Return whether an absolute path is the directory or in it, comparing whole path components.
+
+    Unlike a string prefix check, `/data/a-b` is not considered to be in `/data/a`.
+
+    """
+    try:
+        return os.path.commonpath([path, directory]) == directory
+    except ValueError:
+        return False
+
+
+def opened_realpath(fd: int) -> Optional[str]:
+    """Return the path an open file resolves to as the kernel sees it, or None if unknown (e.g., not on Linux).
+
+    Unlike resolving the path it was opened by again, this cannot race with symlinks being swapped.
+
+    """
+    try:
+        return os.readlink(f'/proc/self/fd/{fd}')
+    except OSError:
+        return None
+
+
+def is_allowed(realpath: str, allowed_roots: Iterable[str] = ()) -> bool:
+    """Return whether a resolved path may be served.
+
+    Args:
+        realpath (str): Absolute path with symlinks resolved.
+        allowed_roots (Iterable[str]): Resolved root directories to serve. If empty, any path
+            outside DENIED_TOP_LEVEL_DIRECTORIES is allowed.
+
+    Returns:
+        (bool): True if the path may be served.
+
+    """
+    allowed_roots = list(allowed_roots)
+    if allowed_roots:
+        return any(is_within(realpath, root) for root in allowed_roots)
+    components = realpath.split(os.sep)
+    return len(components) >= 2 and components[1] not in DENIED_TOP_LEVEL_DIRECTORIES
+
+
+class PathResolver:
+    """Resolve and validate requested paths, caching the results for a short time.
+
+    Resolving a path (realpath) and checking that it is a file cost a metadata round trip per
+    path component on network file systems, and the same paths are checked again and again
+    (e.g., when a token is issued and when it is used), so both are cached per path. A cached
+    resolution goes stale if a symlink on the path is swapped, so files must be checked again
+    with is_opened_file_allowed once they are opened.
+
+    Paths added or deleted are invalidated in the other workers through the pub/sub channel
+    of the shared cache, if given. Files changed behind the API's back are only noticed once
+    their resolutions expire.
+
+    Args:
+        allowed_roots (Iterable[str]): Root directories to serve. If empty, any path outside
+            DENIED_TOP_LEVEL_DIRECTORIES is served.
+        ttl (float): Seconds to cache a resolution. 0 disables caching.
+        max_entries (int): Maximum number of cached resolutions.
+        shared_cache (Optional[SharedCache]): Cache whose channel invalidations are published on.
+
+    """
+
+    def __init__(
+        self,
+        allowed_roots: Iterable[str] = (),
+        ttl: float = 2.0,
+        max_entries: int = 10000,
+        shared_cache: Optional[SharedCache] = None,
+    ):
+        self.allowed_roots = [os.path.realpath(root) for root in allowed_roots]
+        self.ttl = ttl
+        self.cache = LocalLRU(max_entries)
+        self.counters = {'hits': 0, 'misses': 0}
+        self.shared_cache = shared_cache
+        if shared_cache is not None:
+            shared_cache.on_invalidate(self._on_invalidated)
+
+    def lookup(self, path: str) -> Tuple[str, bool]:
+        """Return the resolved path and whether it is a file."""
+        entry = self.cache.get(path)
+        if entry is not None:
+            self.counters['hits'] += 1
+            return entry[0]
+        self.counters['misses'] += 1
+        realpath = os.path.realpath(path)
+        resolution = (realpath, os.path.isfile(realpath))
+        self.cache.set(path, resolution, self.ttl)
+        return resolution
+
+    def is_valid(self, path: Optional[str], check_existence: bool = False) -> bool:
+        """Check if the path may be served.
+
+        Args:
+            path (Optional[str]): File path
+            check_existence (bool): If True, this function also checks the existence of the file
+
+        Returns:
+            (bool): True if the path is valid, otherwise False
+
+        """
+        if not path:
+            return False
+        realpath, is_file = self.lookup(path)
+        if not is_allowed(realpath, self.allowed_roots):
+            return False
+        return is_file or not check_existence
+
+    def is_opened_file_allowed(self, fd: int, path: str) -> bool:
+        """Check the file actually opened for a path, without the cache.
+
+        Args:
+            fd (int): Descriptor of the opened file.
+            path (str): Path the file was opened by, resolved again if the descriptor cannot be.
+
+        """
+        realpath = opened_realpath(fd) or os.path.realpath(path)
+        return is_allowed(realpath, self.allowed_roots)
+
+    def is_file_in_directory(self, file: str, directory: str) -> bool:
+        """Return if the file is in the directory, after resolving both."""
+        return is_within(self.lookup(file)[0], self.lookup(directory)[0])
+
+    def invalidate(self, *paths: str):
+        """Forget paths which have been added or deleted, in all the workers."""
+        for path in paths:
+            self.cache.delete(path)
+        if self.shared_cache is not None:
+            self.shared_cache.invalidate(*[INVALIDATION_KEY_PREFIX + path for path in paths])
+
+    def _on_invalidated(self, keys: List[str]):
+        for key in keys:
+            if key.startswith(INVALIDATION_KEY_PREFIX):
+                self.cache.delete(key[len(INVALIDATION_KEY_PREFIX):])
+
+    def stats(self) -> dict:
+        return {'entries': len(self.cache), **self.counters}
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Inspect a live worker: sample its stacks, dump its asyncio tasks and diff its memory.
+
+Nothing runs while no inspection is active: the sampler thread only exists for the duration of
+a profile, and tracemalloc is only started on request.
+
+"""
+
+import asyncio
+from collections import Counter
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    # Semicolons separate frames in collapsed stacks
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'.replace(';', ':')
+
+
+class SamplingProfiler:
+    """Sample the stacks of all the threads of the process at a fixed interval.
+
+    Args:
+        interval (float): Seconds between samples.
+
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            raise RuntimeError('The profiler is already running.')
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            if len(names) != threading.active_count():
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                labels.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(labels))] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        """Return the samples as collapsed stacks (`frame;frame;frame count` per line), as read by flamegraph.pl."""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    async def profile(self, seconds: float) -> str:
+        """Sample for a while without blocking the event loop and return the collapsed stacks.
+
+        Args:
+            seconds (float): Duration of the profile.
+
+        """
+        self.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.stop()
+        return self.collapsed()
+
+
+def dump_tasks(limit: int = 20) -> List[dict]:
+    """List the asyncio tasks of the running event loop with where each is suspended.
+
+    Args:
+        limit (int): Maximum number of frames per task.
+
+    """
+    tasks = []
+    for task in asyncio.all_tasks():
+        stack = task.get_stack(limit=limit)
+        tasks.append({
+            'name': task.get_name(),
+            'coro': getattr(task.get_coro(), '__qualname__', repr(task.get_coro())),
+            'done': task.done(),
+            'stack': [f'{frame.f_code.co_filename}:{frame.f_lineno} in {frame.f_code.co_name}' for frame in stack],
+        })
+    return sorted(tasks, key=lambda task: task['coro'])
+
+
+class MemoryTracer:
+    """Trace allocations with tracemalloc and compare them to a baseline snapshot.
+
+    Args:
+        frames (int): Number of frames kept per allocation traceback.
+
+    """
+
+    def __init__(self, frames: int = 10):
+        self.frames = frames
+        self.baseline: Optional[tracemalloc.Snapshot] = None
+        self.started_at: Optional[float] = None
+
+    @property
+    def tracing(self) -> bool:
+        return self.baseline is not None
+
+    def start(self):
+        """Start tracing and take the baseline (again, if already tracing)."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self.baseline = tracemalloc.take_snapshot()
+        self.started_at = time.time()
+
+    def stop(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.baseline = None
+        self.started_at = None
+
+    def diff(self, limit: int = 20, group_by: str = 'traceback') -> Dict:
+        """Compare the current allocations with the baseline.
+
+        Args:
+            limit (int): Number of the largest differences to return.
+            group_by (str): `traceback`, `lineno` or `filename`.
+
+        Returns:
+            (Dict): Traced memory and the allocations which grew most since the baseline.
+
+        """
+        if self.baseline is None:
+            raise RuntimeError('Memory is not traced.')
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            'started_at': self.started_at,
+            'traced_memory': current,
+            'peak_traced_memory': peak,
+            'top': [
+                {
+                    'size': stat.size,
+                    'size_diff': stat.size_diff,
+                    'count': stat.count,
+                    'count_diff': stat.count_diff,
+                    'traceback': [f'{frame.filename}:{frame.lineno}' for frame in stat.traceback],
+                }
+                for stat in snapshot.compare_to(self.baseline, group_by)[:limit]
+            ],
+        }
@@ -1,16 +1,41 @@
 #!/usr/bin/env python
 # Copyright API authors
-"""The API server."""
+"""The API server.
+
+Served by uvicorn (with uvloop and httptools when installed) by default, or by hypercorn for
+HTTP/2 with `SERVER_IMPLEMENTATION=hypercorn`. See api/settings.py for the options.
+
+"""
 
 from datetime import datetime
 import hashlib
+import importlib.util
+import multiprocessing
 import os
+import signal
+import socket
 import threading
 import time
 import uvicorn
 
+from settings import (
+    SERVER_HOST,
+    PORT,
+    NUM_WORKERS,
+    SERVER_IMPLEMENTATION,
+    SERVER_LOOP,
+    SERVER_HTTP,
+    SERVER_REUSE_PORT,
+    SERVER_BACKLOG,
+    SERVER_KEEP_ALIVE,
+    SERVER_LIMIT_CONCURRENCY,
+    SERVER_CERTFILE,
+    SERVER_KEYFILE,
+)
 from utils import save_jwt_key
 
+APP = 'main:api'
+
 
 def regenerate_jwt_key(postfix: str = ''):
     """Re-generate JWT key.
@@ -38,15 +63,124 @@ def _key_update_daemon():
         time.sleep(1)
 
 
+def resolve_loop(loop: str) -> str:
+    """Resolve `auto` to uvloop if it is installed, otherwise to asyncio.
+
+    Args:
+        loop (str): auto, asyncio or uvloop.
+
+    """
+    if loop == 'auto':
+        return 'uvloop' if importlib.util.find_spec('uvloop') else 'asyncio'
+    return loop
+
+
+def uvicorn_options() -> dict:
+    """Return the options of uvicorn other than where to listen."""
+    return {
+        'loop': SERVER_LOOP,
+        'http': SERVER_HTTP,
+        'backlog': SERVER_BACKLOG,
+        'timeout_keep_alive': int(SERVER_KEEP_ALIVE),
+        'limit_concurrency': SERVER_LIMIT_CONCURRENCY or None,
+        'ssl_certfile': SERVER_CERTFILE,
+        'ssl_keyfile': SERVER_KEYFILE,
+    }
+
+
+def bind_reuse_port(host: str, port: int, backlog: int) -> socket.socket:
+    """Bind a listening socket which other processes can bind to the same port as well.
+
+    Args:
+        host (str): Address to listen on.
+        port (int): Port to listen on.
+        backlog (int): Maximum number of pending connections.
+
+    Returns:
+        (socket.socket): Listening socket.
+
+    """
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _uvicorn_worker(host: str, port: int):
+    sock = bind_reuse_port(host, port, SERVER_BACKLOG)
+    uvicorn.Server(uvicorn.Config(APP, **uvicorn_options())).run(sockets=[sock])
+
+
+def run_uvicorn():
+    """Serve the API with uvicorn."""
+    if not SERVER_REUSE_PORT:
+        # Workers accept connections from a single socket shared by the parent
+        uvicorn.run(APP, host=SERVER_HOST, port=PORT, workers=NUM_WORKERS, **uvicorn_options())
+        return
+    if NUM_WORKERS <= 1:
+        _uvicorn_worker(SERVER_HOST, PORT)
+        return
+
+    # Each worker has a socket of its own and the kernel spreads new connections evenly
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=_uvicorn_worker, args=(SERVER_HOST, PORT)) for _ in range(NUM_WORKERS)]
+    for process in processes:
+        process.start()
+
+    def shutdown(*_):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        shutdown()
+        for process in processes:
+            process.join()
+
+
+def run_hypercorn():
+    """Serve the API with hypercorn, which speaks HTTP/2 (over TLS, or cleartext with prior knowledge)."""
+    try:
+        from hypercorn.config import Config
+        from hypercorn.run import run
+    except ImportError:
+        raise SystemExit('hypercorn is not installed. Install it with `poetry install -E http2`.')
+    if SERVER_REUSE_PORT:
+        print('SERVER_REUSE_PORT is ignored by hypercorn, whose workers share the sockets of the parent')
+    if SERVER_HTTP != 'auto':
+        print('SERVER_HTTP is ignored by hypercorn')
+
+    config = Config()
+    config.application_path = APP
+    config.bind = [f'{SERVER_HOST}:{PORT}']
+    config.workers = NUM_WORKERS
+    config.worker_class = resolve_loop(SERVER_LOOP)
+    config.backlog = SERVER_BACKLOG
+    config.keep_alive_timeout = SERVER_KEEP_ALIVE
+    config.certfile = SERVER_CERTFILE
+    config.keyfile = SERVER_KEYFILE
+    config.accesslog = '-'
+    config.errorlog = '-'
+    run(config)
+
+
 if __name__ == '__main__':
     debug = os.environ.get('API_DEBUG', '') in ['true', 'True', 'TRUE', '1']
     print('Debug: {}'.format(debug))
     daemon = threading.Thread(target=_key_update_daemon)
     daemon.start()
 
-    uvicorn.run(
-        "main:api",
-        host='0.0.0.0',
-        port=8080,
-        workers=int(os.environ.get('NUM_WORKERS', "1"))
-    )
+    if SERVER_IMPLEMENTATION == 'uvicorn':
+        run_uvicorn()
+    elif SERVER_IMPLEMENTATION == 'hypercorn':
+        run_hypercorn()
+    else:
+        raise SystemExit(f'Unknown SERVER_IMPLEMENTATION: {SERVER_IMPLEMENTATION}')
@@ -15,3 +15,118 @@ if API_META_STORE_SERVICE_HOST and API_META_STORE_SERVICE_PORT:
     META_STORE_SERVICE = f'http://{API_META_STORE_SERVICE_HOST}:{API_META_STORE_SERVICE_PORT}'
 else:
     META_STORE_SERVICE = os.environ.get('META_STORE_SERVICE', 'https://demo.dataware-tools.com/api/latest/meta_store')
+
+# Files up to this size (in bytes) are served from a shared memory map instead of the I/O pools.
+# Set to 0 to disable memory-mapped serving.
+MMAP_MAX_FILE_SIZE = int(os.environ.get('MMAP_MAX_FILE_SIZE', str(1024 * 1024)))
+# Maximum number of memory maps kept open per worker
+MMAP_CACHE_SIZE = int(os.environ.get('MMAP_CACHE_SIZE', '256'))
+
+# Dedicated thread pools for file I/O
+IO_READ_WORKERS = int(os.environ.get('IO_READ_WORKERS', '16'))
+IO_WRITE_WORKERS = int(os.environ.get('IO_WRITE_WORKERS', '4'))
+# Maximum number of concurrent I/O operations per mount point
+IO_MOUNT_CONCURRENCY = int(os.environ.get('IO_MOUNT_CONCURRENCY', '8'))
+# Limits for specific roots given as `path=limit,path=limit`
+IO_MOUNT_LIMITS = os.environ.get('IO_MOUNT_LIMITS', '')
+
+# Bandwidth limits of streamed files in bytes per second (0 means unlimited)
+BANDWIDTH_GLOBAL_LIMIT = float(os.environ.get('BANDWIDTH_GLOBAL_LIMIT', '0'))
+BANDWIDTH_PER_USER_LIMIT = float(os.environ.get('BANDWIDTH_PER_USER_LIMIT', '0'))
+BANDWIDTH_PER_DATABASE_LIMIT = float(os.environ.get('BANDWIDTH_PER_DATABASE_LIMIT', '0'))
+# JSON file overriding the limits above, re-read when it changes
+BANDWIDTH_CONFIG_FILE = os.environ.get('BANDWIDTH_CONFIG_FILE', '')
+
+# Directory to keep states of uploads in
+UPLOAD_STATUS_DIR = os.environ.get('UPLOAD_STATUS_DIR', os.path.join(UPLOADED_FILE_PATH_PREFIX, '.uploads'))
+# Seconds to keep states of finished uploads
+UPLOAD_STATUS_TTL = float(os.environ.get('UPLOAD_STATUS_TTL', '86400'))
+# Seconds after which unfinished uploads by other hosts are treated as orphaned
+UPLOAD_TEMP_GRACE_PERIOD = float(os.environ.get('UPLOAD_TEMP_GRACE_PERIOD', '86400'))
+# Seconds between sweeps of states and temp files left by uploads (0: only at startup)
+UPLOAD_SWEEP_INTERVAL = float(os.environ.get('UPLOAD_SWEEP_INTERVAL', '3600'))
+
+# Number of metastore lookups and path checks run concurrently by a bulk delete
+BULK_DELETE_CONCURRENCY = int(os.environ.get('BULK_DELETE_CONCURRENCY', '16'))
+# Maximum number of file_uuids in a bulk delete
+BULK_DELETE_MAX_FILES = int(os.environ.get('BULK_DELETE_MAX_FILES', '1000'))
+
+# URL of a Redis-compatible store shared by the workers (e.g., redis://localhost:6379/0).
+# If not set, each worker only caches locally.
+SHARED_CACHE_URL = os.environ.get('SHARED_CACHE_URL', '')
+SHARED_CACHE_LOCAL_SIZE = int(os.environ.get('SHARED_CACHE_LOCAL_SIZE', '10000'))
+SHARED_CACHE_LOCAL_TTL = float(os.environ.get('SHARED_CACHE_LOCAL_TTL', '5'))
+SHARED_CACHE_MAX_VALUE_SIZE = int(os.environ.get('SHARED_CACHE_MAX_VALUE_SIZE', '65536'))
+# Seconds to use only the local cache after the shared store could not be reached
+SHARED_CACHE_RETRY_INTERVAL = float(os.environ.get('SHARED_CACHE_RETRY_INTERVAL', '5'))
+# Seconds to cache metastore path lookups and content types
+SHARED_CACHE_TTL = float(os.environ.get('SHARED_CACHE_TTL', '300'))
+# Seconds to cache permission decisions (0 disables caching them)
+PERMISSION_CACHE_TTL = float(os.environ.get('PERMISSION_CACHE_TTL', '30'))
+
+# Directory to keep the manifests (file listings) of record directories in
+MANIFEST_DIR = os.environ.get('MANIFEST_DIR', os.path.join(UPLOADED_FILE_PATH_PREFIX, '.manifests'))
+
+# Comma-separated root directories files may be served from. UPLOADED_FILE_PATH_PREFIX is always
+# included. If not set, any path outside system directories (/etc, /usr, ...) may be served.
+SERVED_ROOT_DIRECTORIES = os.environ.get('SERVED_ROOT_DIRECTORIES', '')
+# Seconds to cache resolutions and validations of paths (0 disables caching them)
+PATH_CACHE_TTL = float(os.environ.get('PATH_CACHE_TTL', '2'))
+PATH_CACHE_SIZE = int(os.environ.get('PATH_CACHE_SIZE', '10000'))
+
+# Whether download tokens are cacheable by default (see api/cacheable.py)
+CACHEABLE_DOWNLOAD_URLS = os.environ.get('CACHEABLE_DOWNLOAD_URLS', '') in ['true', 'True', 'TRUE', '1']
+# Seconds within which the same file gets the same cacheable URL
+CACHEABLE_URL_WINDOW = float(os.environ.get('CACHEABLE_URL_WINDOW', '3600'))
+
+# Hand file transfers over to a fronting proxy: '' (stream in-process), 'x-accel-redirect' or 'x-sendfile'
+OFFLOAD_MODE = os.environ.get('OFFLOAD_MODE', '')
+# Internal locations of served roots given as `root=location,root=location`
+OFFLOAD_LOCATIONS = os.environ.get('OFFLOAD_LOCATIONS', '')
+
+# Maximum number of files a single token request may ask for
+DOWNLOAD_BATCH_MAX_FILES = int(os.environ.get('DOWNLOAD_BATCH_MAX_FILES', '1000'))
+
+# Admission control of token issuance and uploads (see api/admission.py)
+ADMISSION_MIN_CONCURRENCY = int(os.environ.get('ADMISSION_MIN_CONCURRENCY', '4'))
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get('ADMISSION_MAX_CONCURRENCY', '256'))
+# Event-loop lag and upstream latency in seconds above which requests are throttled
+ADMISSION_TARGET_LAG = float(os.environ.get('ADMISSION_TARGET_LAG', '0.1'))
+ADMISSION_TARGET_UPSTREAM_LATENCY = float(os.environ.get('ADMISSION_TARGET_UPSTREAM_LATENCY', '1.0'))
+# Seconds after which the weight of an upstream latency sample is halved
+ADMISSION_UPSTREAM_HALF_LIFE = float(os.environ.get('ADMISSION_UPSTREAM_HALF_LIFE', '10'))
+# Streams in flight above which requests are throttled (0 means no limit)
+ADMISSION_MAX_STREAMS = int(os.environ.get('ADMISSION_MAX_STREAMS', '0'))
+
+# Permission (of api-permission-manager) required to inspect workers with /debug/*
+PROFILING_PERMISSION = os.environ.get('PROFILING_PERMISSION', 'permission:write')
+# Maximum duration of a profile in seconds
+PROFILING_MAX_SECONDS = float(os.environ.get('PROFILING_MAX_SECONDS', '60'))
+
+# Serving (see api/server.py)
+SERVER_HOST = os.environ.get('SERVER_HOST', '0.0.0.0')
+PORT = int(os.environ.get('PORT', '8080'))
+NUM_WORKERS = int(os.environ.get('NUM_WORKERS', '1'))
+# ASGI server: uvicorn, or hypercorn for HTTP/2
+SERVER_IMPLEMENTATION = os.environ.get('SERVER_IMPLEMENTATION', 'uvicorn')
+# Event loop (auto, asyncio or uvloop) and HTTP/1.1 parser of uvicorn (auto, h11 or httptools)
+SERVER_LOOP = os.environ.get('SERVER_LOOP', 'auto')
+SERVER_HTTP = os.environ.get('SERVER_HTTP', 'auto')
+# Let each worker bind its own socket with SO_REUSEPORT so that the kernel balances connections
+SERVER_REUSE_PORT = os.environ.get('SERVER_REUSE_PORT', '') in ['true', 'True', 'TRUE', '1']
+SERVER_BACKLOG = int(os.environ.get('SERVER_BACKLOG', '2048'))
+# Seconds to keep idle connections open
+SERVER_KEEP_ALIVE = float(os.environ.get('SERVER_KEEP_ALIVE', '5'))
+# Connections per worker above which requests are answered with 503 (0 means no limit)
+SERVER_LIMIT_CONCURRENCY = int(os.environ.get('SERVER_LIMIT_CONCURRENCY', '0'))
+# TLS certificate and key, required by browsers for HTTP/2
+SERVER_CERTFILE = os.environ.get('SERVER_CERTFILE') or None
+SERVER_KEYFILE = os.environ.get('SERVER_KEYFILE') or None
+
+# Packing of small uploads into a pack file per record (see api/packs.py)
+PACK_DIR = os.environ.get('PACK_DIR', os.path.join(UPLOADED_FILE_PATH_PREFIX, '.packs'))
+# Uploads up to this size in bytes are packed (0 disables packing)
+PACK_MAX_FILE_SIZE = int(os.environ.get('PACK_MAX_FILE_SIZE', '0'))
+# Ratio and amount of deleted bytes above which a pack is compacted
+PACK_COMPACT_RATIO = float(os.environ.get('PACK_COMPACT_RATIO', '0.5'))
+PACK_COMPACT_MIN_BYTES = int(os.environ.get('PACK_COMPACT_MIN_BYTES', str(1024 * 1024)))
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Cache shared between workers for metastore lookups and permission decisions.
+
+Each worker keeps a small local LRU in front of an optional Redis-compatible store
+(e.g., a Redis sidecar). Invalidations delete the key from the store and are published
+so that every worker drops it from its local LRU as well.
+
+"""
+
+from collections import OrderedDict
+import json
+import socket
+import threading
+import time
+from typing import Any, Callable, List, Optional
+from urllib.parse import urlparse
+
+DEFAULT_CHANNEL = 'api-file-provider:invalidate'
+KEY_PREFIX = 'api-file-provider:'
+
+
+class RedisError(Exception):
+    """Error returned by the Redis-compatible store."""
+
+
+class RedisClient:
+    """Minimal client of the Redis protocol (RESP) with one connection per thread.
+
+    Args:
+        url (str): URL like `redis://[:password@]host[:port][/db]`.
+        timeout (float): Socket timeout in seconds.
+
+    """
+
+    def __init__(self, url: str, timeout: float = 0.5):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def connect(self, timeout: Optional[float] = None):
+        """Open a new connection and return (socket, file)."""
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.settimeout(timeout if timeout is not None else self.timeout)
+        stream = sock.makefile('rb')
+        if self.password:
+            self._send(sock, 'AUTH', self.password)
+            self.read_reply(stream)
+        if self.db:
+            self._send(sock, 'SELECT', self.db)
+            self.read_reply(stream)
+        return sock, stream
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+
+    @staticmethod
+    def _send(sock: socket.socket, *args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        sock.sendall(b''.join(parts))
+
+    @classmethod
+    def read_reply(cls, stream):
+        line = stream.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('Connection closed')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode('utf-8')
+        if kind == b'-':
+            raise RedisError(rest.decode('utf-8'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = stream.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            length = int(rest)
+            return None if length < 0 else [cls.read_reply(stream) for _ in range(length)]
+        raise RedisError(f'Unknown reply: {line!r}')
+
+    def execute(self, *args):
+        """Run a command and return its reply, reconnecting once if the connection is broken."""
+        for attempt in range(2):
+            connection = getattr(self._local, 'connection', None)
+            try:
+                if connection is None:
+                    connection = self._local.connection = self.connect()
+                self._send(connection[0], *args)
+                return self.read_reply(connection[1])
+            except (OSError, ConnectionError):
+                self.close()
+                if attempt:
+                    raise
+
+
+class LocalLRU:
+    """Thread-safe LRU with per-entry expiry.
+
+    Args:
+        max_entries (int): Maximum number of entries.
+
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[tuple]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, value: Any, ttl: float):
+        if self.max_entries <= 0 or ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SharedCache:
+    """Two-tier cache of JSON-serializable values.
+
+    Errors of the shared store never fail a request; the cache then behaves like a miss.
+    Commands block for up to the socket timeout, so after the store could not be reached,
+    only the local tier is used for retry_interval seconds. Invalidations are not published
+    meanwhile, so other workers may serve stale entries for up to local_ttl.
+
+    Args:
+        url (Optional[str]): URL of the Redis-compatible store. If None, only the local tier is used.
+        local_size (int): Maximum number of entries in the local tier.
+        local_ttl (float): Maximum seconds an entry stays in the local tier.
+        max_value_size (int): Values larger than this (in bytes, JSON-encoded) are not cached.
+        channel (str): Pub/sub channel for invalidations.
+        retry_interval (float): Seconds to skip the store for after a connection error.
+
+    """
+
+    def __init__(
+        self,
+        url: Optional[str] = None,
+        local_size: int = 10000,
+        local_ttl: float = 5,
+        max_value_size: int = 65536,
+        channel: str = DEFAULT_CHANNEL,
+        retry_interval: float = 5,
+    ):
+        self.client = RedisClient(url) if url else None
+        self.local = LocalLRU(local_size)
+        self.local_ttl = local_ttl
+        self.max_value_size = max_value_size
+        self.channel = channel
+        self.retry_interval = retry_interval
+        self.counters = {'hits': 0, 'misses': 0, 'errors': 0, 'skipped': 0, 'invalidations': 0}
+        self._listener: Optional[threading.Thread] = None
+        self._callbacks: List[Callable[[List[str]], None]] = []
+        self._skip_until = 0.0
+
+    @property
+    def remote_available(self) -> bool:
+        return self.client is not None and time.monotonic() >= self._skip_until
+
+    def _execute(self, *args):
+        """Run a command on the store, returning None on errors and while the store is skipped."""
+        if self.client is None:
+            return None
+        if not self.remote_available:
+            self.counters['skipped'] += 1
+            return None
+        try:
+            return self.client.execute(*args)
+        except (OSError, ConnectionError):
+            self.counters['errors'] += 1
+            self._skip_until = time.monotonic() + self.retry_interval
+        except RedisError:
+            self.counters['errors'] += 1
+        return None
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value, or None on a miss."""
+        entry = self.local.get(key)
+        if entry is not None:
+            self.counters['hits'] += 1
+            return entry[0]
+        if self.client is not None:
+            reply = self._execute('GET', KEY_PREFIX + key)
+            if reply is not None:
+                try:
+                    value = json.loads(reply.decode('utf-8'))
+                except ValueError:
+                    # Corrupted or written by something else: drop it so that it is cached again
+                    self.counters['errors'] += 1
+                    self._delete(key)
+                else:
+                    self.local.set(key, value, self.local_ttl)
+                    self.counters['hits'] += 1
+                    return value
+        self.counters['misses'] += 1
+        return None
+
+    def set(self, key: str, value: Any, ttl: float):
+        """Cache a value for ttl seconds."""
+        encoded = json.dumps(value)
+        if len(encoded) > self.max_value_size or ttl <= 0:
+            return
+        self.local.set(key, value, min(ttl, self.local_ttl))
+        self._execute('SET', KEY_PREFIX + key, encoded, 'PX', int(ttl * 1000))
+
+    def _delete(self, key: str):
+        self._execute('DEL', KEY_PREFIX + key)
+
+    def invalidate(self, *keys: str):
+        """Drop keys from all the workers."""
+        for key in keys:
+            self.local.delete(key)
+        self.counters['invalidations'] += len(keys)
+        if self.client is None or not keys:
+            return
+        self._execute('DEL', *[KEY_PREFIX + key for key in keys])
+        self._execute('PUBLISH', self.channel, json.dumps(list(keys)))
+
+    def on_invalidate(self, callback: Callable[[List[str]], None]):
+        """Call back with the keys invalidated by the other workers, to drop them from other caches."""
+        self._callbacks.append(callback)
+
+    def _handle_message(self, message: List):
+        if len(message) == 3 and message[0] == b'message':
+            keys = json.loads(message[2].decode('utf-8'))
+            for key in keys:
+                self.local.delete(key)
+            for callback in self._callbacks:
+                callback(keys)
+
+    def _listen(self):
+        while True:
+            try:
+                sock, stream = self.client.connect(timeout=None)
+                try:
+                    self.client._send(sock, 'SUBSCRIBE', self.channel)
+                    while True:
+                        self._handle_message(self.client.read_reply(stream))
+                finally:
+                    stream.close()
+                    sock.close()
+            except (OSError, ConnectionError, RedisError, ValueError):
+                self.counters['errors'] += 1
+                time.sleep(1)
+
+    def start(self):
+        """Start listening to invalidations published by the other workers."""
+        if self.client is None or self._listener is not None:
+            return
+        self._listener = threading.Thread(target=self._listen, name='shared-cache-listener', daemon=True)
+        self._listener.start()
+
+    def stats(self) -> dict:
+        return {
+            'backend': 'redis' if self.client is not None else 'local',
+            'local_entries': len(self.local),
+            **self.counters,
+        }
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Durable upload pipeline: receive into a temp file, fsync, rename, then register."""
+
+import asyncio
+from datetime import datetime
+import json
+import os
+import socket
+import time
+import traceback
+from typing import Callable, Optional, Tuple
+import uuid
+
+from api.journal import fsync_directory
+
+# States of an upload
+RECEIVING = 'receiving'
+FSYNCED = 'fsynced'
+REGISTERED = 'registered'
+FAILED = 'failed'
+
+TEMP_SUFFIX = '.part'
+
+# Files of this process older than this were left by a previous process with the same pid
+_process_started_at = time.time()
+
+
+def temp_path_for(save_file_path: str, upload_id: str, host: Optional[str] = None, pid: Optional[int] = None) -> str:
+    """Return the temp path an upload is written to before it is renamed.
+
+    The host name and pid are embedded so that files left by a crash can be told apart.
+
+    Args:
+        save_file_path (str): Final path.
+        upload_id (str): Id of the upload.
+        host (Optional[str]): Host name of the writer. Defaults to this host.
+        pid (Optional[int]): Pid of the writer. Defaults to this process.
+
+    """
+    dir_path, filename = os.path.split(save_file_path)
+    host = (host or socket.gethostname()).replace('.', '_')
+    pid = os.getpid() if pid is None else pid
+    return os.path.join(dir_path, f'.{filename}.{host}.{pid}.{upload_id}{TEMP_SUFFIX}')
+
+
+def _is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _is_writer_gone(pid: int, mtime: float) -> bool:
+    if pid == os.getpid():
+        return mtime < _process_started_at
+    return not _is_process_alive(pid)
+
+
+def write_durably(temp_path: str, save_file_path: str, content: bytes):
+    """Write content to the temp path, fsync it and move it to the final path.
+
+    Args:
+        temp_path (str): Path to write to first. Must be in the same directory as save_file_path.
+        save_file_path (str): Final path.
+        content (bytes): File content.
+
+    Raises:
+        FileExistsError: If save_file_path already exists.
+
+    """
+    dir_path = os.path.dirname(save_file_path)
+    os.makedirs(dir_path, exist_ok=True)
+    try:
+        with open(temp_path, 'xb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            # Unlike rename, link never overwrites a file uploaded concurrently with the same name
+            os.link(temp_path, save_file_path)
+        except FileExistsError:
+            raise
+        except OSError:
+            if os.path.exists(save_file_path):
+                raise FileExistsError(save_file_path)
+            os.rename(temp_path, save_file_path)
+    finally:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+    fsync_directory(dir_path)
+
+
+class UploadPipeline:
+    """Stage uploads through receiving, fsynced and registered states.
+
+    The state of every upload is kept as a small JSON file in status_dir so that any worker
+    (and any pod sharing the directory) can answer status requests.
+
+    Args:
+        status_dir (str): Directory to keep upload states in.
+        io_scheduler (IOScheduler): Scheduler to run writes on.
+        status_ttl (float): Seconds to keep states of finished uploads.
+        temp_grace_period (float): Seconds after which unfinished uploads of other hosts are treated as orphaned.
+        sweep_interval (float): Seconds between sweeps. 0 sweeps only once, at start.
+
+    """
+
+    def __init__(
+        self,
+        status_dir: str,
+        io_scheduler,
+        status_ttl: float = 86400,
+        temp_grace_period: float = 86400,
+        sweep_interval: float = 3600,
+    ):
+        self.status_dir = status_dir
+        self.io_scheduler = io_scheduler
+        self.status_ttl = status_ttl
+        self.temp_grace_period = temp_grace_period
+        self.sweep_interval = sweep_interval
+        self._task: Optional[asyncio.Future] = None
+
+    def _status_path(self, upload_id: str) -> str:
+        return os.path.join(self.status_dir, f'{upload_id}.json')
+
+    def get_status(self, upload_id: str) -> Optional[dict]:
+        """Return the state of an upload, or None if it is unknown."""
+        if not upload_id or os.sep in upload_id or upload_id.startswith('.'):
+            return None
+        try:
+            with open(self._status_path(upload_id), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _set_status(self, upload_id: str, status: dict) -> dict:
+        status = {**status, 'updated_at': datetime.utcnow().isoformat()}
+        os.makedirs(self.status_dir, exist_ok=True)
+        path = self._status_path(upload_id)
+        with open(f'{path}.{os.getpid()}.tmp', 'w') as f:
+            json.dump(status, f)
+        os.replace(f'{path}.{os.getpid()}.tmp', path)
+        return status
+
+    async def _update_status(self, upload_id: str, status: dict) -> dict:
+        return await self.io_scheduler.write(self.status_dir, self._set_status, upload_id, status)
+
+    async def create(self, save_file_path: str, database_id: str, record_id: str) -> str:
+        """Start tracking a new upload and return its id."""
+        upload_id = uuid.uuid4().hex
+        await self._update_status(upload_id, {
+            'upload_id': upload_id,
+            'state': RECEIVING,
+            'database_id': database_id,
+            'record_id': record_id,
+            'save_file_path': save_file_path,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+        })
+        return upload_id
+
+    async def run(
+        self,
+        upload_id: str,
+        content: bytes,
+        register: Callable,
+        on_registered: Optional[Callable] = None,
+        store: Optional[Callable] = None,
+        discard: Optional[Callable] = None,
+    ) -> Tuple[dict, Optional[object]]:
+        """Write the upload durably and register it in the metastore.
+
+        Args:
+            upload_id (str): Id returned by create().
+            content (bytes): File content.
+            register (Callable): Blocking function registering the file, returning (success, response)
+                like _update_metastore.
+            on_registered (Optional[Callable]): Blocking function run on the write pool once the file is
+                registered (e.g., to update caches and manifests). Its errors do not fail the upload.
+            store (Optional[Callable]): Blocking function saving (path, content) durably, raising FileExistsError
+                if the path is taken. Defaults to writing a temp file and renaming it.
+            discard (Optional[Callable]): Blocking function removing what store saved (path) if registering
+                fails. Defaults to removing the file.
+
+        Returns:
+            (Tuple[dict, Optional[object]]): The final state and the response of register, if it was called.
+
+        """
+        try:
+            return await self._run(upload_id, content, register, on_registered, store, discard)
+        except Exception as e:
+            # Nobody may be awaiting the upload (wait=false), so it must not stay unfinished
+            traceback.print_exc()
+            failure = {'state': FAILED, 'status_code': 500, 'detail': f'The upload failed: {e}'}
+            try:
+                status = await self.io_scheduler.read(self.status_dir, self.get_status, upload_id)
+                return await self._update_status(upload_id, {**(status or {}), **failure}), None
+            except Exception:
+                traceback.print_exc()
+                return failure, None
+
+    async def _run(
+        self,
+        upload_id: str,
+        content: bytes,
+        register: Callable,
+        on_registered: Optional[Callable],
+        store: Optional[Callable],
+        discard: Optional[Callable],
+    ) -> Tuple[dict, Optional[object]]:
+        status = await self.io_scheduler.read(self.status_dir, self.get_status, upload_id)
+        save_file_path = status['save_file_path']
+        if store is None:
+            def store(path, data):
+                write_durably(temp_path_for(path, upload_id), path, data)
+        try:
+            await self.io_scheduler.write(save_file_path, store, save_file_path, content)
+        except FileExistsError:
+            return await self._update_status(upload_id, {**status, 'state': FAILED, 'status_code': 409,
+                                                         'detail': f'The file with the same path ({save_file_path}) '
+                                                                   'already exists.'}), None
+        except OSError as e:
+            return await self._update_status(upload_id, {**status, 'state': FAILED, 'status_code': 500,
+                                                         'detail': f'Failed to save the file: {e}'}), None
+        status = await self._update_status(upload_id, {**status, 'state': FSYNCED})
+
+        loop = asyncio.get_event_loop()
+        fetch_success, fetch_res = await loop.run_in_executor(None, register)
+        if fetch_success and fetch_res is not None and fetch_res.status_code < 400:
+            try:
+                body = fetch_res.json()
+            except ValueError:
+                body = {}
+            if on_registered is not None:
+                try:
+                    await self.io_scheduler.write(save_file_path, on_registered)
+                except Exception as e:
+                    print(f'Failed to run post-registration of {save_file_path}: {e}')
+            return await self._update_status(upload_id, {**status, 'state': REGISTERED, 'file': body}), fetch_res
+
+        # Do not leave a file on disk which the metastore does not know about
+        await self.io_scheduler.write(save_file_path, discard or _remove_if_exists, save_file_path)
+        return await self._update_status(upload_id, {
+            **status,
+            'state': FAILED,
+            'status_code': fetch_res.status_code if fetch_res is not None else 500,
+            'detail': (f'Metadata updating process failed: {fetch_res.text}' if fetch_res is not None
+                       else 'Metadata updating process returned no response'),
+        }), fetch_res
+
+    def sweep(self):
+        """Clean up what crashed uploads left behind.
+
+        Only the states are searched: the temp file of an unfinished upload is derived from its
+        state. Uploads whose writer is gone are marked as failed and their temp files removed.
+        A file which was already saved is kept, since the upload may have been registered right
+        before the crash; it is logged for manual reconciliation instead. States of finished
+        uploads older than status_ttl are dropped.
+
+        """
+        host = socket.gethostname()
+        now = time.time()
+        try:
+            status_files = os.listdir(self.status_dir)
+        except FileNotFoundError:
+            return
+        for filename in status_files:
+            path = os.path.join(self.status_dir, filename)
+            if not filename.endswith('.json'):
+                # Left by _set_status if its process died before the rename
+                if filename.endswith('.tmp'):
+                    try:
+                        if now - os.path.getmtime(path) > self.status_ttl:
+                            os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                continue
+            status = self.get_status(filename[:-len('.json')])
+            if status is None:
+                continue
+            try:
+                mtime = os.path.getmtime(path)
+                if status['state'] in (RECEIVING, FSYNCED):
+                    if status.get('host') == host:
+                        orphaned = _is_writer_gone(status.get('pid', 0), mtime)
+                    else:
+                        orphaned = now - mtime > self.temp_grace_period
+                    if not orphaned:
+                        continue
+                    if status['state'] == RECEIVING:
+                        temp_path = temp_path_for(status['save_file_path'], status['upload_id'],
+                                                  host=status.get('host'), pid=status.get('pid', 0))
+                        if os.path.exists(temp_path):
+                            _remove_if_exists(temp_path)
+                            print(f'Removed orphaned upload: {temp_path}')
+                        detail = 'Interrupted by a restart'
+                    else:
+                        print(f'Upload {status["upload_id"]} was interrupted after saving {status["save_file_path"]}; '
+                              'check whether the metastore has it')
+                        detail = 'Interrupted by a restart after the file was saved. ' \
+                                 'The file was kept since it may have been registered.'
+                    self._set_status(status['upload_id'], {**status, 'state': FAILED, 'status_code': 500,
+                                                           'detail': detail})
+                elif now - mtime > self.status_ttl:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    async def _sweep_periodically(self):
+        while True:
+            try:
+                await self.io_scheduler.write(self.status_dir, self.sweep)
+            except Exception:
+                traceback.print_exc()
+            if self.sweep_interval <= 0:
+                return
+            await asyncio.sleep(self.sweep_interval)
+
+    def start(self):
+        """Start sweeping on the running event loop, right away and then every sweep_interval."""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._sweep_periodically())
+
+
+def _remove_if_exists(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
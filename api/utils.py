@@ -1,11 +1,15 @@
 from distutils.util import strtobool
+import hashlib
 import os.path
 import re
+from typing import Optional
 
 from dataware_tools_api_helper import get_forward_headers
 from dataware_tools_api_helper.permissions import CheckPermissionClient, DummyCheckPermissionClient
 import responder
 
+from api.paths import is_within
+
 
 def get_valid_filename(name):
     """
@@ -25,7 +29,8 @@ def get_valid_filename(name):
 
 def is_file_in_directory(file: str, directory: str) -> bool:
     """Return if the file is in the directory.
-    Taken from https://stackoverflow.com/q/3812849.
+
+    Paths are compared component by component after resolving symlinks.
 
     Args:
         file (str): Path to file to check.
@@ -35,43 +40,7 @@ def is_file_in_directory(file: str, directory: str) -> bool:
         (bool): Whether the file is in the specified directory.
 
     """
-    # make both absolute
-    directory = os.path.join(os.path.realpath(directory), '')
-    file = os.path.realpath(file)
-
-    # return true, if the common prefix of both is equal to directory
-    # e.g. /a/b/c/d.rst and directory is /a/b, the common prefix is /a/b
-    return os.path.commonprefix([file, directory]) == directory
-
-
-def is_valid_path(path: str, check_existence=False) -> bool:
-    """Checks if the path is valid.
-
-    Args:
-        path (str): File path
-        check_existence (bool): If True, this function also checks the existence of the file
-
-    Returns:
-        (bool): True if the path is valid, otherwise False
-
-    """
-    # Avoid Directory Traversal
-    abspath = os.path.abspath(os.path.realpath(path))
-    abspath_splitted = abspath.split(os.sep)
-    if len(abspath_splitted) < 2:
-        return False
-    else:
-        if abspath_splitted[1] in ['bin', 'boot', 'dev', 'etc', 'home', 'lib', 'lib64', 'media',
-                                   'proc', 'root', 'run', 'sbin', 'srv', 'sys', 'tmp', 'usr',
-                                   'var']:
-            return False
-
-    # Check the existence of the file
-    if check_existence:
-        if not os.path.isfile(path):
-            return False
-
-    return True
+    return is_within(os.path.realpath(file), os.path.realpath(directory))
 
 
 def get_jwt_key() -> str:
@@ -90,11 +59,47 @@ def save_jwt_key(key: str):
         f.write(key)
 
 
-def get_check_permission_client(req: responder.Request):
+class CachedCheckPermissionClient:
+    """Wrap a client for checking permission so that its decisions are cached.
+
+    Args:
+        client (CheckPermissionClient): Client to ask on a cache miss.
+        cache (SharedCache): Cache to keep decisions in.
+        auth_header (str): Authorization header the client was made for.
+        ttl (float): Seconds to cache decisions.
+
+    """
+
+    def __init__(self, client, cache, auth_header: str, ttl: float):
+        self.client = client
+        self.cache = cache
+        self.auth_hash = hashlib.sha256(auth_header.encode('utf-8')).hexdigest()
+        self.ttl = ttl
+
+    def check_permissions(self, action: str, database_id: Optional[str] = None):
+        key = f'permission:{self.auth_hash}:{action}:{database_id}'
+        allowed = self.cache.get(key)
+        if allowed is True:
+            return True
+        if allowed is False:
+            raise PermissionError(f'Cached: {action} is not permitted.')
+
+        try:
+            result = self.client.check_permissions(action, database_id)
+        except PermissionError:
+            self.cache.set(key, False, self.ttl)
+            raise
+        self.cache.set(key, True, self.ttl)
+        return result
+
+
+def get_check_permission_client(req: responder.Request, cache=None, ttl: float = 0):
     """Get a client for checking permission.
 
     Args:
         req (responder.Request): Authorization request header.
+        cache (Optional[SharedCache]): Cache for permission decisions.
+        ttl (float): Seconds to cache permission decisions. 0 disables caching.
     """
     if strtobool(os.environ.get('API_IGNORE_PERMISSION_CHECK', 'false')):
         return DummyCheckPermissionClient('')
@@ -104,4 +109,7 @@ def get_check_permission_client(req: responder.Request):
     except AttributeError:
         forward_header = req.headers
     auth_header = forward_header.get('authorization', '')
-    return CheckPermissionClient(auth_header)
+    client = CheckPermissionClient(auth_header)
+    if cache is not None and ttl > 0 and auth_header:
+        return CachedCheckPermissionClient(client, cache, auth_header, ttl)
+    return client
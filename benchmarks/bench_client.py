@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Compare the Python client with naive single-stream downloads.
+
+The API is served on a local port and every file under test/files is downloaded, first with
+a token request and a single GET per file through `requests`, then with the client (tokens
+issued in batches, pooled connections). With `--large-mb`, a synthetic file of that size is
+also downloaded in one stream and in parallel segments.
+
+Usage:
+    $ API_IGNORE_PERMISSION_CHECK=true python benchmarks/bench_client.py [--repeat 5] [--large-mb 256]
+
+"""
+
+import argparse
+import asyncio
+import glob
+import os
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('API_IGNORE_PERMISSION_CHECK', 'true')
+
+import requests  # noqa: E402
+import uvicorn  # noqa: E402
+
+from api import main  # noqa: E402
+from api.settings import UPLOADED_FILE_PATH_PREFIX  # noqa: E402
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FILES_DIR = os.path.join(ROOT_DIR, 'test', 'files')
+LARGE_FILE_DIR = os.path.join(UPLOADED_FILE_PATH_PREFIX, 'database_bench_client', 'record_bench')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'build_client', 'python'))
+from api_file_provider_client import FileProviderClient  # noqa: E402
+
+
+def _serve():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    server = uvicorn.Server(uvicorn.Config(main.api, log_level='warning', lifespan='off'))
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.serve(sockets=[sock]))
+
+    threading.Thread(target=serve, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, f'http://127.0.0.1:{sock.getsockname()[1]}'
+
+
+def _naive(base_url, files, output_dir):
+    for file_uuid, _ in files:
+        token = requests.post(f'{base_url}/download', json={'database_id': 'bench', 'file_uuid': file_uuid}).json()
+        res = requests.get(f'{base_url}/download/{token["token"]}', stream=True)
+        with open(os.path.join(output_dir, file_uuid), 'wb') as f:
+            for chunk in res.iter_content(256 * 1024):
+                f.write(chunk)
+
+
+def _measure(func, repeat):
+    durations = []
+    for _ in range(repeat):
+        output_dir = tempfile.mkdtemp()
+        try:
+            started = time.perf_counter()
+            func(output_dir)
+            durations.append(time.perf_counter() - started)
+        finally:
+            shutil.rmtree(output_dir)
+    return statistics.median(durations)
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--large-mb', type=int, default=0, help='Size of a synthetic large file in MiB')
+    args = parser.parse_args()
+
+    paths = {
+        f'uuid-{i}': os.path.realpath(path)
+        for i, path in enumerate(sorted(p for p in glob.glob(os.path.join(FILES_DIR, '**', '*'), recursive=True)
+                                        if os.path.isfile(p)))
+    }
+    if args.large_mb:
+        os.makedirs(LARGE_FILE_DIR, exist_ok=True)
+        paths['uuid-large'] = os.path.join(LARGE_FILE_DIR, 'large.bin')
+        with open(paths['uuid-large'], 'wb') as f:
+            for _ in range(args.large_mb):
+                f.write(os.urandom(1024 * 1024))
+    main._get_file_path = lambda req, database_id, uuid: paths.get(uuid)
+
+    server, base_url = _serve()
+    try:
+        client = FileProviderClient(base_url, concurrency=args.concurrency)
+        fixtures = [(uuid, path) for uuid, path in paths.items() if uuid != 'uuid-large']
+        total_mb = sum(os.path.getsize(path) for _, path in fixtures) / 1024 / 1024
+        naive = _measure(lambda output_dir: _naive(base_url, fixtures, output_dir), args.repeat)
+        sdk = _measure(lambda output_dir: client.download_files(
+            'bench', [(uuid, os.path.join(output_dir, uuid)) for uuid, _ in fixtures]), args.repeat)
+        print('fixtures ({} files, {:.1f}MiB) naive={:.1f}ms client={:.1f}ms'.format(
+            len(fixtures), total_mb, naive * 1000, sdk * 1000))
+
+        if args.large_mb:
+            large = [('uuid-large', paths['uuid-large'])]
+            naive = _measure(lambda output_dir: _naive(base_url, large, output_dir), args.repeat)
+            sdk = _measure(lambda output_dir: client.download_file(
+                'bench', 'uuid-large', os.path.join(output_dir, 'large.bin')), args.repeat)
+            print('large ({}MiB) naive={:.1f}MiB/s client={:.1f}MiB/s'.format(
+                args.large_mb, args.large_mb / naive, args.large_mb / sdk))
+    finally:
+        server.should_exit = True
+        if args.large_mb:
+            shutil.rmtree(os.path.dirname(LARGE_FILE_DIR), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    run()
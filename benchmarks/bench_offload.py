@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Compare streaming files in-process with handing them over to a proxy (X-Accel-Redirect).
+
+By default the time a worker spends per request is measured in-process for each mode. With
+`--api-url` and `--proxy-url` (e.g., the deployment of docker-compose.offload.yaml, with
+API_IGNORE_PERMISSION_CHECK=true), throughput over HTTP is measured as well: directly from the
+API streaming files, and through nginx sending them.
+
+Usage:
+    $ python benchmarks/bench_offload.py [--sizes 1,16,128] [--repeat 20]
+    $ docker-compose -f docker-compose.yaml -f docker-compose.offload.yaml exec api \
+        python benchmarks/bench_offload.py --api-url http://localhost:8080 --proxy-url http://proxy
+
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import statistics
+import time
+
+os.environ.setdefault('API_IGNORE_PERMISSION_CHECK', 'true')
+
+from api import main  # noqa: E402
+from api.offload import X_ACCEL_REDIRECT, Offloader  # noqa: E402
+from api.settings import UPLOADED_FILE_PATH_PREFIX  # noqa: E402
+
+BENCH_DIR = os.path.join(UPLOADED_FILE_PATH_PREFIX, 'database_bench_offload', 'record_bench')
+
+
+def _create_files(sizes_mb):
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    paths = []
+    for size_mb in sizes_mb:
+        path = os.path.join(BENCH_DIR, f'{size_mb}mb.bin')
+        if not os.path.exists(path) or os.path.getsize(path) != size_mb * 1024 * 1024:
+            with open(path, 'wb') as f:
+                for _ in range(size_mb):
+                    f.write(os.urandom(1024 * 1024))
+        paths.append(path)
+    return paths
+
+
+def _measure_in_process(path, repeat):
+    url = main.api.url_for(main.get_file)
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        r = main.api.requests.get(url=url, params={'path': path})
+        latencies.append(time.perf_counter() - started)
+        assert r.status_code == 200
+    return statistics.median(latencies) * 1000
+
+
+def _measure_http(base_url, path, repeat, concurrency):
+    import requests
+
+    def fetch(_):
+        r = requests.get(f'{base_url}/file', params={'path': path})
+        assert r.status_code == 200
+        return len(r.content)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        total = sum(executor.map(fetch, range(repeat)))
+    return total / (time.perf_counter() - started) / 1024 / 1024
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--sizes', default='1,16,128', help='Comma-separated file sizes in MiB')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--api-url', default=None, help='URL of the API streaming files itself')
+    parser.add_argument('--proxy-url', default=None, help='URL of the proxy in front of an offloading API')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated files')
+    args = parser.parse_args()
+
+    paths = _create_files([int(size) for size in args.sizes.split(',')])
+    try:
+        streaming = main.offloader
+        offloading = Offloader(X_ACCEL_REDIRECT, {UPLOADED_FILE_PATH_PREFIX: '/_offload/uploaded_data'})
+        for path in paths:
+            main.offloader = streaming
+            stream_ms = _measure_in_process(path, args.repeat)
+            main.offloader = offloading
+            offload_ms = _measure_in_process(path, args.repeat)
+            main.offloader = streaming
+            print('{:12s} in-process stream={:.2f}ms offload={:.2f}ms'.format(
+                os.path.basename(path), stream_ms, offload_ms))
+
+        for label, base_url in [('api', args.api_url), ('proxy', args.proxy_url)]:
+            if base_url is None:
+                continue
+            for path in paths:
+                throughput = _measure_http(base_url.rstrip('/'), path, args.repeat, args.concurrency)
+                print('{:12s} {:5s} {:.1f}MiB/s'.format(os.path.basename(path), label, throughput))
+    finally:
+        if not args.keep:
+            shutil.rmtree(os.path.dirname(BENCH_DIR), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Compare serving configurations of api/server.py.
+
+For each configuration, the server is started as a subprocess and measured with keep-alive
+HTTP/1.1 connections from several client processes: requests/s of `GET /healthz`, then the
+throughput of streaming a file with `GET /file`. HTTP/2 (hypercorn) mainly helps browsers
+multiplexing many Range requests on one connection, which this benchmark does not measure.
+
+Usage:
+    $ python benchmarks/bench_server.py [--workers 2] [--connections 64] [--duration 5] [--file-mb 64]
+    $ python benchmarks/bench_server.py --configs uvicorn-uvloop-httptools,hypercorn
+
+"""
+
+import argparse
+import asyncio
+from multiprocessing import Pool
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import quote
+
+import requests
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+from api.settings import UPLOADED_FILE_PATH_PREFIX  # noqa: E402
+
+BENCH_DIR = os.path.join(UPLOADED_FILE_PATH_PREFIX, 'database_bench_server', 'record_bench')
+
+CONFIGS = {
+    'uvicorn-asyncio-h11': {'SERVER_LOOP': 'asyncio', 'SERVER_HTTP': 'h11'},
+    'uvicorn-uvloop-httptools': {'SERVER_LOOP': 'uvloop', 'SERVER_HTTP': 'httptools'},
+    'uvicorn-reuseport': {'SERVER_LOOP': 'uvloop', 'SERVER_HTTP': 'httptools', 'SERVER_REUSE_PORT': 'true'},
+    'hypercorn': {'SERVER_IMPLEMENTATION': 'hypercorn', 'SERVER_LOOP': 'uvloop'},
+}
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _start_server(env, port, workers):
+    env = {
+        **os.environ,
+        **env,
+        'SERVER_HOST': '127.0.0.1',
+        'PORT': str(port),
+        'NUM_WORKERS': str(workers),
+        'API_IGNORE_PERMISSION_CHECK': 'true',
+        'PYTHONPATH': os.pathsep.join([ROOT_DIR, os.environ.get('PYTHONPATH', '')]),
+    }
+    process = subprocess.Popen([sys.executable, os.path.join('api', 'server.py')], cwd=ROOT_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    for _ in range(300):
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/healthz', timeout=1).status_code == 200:
+                # Let the other workers start as well
+                time.sleep(1)
+                return process
+        except requests.ConnectionError:
+            pass
+        if process.poll() is not None:
+            raise RuntimeError('The server exited')
+        time.sleep(0.1)
+    _stop_server(process)
+    raise RuntimeError('The server did not start')
+
+
+def _stop_server(process):
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        pass
+    # The JWT key daemon keeps the parent alive after the server has shut down
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+async def _read_response(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    headers = {}
+    for line in head.split(b'\r\n')[1:]:
+        if line:
+            name, _, value = line.partition(b':')
+            headers[name.strip().lower()] = value.strip()
+    if b'content-length' in headers:
+        length = int(headers[b'content-length'])
+        while length > 0:
+            length -= len(await reader.read(min(length, 1024 * 1024)))
+        return int(headers[b'content-length'])
+    size = 0
+    while True:
+        chunk_size = int((await reader.readuntil(b'\r\n')).strip(), 16)
+        await reader.readexactly(chunk_size + 2)
+        size += chunk_size
+        if chunk_size == 0:
+            return size
+
+
+async def _connection(port, request, deadline, counts):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        while time.monotonic() < deadline:
+            writer.write(request)
+            counts[1] += await _read_response(reader)
+            counts[0] += 1
+    finally:
+        writer.close()
+
+
+def _client_process(args):
+    port, path, connections, duration = args
+    request = f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n'.encode()
+    counts = [0, 0]
+
+    async def run():
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*[_connection(port, request, deadline, counts) for _ in range(connections)])
+
+    asyncio.new_event_loop().run_until_complete(run())
+    return counts
+
+
+def _load(port, path, connections, duration, processes):
+    with Pool(processes) as pool:
+        started = time.perf_counter()
+        results = pool.map(_client_process, [(port, path, max(1, connections // processes), duration)] * processes)
+        elapsed = time.perf_counter() - started
+    return sum(r[0] for r in results) / elapsed, sum(r[1] for r in results) / elapsed / 1024 / 1024
+
+
+def _create_file(size_mb):
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    path = os.path.join(BENCH_DIR, f'{size_mb}mb.bin')
+    if not os.path.exists(path) or os.path.getsize(path) != size_mb * 1024 * 1024:
+        with open(path, 'wb') as f:
+            for _ in range(size_mb):
+                f.write(os.urandom(1024 * 1024))
+    return path
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--configs', default=','.join(CONFIGS), help='Comma-separated configurations to measure')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--connections', type=int, default=64)
+    parser.add_argument('--stream-connections', type=int, default=8)
+    parser.add_argument('--client-processes', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--file-mb', type=int, default=64)
+    parser.add_argument('--keep', action='store_true', help='Keep the generated file')
+    args = parser.parse_args()
+
+    file_path = _create_file(args.file_mb)
+    try:
+        for name in args.configs.split(','):
+            port = _free_port()
+            try:
+                process = _start_server(CONFIGS[name], port, args.workers)
+            except RuntimeError as e:
+                print(f'{name:26s} skipped: {e}')
+                continue
+            try:
+                rps, _ = _load(port, '/healthz', args.connections, args.duration, args.client_processes)
+                _, throughput = _load(port, f'/file?path={quote(file_path)}', args.stream_connections,
+                                      args.duration, args.client_processes)
+            finally:
+                _stop_server(process)
+            print(f'{name:26s} healthz={rps:.0f}req/s stream={throughput:.1f}MiB/s')
+    finally:
+        if not args.keep:
+            shutil.rmtree(os.path.dirname(BENCH_DIR), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Compare latency of serving small files from memory maps and through aiofiles.
+
+Usage:
+    $ API_IGNORE_PERMISSION_CHECK=true python benchmarks/bench_small_files.py [--repeat 200]
+
+"""
+
+import argparse
+import glob
+import os
+import statistics
+import time
+
+os.environ.setdefault('API_IGNORE_PERMISSION_CHECK', 'true')
+
+from api import main  # noqa: E402
+
+FILES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test', 'files')
+
+
+def _measure(paths, repeat, headers=None):
+    url = main.api.url_for(main.get_file)
+    latencies = []
+    for _ in range(repeat):
+        for path in paths:
+            started = time.perf_counter()
+            r = main.api.requests.get(url=url, params={'path': path}, headers=headers)
+            latencies.append(time.perf_counter() - started)
+            assert r.status_code in (200, 206)
+    latencies.sort()
+    return {
+        'median_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    paths = sorted(
+        os.path.realpath(p) for p in glob.glob(os.path.join(FILES_DIR, '**', '*.json'), recursive=True)
+        + glob.glob(os.path.join(FILES_DIR, '**', '*.csv'), recursive=True)
+    )
+    max_file_size = main.mmap_cache.max_file_size
+    for label, headers in [('full', None), ('range', {'Range': 'bytes=10-200'})]:
+        for mode, size in [('aiofiles', 0), ('mmap', max_file_size or 1024 * 1024)]:
+            main.mmap_cache.clear()
+            main.mmap_cache.max_file_size = size
+            result = _measure(paths, args.repeat, headers=headers)
+            print('{:6s} {:9s} median={:.3f}ms p99={:.3f}ms'.format(
+                label, mode, result['median_ms'], result['p99_ms']))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Measure the import-to-ready time of the API server.
+
+A fresh interpreter imports `api.main` with `-X importtime`, runs the startup events and
+serves `/healthz` once. The slowest imports are listed to find what to defer next.
+
+Usage:
+    $ python benchmarks/startup_time.py [--repeat 5] [--top 20]
+
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHILD = '''
+import json
+import time
+started = time.perf_counter()
+from api import main
+imported = time.perf_counter()
+from starlette.testclient import TestClient
+with TestClient(main.api) as client:
+    assert client.get('/healthz').text == 'ok'
+ready = time.perf_counter()
+print(json.dumps({'import': imported - started, 'ready': ready - started}))
+'''
+
+
+def measure(importtime: bool = False) -> dict:
+    """Start a fresh interpreter and return its timings (and -X importtime output if asked)."""
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [ROOT_DIR, os.environ.get('PYTHONPATH')]))}
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', CHILD]
+    process = subprocess.run(command, cwd=ROOT_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True, check=True)
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    if importtime:
+        result['importtime'] = process.stderr
+    return result
+
+
+def slowest_imports(importtime: str, top: int):
+    """Return the top-level imports of api.main sorted by cumulative time (in microseconds)."""
+    imports = []
+    for line in importtime.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        imports.append((int(cumulative), name.rstrip()))
+    # Direct children of the top-level import are indented by exactly two spaces
+    direct = [(t, n.strip()) for t, n in imports if n.startswith('   ') and not n.startswith('    ')]
+    return sorted(direct or imports, reverse=True)[:top]
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+
+    results = [measure() for _ in range(args.repeat)]
+    print('import: median={:.3f}s'.format(statistics.median(r['import'] for r in results)))
+    print('ready:  median={:.3f}s'.format(statistics.median(r['ready'] for r in results)))
+    print('slowest imports (cumulative):')
+    for cumulative, name in slowest_imports(measure(importtime=True)['importtime'], args.top):
+        print('  {:8.1f}ms  {}'.format(cumulative / 1000, name))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,7 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Python client of api-file-provider."""
+
+from api_file_provider_client.client import DownloadError, FileProviderClient
+
+__all__ = ['DownloadError', 'FileProviderClient']
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Client of api-file-provider with parallel segmented and resumable downloads."""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import json
+import mmap
+import os
+import threading
+import time
+from typing import Callable, List, Optional, Sequence, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_SEGMENT_SIZE = 8 * 1024 * 1024
+DEFAULT_MIN_SEGMENTED_SIZE = 16 * 1024 * 1024
+CHUNK_SIZE = 256 * 1024
+PART_SUFFIX = '.part'
+STATE_SUFFIX = '.part.json'
+
+Token = Union[str, Callable[[], str]]
+
+
+class DownloadError(Exception):
+    """Error of a request to the API or of a downloaded file."""
+
+
+class _RetryableError(Exception):
+    pass
+
+
+class _TokenSource:
+    """Token shared by the segments of a download, re-issued when it expires."""
+
+    def __init__(self, token: Token):
+        self.issue = token if callable(token) else None
+        self.token = token() if callable(token) else token
+        self._lock = threading.Lock()
+
+    @property
+    def refreshable(self) -> bool:
+        return self.issue is not None
+
+    def refresh(self, expired: str):
+        with self._lock:
+            # Another segment may have refreshed it already
+            if self.token == expired:
+                self.token = self.issue()
+
+
+class FileProviderClient:
+    """Client of api-file-provider.
+
+    Large files are split into Range segments fetched in parallel over pooled connections and
+    written straight into a memory-mapped output file. Completed segments are recorded next to
+    the output, so that an interrupted download resumes where it stopped. Sizes are checked
+    for every file, and contents are checked against the ETag when it carries a digest.
+
+    Args:
+        base_url (str): URL of the API.
+        token (Optional[str]): Access token sent as a bearer token when issuing download tokens.
+        concurrency (int): Maximum number of parallel connections per download.
+        segment_size (int): Size of a Range segment in bytes.
+        min_segmented_size (int): Files smaller than this are fetched in a single request.
+        retries (int): Number of retries of a segment after connection errors.
+        timeout (float): Timeout of each request in seconds.
+        session (Optional[requests.Session]): Session to send requests with.
+
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        token: Optional[str] = None,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        segment_size: int = DEFAULT_SEGMENT_SIZE,
+        min_segmented_size: int = DEFAULT_MIN_SEGMENTED_SIZE,
+        retries: int = 3,
+        timeout: float = 60,
+        session: Optional[requests.Session] = None,
+    ):
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = max(1, concurrency)
+        self.segment_size = max(1, segment_size)
+        self.min_segmented_size = min_segmented_size
+        self.retries = retries
+        self.timeout = timeout
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.concurrency, pool_maxsize=self.concurrency)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        self.auth_headers = {'authorization': f'Bearer {token}'} if token else {}
+
+    def _url(self, path: str) -> str:
+        return f'{self.base_url}{path}'
+
+    @staticmethod
+    def _raise_for_status(res: requests.Response):
+        if res.status_code >= 400:
+            try:
+                detail = res.json().get('detail', res.text)
+            except ValueError:
+                detail = res.text
+            raise DownloadError(f'{res.status_code} {res.request.method} {res.url}: {detail}')
+
+    def issue_token(
+        self,
+        database_id: str,
+        file_uuid: str,
+        record_id: Optional[str] = None,
+        content_type: Optional[str] = None,
+        cacheable: bool = False,
+    ) -> str:
+        """Issue a token for downloading a file.
+
+        Args:
+            database_id (str): Database the file belongs to.
+            file_uuid (str): UUID of the file in the metastore.
+            record_id (Optional[str]): Record the file belongs to, to look up its content type.
+            content_type (Optional[str]): Content type to serve the file with.
+            cacheable (bool): Whether to issue a token shared caches can reuse.
+
+        Returns:
+            (str): The token.
+
+        """
+        body = {'database_id': database_id, 'file_uuid': file_uuid, 'cacheable': cacheable}
+        if record_id is not None:
+            body['record_id'] = record_id
+        if content_type is not None:
+            body['content_type'] = content_type
+        res = self.session.post(self._url('/download'), json=body, headers=self.auth_headers, timeout=self.timeout)
+        self._raise_for_status(res)
+        return res.json()['token']
+
+    def issue_tokens(
+        self,
+        files: Sequence[dict],
+        database_id: Optional[str] = None,
+        cacheable: bool = False,
+        batch_size: int = 100,
+    ) -> List[dict]:
+        """Issue tokens for many files with a request per batch.
+
+        Args:
+            files (Sequence[dict]): Params of each file (file_uuid, and database_id, record_id and
+                content_type if they differ between the files).
+            database_id (Optional[str]): Database of all the files.
+            cacheable (bool): Whether to issue tokens shared caches can reuse.
+            batch_size (int): Maximum number of files per request.
+
+        Returns:
+            (List[dict]): Result of each file in order, with `token` or `status_code` and `detail`.
+
+        """
+        common = {'cacheable': cacheable}
+        if database_id is not None:
+            common['database_id'] = database_id
+        results = []
+        for offset in range(0, len(files), batch_size):
+            body = {**common, 'files': list(files[offset:offset + batch_size])}
+            res = self.session.post(self._url('/download'), json=body, headers=self.auth_headers,
+                                    timeout=self.timeout)
+            self._raise_for_status(res)
+            results.extend(res.json()['results'])
+        return results
+
+    def _get(self, token: str, start: int, end: int) -> requests.Response:
+        return self.session.get(self._url(f'/download/{token}'), headers={'Range': f'bytes={start}-{end}'},
+                                stream=True, timeout=self.timeout)
+
+    def probe(self, token: str) -> Tuple[int, Optional[str]]:
+        """Return the size and the ETag of the file of a token."""
+        with self._get(token, 0, 0) as res:
+            self._raise_for_status(res)
+            return _size_and_etag(res)
+
+    def _segments(self, size: int) -> List[Tuple[int, int]]:
+        """Split a file into (start, end) ranges. The first one is always the first segment_size bytes."""
+        if size <= self.segment_size:
+            return [(0, size - 1)] if size else []
+        if size < self.min_segmented_size:
+            return [(0, self.segment_size - 1), (self.segment_size, size - 1)]
+        return [(start, min(start + self.segment_size, size) - 1) for start in range(0, size, self.segment_size)]
+
+    def _fetch_segment(self, token: _TokenSource, output: mmap.mmap, start: int, end: int, etag: Optional[str]):
+        last_error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(min(2 ** attempt * 0.1, 5))
+            current = token.token
+            try:
+                with self._get(current, start, end) as res:
+                    if res.status_code == 403 and token.refreshable and attempt < self.retries:
+                        # The token has probably expired
+                        token.refresh(current)
+                        raise _RetryableError(f'403 for bytes {start}-{end}')
+                    self._raise_for_status(res)
+                    if res.status_code != 206 and not (res.status_code == 200 and start == 0):
+                        raise DownloadError(f'Range requests are not supported: {res.status_code}')
+                    if etag is not None and res.headers.get('ETag', etag) != etag:
+                        raise DownloadError('The file has changed during the download')
+                    offset = _write_body(res, output, start, end)
+                    if offset != end + 1:
+                        raise _RetryableError(f'Got {offset - start} of {end + 1 - start} bytes')
+                    return
+            except (requests.ConnectionError, requests.Timeout, _RetryableError) as e:
+                last_error = e
+        raise DownloadError(f'Failed to download bytes {start}-{end}: {last_error}')
+
+    def download(self, token: Token, output_path: str, resume: bool = True, verify: bool = True) -> str:
+        """Download the file of a token.
+
+        The file is written to `{output_path}.part` and moved to output_path once it is complete
+        and verified. Progress is kept in `{output_path}.part.json` to resume from.
+
+        Args:
+            token (Token): Download token, or a function issuing one (called again if the token expires).
+            output_path (str): Path to save the file to.
+            resume (bool): Whether to resume an interrupted download of the same file.
+            verify (bool): Whether to check the content against the ETag when it carries a digest.
+
+        Returns:
+            (str): output_path
+
+        """
+        token = _TokenSource(token)
+        part_path = output_path + PART_SUFFIX
+        state_path = output_path + STATE_SUFFIX
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+
+        # The first segment comes with the size and the ETag, saving a round trip for small files
+        with self._get(token.token, 0, self.segment_size - 1) as first:
+            self._raise_for_status(first)
+            size, etag = _size_and_etag(first)
+            segments = self._segments(size) if first.status_code == 206 else [(0, size - 1)]
+            state = {'size': size, 'etag': etag, 'segments': [start for start, _ in segments], 'done': []}
+            saved = _load_state(state_path) if resume and etag is not None and os.path.exists(part_path) else None
+            if saved is not None and all(saved.get(k) == state[k] for k in ('size', 'etag', 'segments')):
+                state = saved
+            done = set(state['done'])
+
+            with open(part_path, 'r+b' if state is saved else 'w+b') as f:
+                f.truncate(size)
+                if not size:
+                    segments = []
+                output = mmap.mmap(f.fileno(), size) if size else None
+                try:
+                    if segments and 0 not in done:
+                        if _write_body(first, output, 0, segments[0][1]) == segments[0][1] + 1:
+                            done.add(0)
+                            _save_state(state_path, {**state, 'done': sorted(done)})
+                    first.close()
+
+                    pending = [(start, end) for start, end in segments if start not in done]
+                    if pending:
+                        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(pending))) as executor:
+                            futures = {
+                                executor.submit(self._fetch_segment, token, output, start, end, etag): start
+                                for start, end in pending
+                            }
+                            for future in as_completed(futures):
+                                future.result()
+                                done.add(futures[future])
+                                _save_state(state_path, {**state, 'done': sorted(done)})
+                    if output is not None:
+                        output.flush()
+                        if verify:
+                            _verify(output, etag)
+                finally:
+                    if output is not None:
+                        output.close()
+
+        if os.path.getsize(part_path) != size:
+            raise DownloadError(f'Size mismatch: {os.path.getsize(part_path)} != {size}')
+        os.replace(part_path, output_path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        return output_path
+
+    def download_file(self, database_id: str, file_uuid: str, output_path: str, **kwargs) -> str:
+        """Issue a token for a file and download it. See download() for the other args."""
+        return self.download(lambda: self.issue_token(database_id, file_uuid), output_path, **kwargs)
+
+    def download_files(
+        self,
+        database_id: str,
+        files: Sequence[Tuple[str, str]],
+        resume: bool = True,
+        verify: bool = True,
+    ) -> List[str]:
+        """Download many files, issuing their tokens in batches.
+
+        Up to `concurrency` files are downloaded at once, large ones with parallel segments.
+
+        Args:
+            database_id (str): Database the files belong to.
+            files (Sequence[Tuple[str, str]]): File UUID and output path of each file.
+            resume (bool): Whether to resume interrupted downloads.
+            verify (bool): Whether to check contents against ETags carrying digests.
+
+        Returns:
+            (List[str]): Output paths.
+
+        """
+        results = self.issue_tokens([{'file_uuid': file_uuid} for file_uuid, _ in files], database_id=database_id)
+        for (file_uuid, _), result in zip(files, results):
+            if 'token' not in result:
+                raise DownloadError(f'Failed to issue a token for {file_uuid}: {result.get("detail")}')
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [
+                executor.submit(self.download, result['token'], output_path, resume=resume, verify=verify)
+                for (_, output_path), result in zip(files, results)
+            ]
+            return [future.result() for future in futures]
+
+
+def _size_and_etag(res: requests.Response) -> Tuple[int, Optional[str]]:
+    if res.status_code == 206 and '/' in res.headers.get('Content-Range', ''):
+        size = int(res.headers['Content-Range'].rsplit('/', 1)[1])
+    else:
+        size = int(res.headers['Content-Length'])
+    return size, res.headers.get('ETag')
+
+
+def _write_body(res: requests.Response, output: mmap.mmap, start: int, end: int) -> int:
+    """Write the body of a response to output[start:end + 1] and return the offset reached."""
+    offset = start
+    for chunk in res.iter_content(CHUNK_SIZE):
+        length = min(len(chunk), end + 1 - offset)
+        output[offset:offset + length] = chunk[:length]
+        offset += length
+        if offset > end:
+            break
+    return offset
+
+
+def _load_state(path: str) -> Optional[dict]:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_state(path: str, state: dict):
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(f'{path}.tmp', path)
+
+
+def _verify(content: mmap.mmap, etag: Optional[str]):
+    """Check the content against an ETag carrying its sha256 digest (`"sha256:<hex>"`)."""
+    if not etag or etag.startswith('W/') or not etag.strip('"').startswith('sha256:'):
+        return
+    expected = etag.strip('"')[len('sha256:'):]
+    if hashlib.sha256(content).hexdigest() != expected:
+        raise DownloadError('Digest mismatch')
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Test code for admission control."""
+
+import asyncio
+
+from api.admission import TOKENS, UPLOADS, AdmissionController
+
+
+def test_sheds_over_limit():
+    controller = AdmissionController(kinds=(TOKENS, UPLOADS), min_limit=1, max_limit=2)
+    assert controller.try_acquire(TOKENS) is None
+    assert controller.try_acquire(TOKENS) is None
+    assert controller.try_acquire(TOKENS) >= 1
+    # Other kinds are limited separately
+    assert controller.try_acquire(UPLOADS) is None
+    controller.release(TOKENS)
+    assert controller.try_acquire(TOKENS) is None
+    assert controller.stats()['gates'][TOKENS] == {'limit': 2, 'in_flight': 2, 'admitted': 3, 'shed': 1}
+    assert controller.degraded
+
+
+def test_adjust_decreases_and_increases_limits():
+    controller = AdmissionController(kinds=(TOKENS,), min_limit=4, max_limit=100, target_lag=0.1)
+    controller.adjust(1.0)
+    assert controller.overloaded
+    assert controller.degraded
+    assert controller.gates[TOKENS].limit == 75
+    for _ in range(20):
+        controller.adjust(1.0)
+    assert controller.gates[TOKENS].limit == 4
+
+    for _ in range(10):
+        controller.adjust(0.0)
+    assert not controller.overloaded
+    assert 4 < controller.gates[TOKENS].limit < 100
+    for _ in range(100):
+        controller.adjust(0.0)
+    assert controller.gates[TOKENS].limit == 100
+
+
+def test_upstream_latency_and_streams_overload():
+    controller = AdmissionController(kinds=(TOKENS,), target_upstream_latency=1.0)
+    for _ in range(20):
+        controller.record_upstream_latency(5.0)
+    controller.adjust(0.0)
+    assert controller.overloaded
+    assert controller.retry_after() == 10
+
+    streams = [0]
+    controller = AdmissionController(kinds=(TOKENS,), max_streams=10, streams=lambda: streams[0])
+    controller.adjust(0.0)
+    assert not controller.overloaded
+    streams[0] = 11
+    controller.adjust(0.0)
+    assert controller.overloaded
+
+
+def test_upstream_latency_decays_with_time():
+    controller = AdmissionController(kinds=(TOKENS,), target_upstream_latency=1.0, upstream_half_life=10.0)
+    now = 1000.0
+    for _ in range(20):
+        controller.record_upstream_latency(5.0, now=now)
+    controller.adjust(0.0, now=now)
+    assert controller.overloaded
+
+    # No new samples come in while requests are shed, yet the worker recovers
+    controller.adjust(0.0, now=now + 10.0)
+    assert 2.4 < controller.upstream_latency < 2.5
+    controller.adjust(0.0, now=now + 30.0)
+    assert not controller.overloaded
+
+    # New samples start from the decayed average
+    controller.record_upstream_latency(5.0, now=now + 30.0)
+    assert 1.4 < controller.upstream_latency < 1.6
+
+
+def test_hold_keeps_a_slot():
+    controller = AdmissionController(kinds=(UPLOADS,), min_limit=1, max_limit=1)
+    assert controller.try_acquire(UPLOADS) is None
+    controller.hold(UPLOADS)
+    controller.release(UPLOADS)
+    assert controller.try_acquire(UPLOADS) is not None
+    controller.release(UPLOADS)
+    assert controller.try_acquire(UPLOADS) is None
+
+
+def test_retry_after_is_bounded():
+    controller = AdmissionController(kinds=(TOKENS,))
+    assert controller.retry_after() == 1
+    controller.lag = 100.0
+    assert controller.retry_after() == 30
+
+
+def test_measures_lag():
+    controller = AdmissionController(kinds=(TOKENS,), interval=0.01, degraded_period=0.0)
+
+    async def run():
+        controller.start()
+        await asyncio.sleep(0.05)
+        controller._task.cancel()
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert 0.0 <= controller.lag < 0.1
+    assert not controller.degraded
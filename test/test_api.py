@@ -5,12 +5,17 @@
 import json
 import os
 import shutil
+import time
 
 import pytest
 import requests
 
-from api import main
-from api.settings import META_STORE_SERVICE, UPLOADED_FILE_PATH_PREFIX
+from api import main, manifest
+from api.admission import TOKENS, UPLOADS, AdmissionController
+from api.journal import parse_records
+from api.offload import X_ACCEL_REDIRECT, Offloader
+from api.packs import LOCK_NAME, PackStore
+from api.settings import MANIFEST_DIR, META_STORE_SERVICE, PACK_DIR, UPLOADED_FILE_PATH_PREFIX
 
 API_TOKEN = os.environ.get('API_TOKEN', None)
 skip_if_token_unset = pytest.mark.skipif(
@@ -51,6 +56,12 @@ def delete_database_directory(database_id: str):
     )
     if os.path.exists(directory_for_database):
         shutil.rmtree(directory_for_database)
+    manifests_for_database = os.path.join(MANIFEST_DIR, f'database_{database_id}')
+    if os.path.exists(manifests_for_database):
+        shutil.rmtree(manifests_for_database)
+    packs_for_database = os.path.join(PACK_DIR, f'database_{database_id}')
+    if os.path.exists(packs_for_database):
+        shutil.rmtree(packs_for_database)
 
 
 def test_healthz(api):
@@ -58,6 +69,27 @@ def test_healthz(api):
     assert r.text == 'ok'
 
 
+def test_healthz_degraded(api, monkeypatch):
+    monkeypatch.setattr(main, 'admission_controller', AdmissionController(degraded_period=60))
+    main.admission_controller.adjust(10.0)
+    r = api.requests.get(url=api.url_for(main.healthz))
+    assert r.status_code == 503
+    assert r.text == 'degraded'
+
+
+def test_schema(api):
+    r = api.requests.get(url=api.url_for(main.schema))
+    assert r.status_code == 200
+    assert r.headers['Content-Type'] == 'application/x-yaml'
+    assert 'API for downloading files' in r.text
+
+
+def test_docs(api):
+    r = api.requests.get(url=api.url_for(main.docs))
+    assert r.status_code == 200
+    assert '/schema.yml' in r.text
+
+
 def test_index(api):
     r = api.requests.get(url=api.url_for(main.index))
     data = json.loads(r.text)
@@ -83,6 +115,21 @@ def test_file_get_200(api, file_path, content_type):
         assert r.content == f.read()
 
 
+def test_file_get_404_once_deleted_behind_the_cache(api):
+    database_id = 'database_for_testing_stale_paths'
+    file_path = os.path.join(UPLOADED_FILE_PATH_PREFIX, f'database_{database_id}', 'record', 'a.txt')
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'wb') as f:
+        f.write(b'a')
+    r = api.requests.get(url=api.url_for(main.get_file), params={'path': file_path})
+    assert r.status_code == 200
+
+    # Deleted by another worker, while its resolution is still cached in this one
+    delete_database_directory(database_id)
+    r = api.requests.get(url=api.url_for(main.get_file), params={'path': file_path})
+    assert r.status_code == 404
+
+
 @pytest.mark.parametrize("file_path, content_type", file_pathes)
 def test_file_get_with_range_206(api, file_path, content_type):
     params = {'path': file_path}
@@ -112,6 +159,30 @@ def test_file_get_with_range_206_2(api, file_path, content_type):
     assert int(r.headers.get('content-length')) == len(r.content)
 
 
+@pytest.mark.parametrize("file_path, content_type", file_pathes)
+def test_file_get_without_mmap(api, file_path, content_type, monkeypatch):
+    monkeypatch.setattr(main.mmap_cache, 'max_file_size', 0)
+    params = {'path': file_path}
+    r = api.requests.get(url=api.url_for(main.get_file), params=params)
+    assert r.status_code == 200
+    with open(file_path, 'rb') as f:
+        assert r.content == f.read()
+
+    headers = {'Range': 'bytes=10-8999'}
+    r = api.requests.get(url=api.url_for(main.get_file), params=params, headers=headers)
+    assert r.status_code == 206
+    with open(file_path, 'rb') as f:
+        assert r.content == f.read()[10:9000]
+
+
+def test_metrics(api):
+    r = api.requests.get(url=api.url_for(main.metrics))
+    assert r.status_code == 200
+    data = json.loads(r.text)
+    assert 'pools' in data['io'].keys()
+    assert 'mounts' in data['io'].keys()
+
+
 def test_file_get_404(api):
     r = api.requests.get(url=api.url_for(main.get_file),
                          params={'path': 'a-file-that-does-not-exist'})
@@ -237,6 +308,128 @@ def test_upload_201_metadata_updated_properly(api, setup_metastore_data):
     assert data['path'] == save_file_path
 
 
+class _MetastoreResponse:
+    status_code = 200
+    text = '{"uuid": "uuid-for-testing"}'
+
+    def json(self):
+        return json.loads(self.text)
+
+
+@pytest.mark.parametrize("wait", ['true', 'false'])
+def test_upload_registers_after_file_is_saved(api, monkeypatch, wait):
+    database_id = 'database_for_testing_upload_pipeline'
+    registered_files = []
+    uploads_in_flight = []
+
+    def update_metastore(req, database_id, record_id, save_file_path, file_metadata):
+        # The file must be completely written before it is registered
+        with open(save_file_path, 'rb') as f:
+            registered_files.append(f.read())
+        uploads_in_flight.append(main.admission_controller.gates[main.UPLOADS].in_flight)
+        return (True, _MetastoreResponse())
+
+    monkeypatch.setattr(main, '_update_metastore', update_metastore)
+    file_path = 'test/files/text.txt'
+    files = {'file': ('text.txt', open(file_path, 'rb'), 'anything')}
+    params = {'record_id': 'record', 'database_id': database_id, 'wait': wait}
+    r = api.requests.post(url=api.url_for(main.Upload), files=files, params=params)
+    data = json.loads(r.text)
+    assert r.status_code == (201 if wait == 'true' else 202)
+    assert 'upload_id' in data.keys()
+
+    # Follow the upload until it is finished
+    for _ in range(100):
+        r = api.requests.get(url=api.url_for(main.UploadStatus, upload_id=data['upload_id']))
+        assert r.status_code == 200
+        status = json.loads(r.text)
+        if status['state'] in ['registered', 'failed']:
+            break
+        time.sleep(0.05)
+    assert status['save_file_path'] == data['save_file_path']
+    assert status['state'] == 'registered'
+    assert status['file']['uuid'] == 'uuid-for-testing'
+    with open(file_path, 'rb') as f:
+        assert registered_files == [f.read()]
+    # The upload is admitted until it is finished, even after the response with wait=false
+    assert uploads_in_flight == [1]
+    # The slot is released once the pipeline task is done, which may be right after its last state is saved
+    for _ in range(100):
+        if main.admission_controller.gates[main.UPLOADS].in_flight == 0:
+            break
+        time.sleep(0.01)
+    assert main.admission_controller.gates[main.UPLOADS].in_flight == 0
+
+    # The file is listed once it is registered
+    r = api.requests.get(url=api.url_for(main.RecordFiles), params={'database_id': database_id, 'record_id': 'record'})
+    assert r.status_code == 200
+    listing = json.loads(r.text)
+    assert [entry['path'] for entry in listing['files']] == [data['save_file_path']]
+    assert listing['files'][0]['size'] == os.path.getsize(file_path)
+    assert listing['files'][0]['digest'].startswith('sha256:')
+
+    # Detele uploaded files
+    delete_database_directory(database_id)
+
+
+def test_upload_packed_file(api, monkeypatch):
+    database_id = 'database_for_testing_packs'
+    delete_database_directory(database_id)
+    monkeypatch.setattr(main, 'pack_store', PackStore(UPLOADED_FILE_PATH_PREFIX, PACK_DIR, max_file_size=1024 * 1024,
+                                                      compact_min_bytes=0))
+    monkeypatch.setattr(main, '_update_metastore', lambda *args: (True, _MetastoreResponse()))
+    file_path = 'test/files/text.txt'
+    with open(file_path, 'rb') as f:
+        content = f.read()
+    files = {'file': ('text.txt', content, 'text/plain')}
+    params = {'record_id': 'record', 'database_id': database_id}
+    r = api.requests.post(url=api.url_for(main.Upload), files=files, params=params)
+    assert r.status_code == 201
+    save_file_path = json.loads(r.text)['save_file_path']
+    assert not os.path.exists(save_file_path)
+    assert main.pack_store.lookup(save_file_path).size == len(content)
+    r = api.requests.post(url=api.url_for(main.Upload), files=files, params=params)
+    assert r.status_code == 409
+
+    # Packed files are served as ranges of the pack
+    r = api.requests.get(url=api.url_for(main.get_file), params={'path': save_file_path})
+    assert r.status_code == 200
+    assert r.content == content
+    r = api.requests.get(url=api.url_for(main.get_file), params={'path': save_file_path},
+                         headers={'Range': 'bytes=1-3'})
+    assert r.status_code == 206
+    assert r.content == content[1:4]
+
+    monkeypatch.setattr(main, '_get_file_path', lambda req, database_id, uuid: save_file_path)
+    body = {'database_id': database_id, 'file_uuid': 'uuid-for-testing', 'cacheable': True}
+    token = json.loads(api.requests.post(url=api.url_for(main.Downloads), json=body).text)['token']
+    r = api.requests.get(url=api.url_for(main.Download, token=token))
+    assert r.status_code == 200
+    assert r.content == content
+    assert r.headers['ETag'].startswith('"sha256:')
+
+    r = api.requests.get(url=api.url_for(main.RecordFiles), params=params)
+    assert [entry['size'] for entry in json.loads(r.text)['files']] == [len(content)]
+    r = api.requests.post(url=api.url_for(main.RebuildRecordFiles), json=params)
+    assert [entry['digest'] for entry in json.loads(r.text)['files']][0].startswith('sha256:')
+
+    # Deleting the file lets the pack be compacted
+    r = api.requests.delete(url=api.url_for(main.DeleteFile), params={**params, 'file_uuid': 'uuid-for-testing'})
+    assert r.status_code == 200
+    r = api.requests.get(url=api.url_for(main.get_file), params={'path': save_file_path})
+    assert r.status_code == 404
+    main.pack_store.compact(os.path.dirname(save_file_path))
+    assert os.listdir(main.pack_store.pack_dir_for(os.path.dirname(save_file_path))) == [LOCK_NAME]
+
+    # Detele uploaded files
+    delete_database_directory(database_id)
+
+
+def test_upload_status_404(api):
+    r = api.requests.get(url=api.url_for(main.UploadStatus, upload_id='upload-id-that-does-not-exist'))
+    assert r.status_code == 404
+
+
 # TODO: Add 404 tests
 
 
@@ -290,6 +483,261 @@ def test_delete_file_404(api):
     assert r.status_code == 404
 
 
+def _create_uploaded_files(database_id, record_id, filenames):
+    record_path = os.path.join(UPLOADED_FILE_PATH_PREFIX, f'database_{database_id}', f'record_{record_id}')
+    os.makedirs(record_path, exist_ok=True)
+    paths = []
+    for filename in filenames:
+        paths.append(os.path.join(record_path, filename))
+        with open(paths[-1], 'w') as f:
+            f.write(filename)
+    return record_path, paths
+
+
+def test_bulk_delete_record_200(api):
+    database_id = 'database_for_testing_bulk_delete'
+    record_path, paths = _create_uploaded_files(database_id, 'record', [f'{i}.json' for i in range(20)])
+    r = api.requests.post(url=api.url_for(main.BulkDelete), json={'database_id': database_id, 'record_id': 'record'})
+    assert r.status_code == 200
+    data = json.loads(r.text)
+    assert sorted(result['path'] for result in data['results']) == sorted(paths)
+    assert all(result['status_code'] == 200 for result in data['results'])
+    assert data['removed_directories'] == [record_path]
+    assert not os.path.exists(record_path)
+
+    # Detele uploaded files
+    delete_database_directory(database_id)
+
+
+def test_bulk_delete_file_uuids(api, monkeypatch):
+    database_id = 'database_for_testing_bulk_delete'
+    record_path, paths = _create_uploaded_files(database_id, 'record', ['a.csv', 'b.csv'])
+    file_paths = {
+        'uuid-a': paths[0],
+        'uuid-outside': '/opt/app/test/files/text.txt',
+    }
+    monkeypatch.setattr(main, '_get_file_path', lambda req, database_id, uuid: file_paths.get(uuid, None))
+
+    body = {'database_id': database_id, 'file_uuids': ['uuid-a', 'uuid-outside', 'uuid-unknown']}
+    r = api.requests.post(url=api.url_for(main.BulkDelete), json=body)
+    assert r.status_code == 200
+    data = json.loads(r.text)
+    assert [result['status_code'] for result in data['results']] == [200, 403, 404]
+    assert [result['file_uuid'] for result in data['results']] == body['file_uuids']
+    assert not os.path.exists(paths[0])
+    assert os.path.exists(paths[1])
+    assert data['removed_directories'] == []
+
+    # Detele uploaded files
+    delete_database_directory(database_id)
+
+
+def test_list_record_files(api):
+    database_id = 'database_for_testing_list'
+    params = {'database_id': database_id, 'record_id': 'record'}
+    r = api.requests.get(url=api.url_for(main.RecordFiles), params=params)
+    assert r.status_code == 404
+
+    # Without a manifest, it is built from the directory
+    record_path, paths = _create_uploaded_files(database_id, 'record', ['b.csv', 'a.csv'])
+    r = api.requests.get(url=api.url_for(main.RecordFiles), params=params)
+    assert r.status_code == 200
+    data = json.loads(r.text)
+    assert [entry['path'] for entry in data['files']] == sorted(paths)
+    assert [entry['digest'] for entry in data['files']] == [None, None]
+    assert data['total_size'] == len('a.csv') + len('b.csv')
+
+    # Deleted files are removed from the manifest
+    r = api.requests.post(url=api.url_for(main.BulkDelete), json=params)
+    assert r.status_code == 200
+    r = api.requests.get(url=api.url_for(main.RecordFiles), params=params)
+    assert r.status_code == 404
+
+    # Files added behind the API's back are listed after a rebuild
+    record_path, paths = _create_uploaded_files(database_id, 'record', ['c.csv'])
+    r = api.requests.post(url=api.url_for(main.RebuildRecordFiles), json=params)
+    assert r.status_code == 200
+    data = json.loads(r.text)
+    assert [entry['name'] for entry in data['files']] == ['c.csv']
+    assert data['files'][0]['digest'].startswith('sha256:')
+
+    # Detele uploaded files
+    delete_database_directory(database_id)
+
+
+def test_list_record_files_400(api):
+    r = api.requests.get(url=api.url_for(main.RecordFiles), params={'database_id': 'database'})
+    assert r.status_code == 400
+    r = api.requests.post(url=api.url_for(main.RebuildRecordFiles), json={'record_id': 'record'})
+    assert r.status_code == 400
+
+
+def test_bulk_delete_400(api, monkeypatch):
+    url = api.url_for(main.BulkDelete)
+    r = api.requests.post(url=url, json={'database_id': 'database', 'record_id': 'a', 'file_uuids': ['a']})
+    assert r.status_code == 400
+    r = api.requests.post(url=url, json={'record_id': 'a'})
+    assert r.status_code == 400
+    monkeypatch.setattr(main, 'BULK_DELETE_MAX_FILES', 2)
+    r = api.requests.post(url=url, json={'database_id': 'database', 'file_uuids': ['a', 'b', 'c']})
+    assert r.status_code == 400
+
+
+def test_cacheable_download(api, monkeypatch):
+    file_path = '/opt/app/test/files/text.txt'
+    monkeypatch.setattr(main, '_get_file_path', lambda req, database_id, uuid: file_path)
+    body = {'database_id': 'database', 'file_uuid': 'uuid', 'cacheable': True}
+
+    # The same token is issued for the same file within a window
+    tokens = [json.loads(api.requests.post(url=api.url_for(main.Downloads), json=body).text)['token']
+              for _ in range(2)]
+    assert tokens[0] == tokens[1]
+
+    r = api.requests.get(url=api.url_for(main.Download, token=tokens[0]))
+    assert r.status_code == 200
+    assert r.headers['Cache-Control'].startswith('public, max-age=')
+    assert r.headers['ETag']
+    with open(file_path, 'rb') as f:
+        assert r.content == f.read()
+
+    # Caches can revalidate their copies
+    r = api.requests.get(url=api.url_for(main.Download, token=tokens[0]),
+                         headers={'If-None-Match': r.headers['ETag']})
+    assert r.status_code == 304
+    assert r.content == b''
+
+
+def test_issue_tokens_in_batch(api, monkeypatch):
+    file_path = '/opt/app/test/files/text.txt'
+    monkeypatch.setattr(main, '_get_file_path', lambda req, database_id, uuid: file_path if uuid == 'a' else None)
+    url = api.url_for(main.Downloads)
+    r = api.requests.post(url=url, json={'database_id': 'database', 'files': [{'file_uuid': 'a'}, {'file_uuid': 'b'}]})
+    assert r.status_code == 200
+    assert [result['status_code'] for result in json.loads(r.text)['results']] == [200, 404]
+
+    # Nothing is issued unless every item is valid
+    issued = []
+
+    async def issue_token(req, data):
+        issued.append(data)
+        return 200, {}
+
+    monkeypatch.setattr(main, '_issue_token', issue_token)
+    for files in [[{'file_uuid': 'a'}, 'b'], [{'file_uuid': 'a'}, {'record_id': 'b'}]]:
+        r = api.requests.post(url=url, json={'database_id': 'database', 'files': files})
+        assert r.status_code == 400
+    assert issued == []
+
+
+def test_download_etag_from_token(api, monkeypatch):
+    database_id = 'database_for_testing_etag'
+    record_path, paths = _create_uploaded_files(database_id, 'record', ['a.csv'])
+    monkeypatch.setattr(main, '_get_file_path', lambda req, database_id, uuid: paths[0])
+    body = {'database_id': database_id, 'file_uuid': 'uuid'}
+    token = json.loads(api.requests.post(url=api.url_for(main.Downloads), json=body).text)['token']
+
+    # The ETag comes from the token as long as the file is unchanged
+    lookups = []
+    get = main.manifest_store.get
+    monkeypatch.setattr(main.manifest_store, 'get', lambda path: lookups.append(path) or get(path))
+    r = api.requests.get(url=api.url_for(main.Download, token=token))
+    assert r.status_code == 200
+    etag = r.headers['ETag']
+    assert lookups == []
+
+    with open(paths[0], 'w') as f:
+        f.write('rewritten')
+    r = api.requests.get(url=api.url_for(main.Download, token=token))
+    assert r.status_code == 200
+    assert r.content == b'rewritten'
+    assert r.headers['ETag'] != etag
+    assert lookups == [paths[0]]
+
+    delete_database_directory(database_id)
+
+
+def test_issue_tokens_replays_manifest_once(api, monkeypatch):
+    database_id = 'database_for_testing_token_etags'
+    record_path, paths = _create_uploaded_files(database_id, 'record', [f'{i}.csv' for i in range(20)])
+    for path in paths:
+        main.manifest_store.add(path, digest=f'sha256:{os.path.basename(path)}')
+    monkeypatch.setattr(main, '_get_file_path', lambda req, database_id, uuid: os.path.join(record_path, uuid))
+
+    # The ETags of a batch come from the manifest of the record, replayed once rather than per token
+    replayed = []
+    monkeypatch.setattr(manifest, 'parse_records', lambda data, path='': replayed.append(path) or parse_records(data))
+    body = {'database_id': database_id, 'files': [{'file_uuid': os.path.basename(path)} for path in paths]}
+    r = api.requests.post(url=api.url_for(main.Downloads), json=body)
+    assert [result['status_code'] for result in json.loads(r.text)['results']] == [200] * len(paths)
+    assert len(replayed) == 1
+
+    delete_database_directory(database_id)
+
+
+def test_debug_endpoints(api):
+    r = api.requests.get(url=api.url_for(main.profile), params={'seconds': '0.05', 'interval': '0.001'})
+    assert r.status_code == 200
+    assert r.text.endswith('\n')
+
+    r = api.requests.get(url=api.url_for(main.profile), params={'seconds': '3600'})
+    assert r.status_code == 400
+
+    r = api.requests.get(url=api.url_for(main.tasks))
+    assert r.status_code == 200
+    assert isinstance(json.loads(r.text)['tasks'], list)
+
+    r = api.requests.get(url=api.url_for(main.Memory))
+    assert r.status_code == 409
+    r = api.requests.post(url=api.url_for(main.Memory), json={'action': 'start'})
+    assert json.loads(r.text) == {'tracing': True}
+    try:
+        r = api.requests.get(url=api.url_for(main.Memory), params={'limit': '3'})
+        assert r.status_code == 200
+        assert len(json.loads(r.text)['top']) <= 3
+    finally:
+        r = api.requests.post(url=api.url_for(main.Memory), json={'action': 'stop'})
+    assert json.loads(r.text) == {'tracing': False}
+
+
+def test_debug_endpoints_403(api, monkeypatch):
+    monkeypatch.setenv('API_IGNORE_PERMISSION_CHECK', 'false')
+    for r in [
+        api.requests.get(url=api.url_for(main.profile), params={'seconds': '0.05'}),
+        api.requests.get(url=api.url_for(main.tasks)),
+        api.requests.post(url=api.url_for(main.Memory), json={'action': 'start'}),
+    ]:
+        assert r.status_code == 403
+    assert not main.memory_tracer.tracing
+
+
+def test_requests_shed_when_overloaded(api, monkeypatch):
+    monkeypatch.setattr(main, 'admission_controller', AdmissionController(min_limit=1, max_limit=1))
+    main.admission_controller.gates[TOKENS].in_flight = 1
+    main.admission_controller.gates[UPLOADS].in_flight = 1
+    r = api.requests.post(url=api.url_for(main.Downloads), json={'database_id': 'database', 'file_uuid': 'uuid'})
+    assert r.status_code == 503
+    assert int(r.headers['Retry-After']) >= 1
+    r = api.requests.post(url=api.url_for(main.Upload), data={'database_id': 'database', 'record_id': 'record'})
+    assert r.status_code == 503
+
+    # Downloads of issued tokens are not affected
+    r = api.requests.get(url=api.url_for(main.get_file), params={'path': '/opt/app/test/files/text.txt'})
+    assert r.status_code == 200
+
+
+def test_file_get_offloaded(api, monkeypatch):
+    monkeypatch.setattr(main, 'offloader', Offloader(X_ACCEL_REDIRECT, {'/opt/app/test': '/_offload/test'}))
+    r = api.requests.get(url=api.url_for(main.get_file), params={'path': '/opt/app/test/files/text.txt'},
+                         headers={'Range': 'bytes=0-1'})
+    assert r.status_code == 200
+    assert r.headers['X-Accel-Redirect'] == '/_offload/test/files/text.txt'
+    assert r.content == b''
+
+    # Files outside the mapped roots are streamed in-process
+    r = api.requests.get(url=api.url_for(main.get_file), params={'path': '/opt/app/test/../README.md'})
+    assert 'X-Accel-Redirect' not in r.headers
+
+
 def test_download_403(api):
     token = 'eyJ0eXAiOiJKV1EiLCJhbGciOiJIUzI1NiJ9.aaaa.aaaa'
 
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Test code for bandwidth shaping."""
+
+import json
+import os
+
+from api.bandwidth import BandwidthShaper, TokenBucket
+
+
+def test_token_bucket_waits_off_debt():
+    bucket = TokenBucket(1000)
+    now = bucket.updated
+    assert bucket.reserve(1000, now=now) == 0
+    assert bucket.reserve(500, now=now) == 0.5
+    assert bucket.reserve(500, now=now) == 1.0
+    # Tokens refill with time
+    assert bucket.reserve(500, now=now + 2.0) == 0
+
+
+def test_token_bucket_unlimited():
+    bucket = TokenBucket(0)
+    assert bucket.reserve(10 ** 9) == 0
+
+
+def test_shaper_keys_and_release():
+    shaper = BandwidthShaper(global_limit=1000, per_user_limit=100)
+    stream_1 = shaper.open_stream('user-a', 'database-a')
+    stream_2 = shaper.open_stream('user-a', None)
+    assert stream_1.keys == (('user', 'user-a'), ('database', 'database-a'), ('global',))
+    assert shaper.stats()['active_streams'] == 2
+    assert shaper.stats()['active_users'] == 1
+    assert shaper.buckets[('user', 'user-a')].rate == 100
+    assert shaper.buckets[('database', 'database-a')].rate == 0
+
+    stream_1.close()
+    stream_1.close()
+    assert ('database', 'database-a') not in shaper.buckets
+    stream_2.close()
+    assert shaper.stats()['active_streams'] == 0
+    assert ('user', 'user-a') not in shaper.buckets
+
+
+def test_shaper_keeps_idle_buckets_until_refilled():
+    shaper = BandwidthShaper(per_user_limit=100)
+    stream = shaper.open_stream('user-a', None)
+    bucket = shaper.buckets[('user', 'user-a')]
+    assert bucket.reserve(300, now=bucket.updated) == 2.0
+    stream.close()
+
+    # Reopening right away must not hand out a fresh burst
+    stream = shaper.open_stream('user-a', None)
+    assert shaper.buckets[('user', 'user-a')] is bucket
+    stream.close()
+    assert ('user', 'user-a') in shaper.idle
+
+    shaper.evict_idle(now=bucket.updated + 2.9)
+    assert ('user', 'user-a') in shaper.buckets
+    shaper.evict_idle(now=bucket.updated + 3.0)
+    assert ('user', 'user-a') not in shaper.buckets
+    assert not shaper.idle
+
+
+def test_shaper_reloads_config_file(tmp_path):
+    config_file = str(tmp_path / 'bandwidth.json')
+    shaper = BandwidthShaper(per_user_limit=100, config_file=config_file, reload_interval=0)
+    stream = shaper.open_stream('user-a', 'database-a')
+    assert shaper.buckets[('user', 'user-a')].rate == 100
+
+    with open(config_file, 'w') as f:
+        json.dump({'users': {'user-a': 5000}, 'per_database': 300}, f)
+    shaper.maybe_reload()
+    assert shaper.buckets[('user', 'user-a')].rate == 5000
+    assert shaper.buckets[('database', 'database-a')].rate == 300
+
+    os.remove(config_file)
+    shaper.maybe_reload()
+    assert shaper.buckets[('user', 'user-a')].rate == 100
+    stream.close()
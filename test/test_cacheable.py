@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Test code for cacheable download URLs."""
+
+import os
+
+from api.cacheable import bucketed_expiry, cache_headers, etag_for, matches_etag
+
+
+def test_bucketed_expiry():
+    assert bucketed_expiry(3600, now=7200) == bucketed_expiry(3600, now=10799) == 14400
+    assert bucketed_expiry(3600, now=10800) == 18000
+
+
+def test_etag(tmp_path):
+    path = tmp_path / 'a.csv'
+    path.write_text('a')
+    stat = os.stat(str(path))
+    assert etag_for(stat, 'sha256:abc') == '"sha256:abc"'
+    assert etag_for(stat).startswith('W/"')
+
+    assert matches_etag('"x", W/"sha256:abc"', '"sha256:abc"')
+    assert matches_etag('*', '"sha256:abc"')
+    assert not matches_etag('"x"', '"sha256:abc"')
+    assert not matches_etag(None, '"sha256:abc"')
+
+
+def test_cache_headers():
+    headers = cache_headers('"sha256:abc"', expires_at=1100, now=1000)
+    assert headers['Cache-Control'] == 'public, max-age=100, immutable'
+    assert headers['ETag'] == '"sha256:abc"'
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Test code for the Python client."""
+
+import asyncio
+import json
+import os
+import shutil
+import socket
+import sys
+import threading
+import time
+
+import pytest
+import uvicorn
+
+from api import main
+from api.settings import UPLOADED_FILE_PATH_PREFIX
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'build_client', 'python'))
+from api_file_provider_client import DownloadError, FileProviderClient  # noqa: E402
+
+DATABASE_ID = 'database_for_testing_client'
+
+
+@pytest.fixture
+def server_url():
+    """Run the API on a free port in a background thread."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    server = uvicorn.Server(uvicorn.Config(main.api, log_level='warning', lifespan='off'))
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.serve(sockets=[sock]))
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    for _ in range(100):
+        if server.started:
+            break
+        time.sleep(0.05)
+    yield f'http://127.0.0.1:{sock.getsockname()[1]}'
+    server.should_exit = True
+    thread.join(timeout=5)
+    sock.close()
+
+
+@pytest.fixture
+def uploaded_file(monkeypatch):
+    record_dir = os.path.join(UPLOADED_FILE_PATH_PREFIX, f'database_{DATABASE_ID}', 'record_a')
+    os.makedirs(record_dir, exist_ok=True)
+    path = os.path.join(record_dir, 'a.bin')
+    content = os.urandom(300 * 1024 + 7)
+    with open(path, 'wb') as f:
+        f.write(content)
+    monkeypatch.setattr(main, '_get_file_path', lambda req, database_id, uuid: path if uuid == 'uuid-a' else None)
+    yield path, content
+    shutil.rmtree(os.path.dirname(record_dir), ignore_errors=True)
+    shutil.rmtree(os.path.join(main.manifest_store.manifest_dir, f'database_{DATABASE_ID}'), ignore_errors=True)
+
+
+def _client(server_url, **kwargs):
+    return FileProviderClient(server_url, concurrency=4, segment_size=64 * 1024, min_segmented_size=0, **kwargs)
+
+
+def test_download_segmented(server_url, uploaded_file, tmp_path):
+    path, content = uploaded_file
+    output_path = str(tmp_path / 'out' / 'a.bin')
+    _client(server_url).download_file(DATABASE_ID, 'uuid-a', output_path)
+    with open(output_path, 'rb') as f:
+        assert f.read() == content
+    assert os.listdir(str(tmp_path / 'out')) == ['a.bin']
+
+
+def test_download_resumes(server_url, uploaded_file, tmp_path):
+    path, content = uploaded_file
+    client = _client(server_url)
+    token = client.issue_token(DATABASE_ID, 'uuid-a')
+    size, etag = client.probe(token)
+    assert size == len(content)
+
+    # Pretend that the first two segments were downloaded before an interruption
+    output_path = str(tmp_path / 'a.bin')
+    with open(output_path + '.part', 'wb') as f:
+        f.write(content[:128 * 1024])
+    with open(output_path + '.part.json', 'w') as f:
+        segments = list(range(0, size, 64 * 1024))
+        json.dump({'size': size, 'etag': etag, 'segments': segments, 'done': [0, 64 * 1024]}, f)
+
+    requested = []
+    get = client.session.get
+    client.session.get = lambda url, **kwargs: requested.append(kwargs['headers']['Range']) or get(url, **kwargs)
+    client.download(token, output_path)
+    with open(output_path, 'rb') as f:
+        assert f.read() == content
+    assert f'bytes={64 * 1024}-{128 * 1024 - 1}' not in requested
+    assert f'bytes={128 * 1024}-{192 * 1024 - 1}' in requested
+    assert not os.path.exists(output_path + '.part.json')
+
+
+def test_download_verifies_digest(server_url, uploaded_file, tmp_path):
+    path, content = uploaded_file
+    main.manifest_store.add(path, digest='sha256:' + '0' * 64)
+    with pytest.raises(DownloadError):
+        _client(server_url).download_file(DATABASE_ID, 'uuid-a', str(tmp_path / 'a.bin'))
+    assert not os.path.exists(str(tmp_path / 'a.bin'))
+
+
+def test_issue_tokens(server_url, uploaded_file):
+    results = _client(server_url).issue_tokens([{'file_uuid': 'uuid-a'}, {'file_uuid': 'uuid-unknown'}],
+                                               database_id=DATABASE_ID)
+    assert [result['status_code'] for result in results] == [200, 404]
+    assert 'token' in results[0]
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Test code for the I/O scheduler."""
+
+import asyncio
+import os
+
+import pytest
+
+from api.io_scheduler import BULK, INTERACTIVE, IOScheduler, PriorityLimiter, parse_mount_limits, read_mount_points
+
+
+def test_parse_mount_limits():
+    assert parse_mount_limits('') == {}
+    assert parse_mount_limits('/opt/uploaded_data=4, /mnt/nfs/=16') == {
+        '/opt/uploaded_data': 4,
+        '/mnt/nfs': 16,
+    }
+    with pytest.raises(ValueError):
+        parse_mount_limits('4')
+
+
+def test_mount_of_prefers_configured_roots():
+    scheduler = IOScheduler(1, 1, 2, mount_limits={'/opt/uploaded_data': 4})
+    assert scheduler.mount_of('/opt/uploaded_data/database_a/record_b/x.csv') == '/opt/uploaded_data'
+    assert scheduler.mount_of('/opt/uploaded_data_2/x.csv') != '/opt/uploaded_data'
+    assert os.path.ismount(scheduler.mount_of('/opt/uploaded_data_2/x.csv'))
+
+
+def test_priority_limiter_admits_interactive_first():
+    async def scenario():
+        limiter = PriorityLimiter(1)
+        order = []
+        await limiter.acquire(BULK)
+
+        async def worker(name, priority):
+            await limiter.acquire(priority)
+            order.append(name)
+            limiter.release()
+
+        tasks = [
+            asyncio.ensure_future(worker('bulk', BULK)),
+            asyncio.ensure_future(worker('interactive', INTERACTIVE)),
+        ]
+        await asyncio.sleep(0)
+        assert limiter.queued(BULK) == 1
+        assert limiter.queued(INTERACTIVE) == 1
+        limiter.release()
+        await asyncio.gather(*tasks)
+        return order, limiter.active
+
+    order, active = asyncio.get_event_loop().run_until_complete(scenario())
+    assert order == ['interactive', 'bulk']
+    assert active == 0
+
+
+def test_scheduler_runs_on_dedicated_pools(tmp_path):
+    path = str(tmp_path / 'a.txt')
+    scheduler = IOScheduler(2, 1, 2)
+
+    def write(path, content):
+        with open(path, 'wb') as f:
+            f.write(content)
+
+    async def scenario():
+        await scheduler.write(path, write, path, b'abc')
+        return await scheduler.read(path, os.path.getsize, path, priority=INTERACTIVE)
+
+    assert asyncio.get_event_loop().run_until_complete(scenario()) == 3
+    stats = scheduler.stats()
+    assert stats['pools']['read']['workers'] == 2
+    assert all(mount['active'] == 0 for mount in stats['mounts'].values())
+
+
+def test_read_mount_points(tmp_path):
+    mountinfo = tmp_path / 'mountinfo'
+    mountinfo.write_text('22 1 8:1 / / rw - ext4 /dev/sda1 rw\n'
+                         '30 22 0:52 / /mnt/my\\040data rw - nfs4 server:/data rw\n')
+    assert read_mount_points(str(mountinfo)) == {os.makedev(8, 1): '/', os.makedev(0, 52): '/mnt/my data'}
+    assert read_mount_points(str(tmp_path / 'missing')) == {}
+
+
+def test_mount_of_follows_symlinks_once_stat(tmp_path):
+    scheduler = IOScheduler(1, 1, 2)
+    target = tmp_path / 'target'
+    target.mkdir()
+    (tmp_path / 'link').symlink_to(target)
+    path = str(tmp_path / 'link' / 'a.txt')
+    scheduler.mount_points = {os.stat(str(target)).st_dev: '/mnt/target'}
+
+    assert scheduler.mount_of(path) != '/mnt/target'
+    asyncio.get_event_loop().run_until_complete(scheduler.read(path, os.path.exists, path))
+    assert scheduler.mount_of(path) == '/mnt/target'
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Test code for the append-only logs and their locks."""
+
+import threading
+import time
+
+from api.journal import FileLock, append_records, parse_records
+
+
+def test_append_truncates_torn_line(tmp_path):
+    log_path = str(tmp_path / 'index.log')
+    append_records(log_path, [{'a': 1}])
+    with open(log_path, 'ab') as f:
+        f.write(b'{"b": ')
+    size = append_records(log_path, [{'c': 3}])
+
+    with open(log_path, 'rb') as f:
+        data = f.read()
+    assert len(data) == size
+    records, complete = parse_records(data)
+    assert list(records) == [{'a': 1}, {'c': 3}]
+    assert complete == size
+
+
+def test_parse_skips_undecodable_and_incomplete_lines():
+    records, complete = parse_records(b'{"a": 1}\n{"b": \n{"c": 3}\n{"d"')
+    assert list(records) == [{'a': 1}, {'c': 3}]
+    assert complete == len(b'{"a": 1}\n{"b": \n{"c": 3}\n')
+
+
+def test_file_lock_excludes_threads(tmp_path):
+    locks = FileLock()
+    lock_path = str(tmp_path / 'a' / 'lock')
+    holders = []
+    seen = []
+
+    def hold():
+        with locks.hold(lock_path):
+            holders.append(1)
+            seen.append(len(holders))
+            time.sleep(0.01)
+            holders.pop()
+
+    threads = [threading.Thread(target=hold) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert seen == [1] * 8
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Test code for the manifests of record directories."""
+
+import os
+
+import pytest
+
+from api.journal import parse_records
+from api.manifest import ManifestStore, content_digest, file_digest
+
+
+def _write(path, content: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def test_add_and_remove(tmp_path):
+    store = ManifestStore(str(tmp_path), str(tmp_path / '.manifests'))
+    record_dir = str(tmp_path / 'database_a' / 'record_a')
+    assert store.list(record_dir) is None
+
+    for name in ['b.csv', 'a.csv']:
+        _write(os.path.join(record_dir, name), name.encode())
+        store.add(os.path.join(record_dir, name), digest=content_digest(name.encode()), content_type='text/csv')
+    entries = store.list(record_dir)
+    assert [entry['name'] for entry in entries] == ['a.csv', 'b.csv']
+    assert entries[0]['size'] == len('a.csv')
+    assert entries[0]['content_type'] == 'text/csv'
+    assert entries[0]['digest'] == file_digest(os.path.join(record_dir, 'a.csv'))
+
+    # The manifest is kept out of the record directory
+    assert sorted(os.listdir(record_dir)) == ['a.csv', 'b.csv']
+
+    store.remove(record_dir, ['a.csv', 'unknown.csv'])
+    assert [entry['name'] for entry in store.list(record_dir)] == ['b.csv']
+    store.remove(record_dir, ['b.csv'])
+    assert store.list(record_dir) is None
+
+
+def test_manifest_log_is_compacted(tmp_path):
+    store = ManifestStore(str(tmp_path), str(tmp_path / '.manifests'), compact_min_bytes=1024)
+    record_dir = str(tmp_path / 'database_a' / 'record_a')
+    manifest_path = store.manifest_path(record_dir)
+    sizes = []
+    for i in range(100):
+        _write(os.path.join(record_dir, 'a.csv'), b'%d' % i)
+        store.add(os.path.join(record_dir, 'a.csv'))
+        sizes.append(os.path.getsize(manifest_path))
+    # Replaced entries are dropped once the log has doubled
+    assert max(sizes) <= 2 * 1024 + 200
+    assert min(sizes[10:]) < 200
+    assert [entry['size'] for entry in store.list(record_dir)] == [2]
+
+    # A line torn by a crash is skipped, and dropped by the next append
+    with open(manifest_path, 'ab') as f:
+        f.write(b'{"name": "b.csv", "si')
+    assert [entry['name'] for entry in store.list(record_dir)] == ['a.csv']
+    _write(os.path.join(record_dir, 'c.csv'), b'c')
+    store.add(os.path.join(record_dir, 'c.csv'))
+    assert [entry['name'] for entry in store.list(record_dir)] == ['a.csv', 'c.csv']
+
+
+def test_rebuild_keeps_unchanged_entries(tmp_path):
+    store = ManifestStore(str(tmp_path), str(tmp_path / '.manifests'))
+    record_dir = str(tmp_path / 'database_a' / 'record_a')
+    _write(os.path.join(record_dir, 'a.json'), b'{}')
+    store.add(os.path.join(record_dir, 'a.json'), digest='sha256:known', content_type='text/plain')
+    _write(os.path.join(record_dir, 'b.bin'), b'\x00')
+    _write(os.path.join(record_dir, '.b.bin.host.1.abc.part'), b'')
+
+    entries = store.rebuild(record_dir, compute_digest=False)
+    assert [entry['name'] for entry in entries] == ['a.json', 'b.bin']
+    assert entries[0]['digest'] == 'sha256:known'
+    assert entries[0]['content_type'] == 'text/plain'
+    assert entries[1]['digest'] is None
+
+    entries = store.rebuild(record_dir)
+    assert entries[1]['digest'] == content_digest(b'\x00')
+    assert store.list(record_dir) == entries
+
+
+def test_manifest_path_outside_root(tmp_path):
+    store = ManifestStore(str(tmp_path / 'root'), str(tmp_path / '.manifests'))
+    with pytest.raises(ValueError):
+        store.manifest_path(str(tmp_path / 'other'))
+
+
+def test_manifest_is_followed_incrementally(tmp_path, monkeypatch):
+    store = ManifestStore(str(tmp_path), str(tmp_path / '.manifests'), compact_min_bytes=2048)
+    other = ManifestStore(str(tmp_path), str(tmp_path / '.manifests'), compact_min_bytes=2048)
+    record_dir = str(tmp_path / 'database_a' / 'record_a')
+    for i in range(10):
+        _write(os.path.join(record_dir, f'{i}.csv'), b'0')
+        store.add(os.path.join(record_dir, f'{i}.csv'))
+    assert other.get(os.path.join(record_dir, '0.csv'))['size'] == 1
+
+    # Only what was appended since is parsed
+    parsed = []
+    monkeypatch.setattr('api.manifest.parse_records', lambda data, path: parsed.append(data) or parse_records(data))
+    store.remove(record_dir, ['0.csv'])
+    assert other.get(os.path.join(record_dir, '0.csv')) is None
+    assert other.get(os.path.join(record_dir, '1.csv'))['size'] == 1
+    assert parsed == [b'{"name": "0.csv", "deleted": true}\n']
+
+    # The log is replayed again once a compaction has replaced it
+    for i in range(40):
+        store.remove(record_dir, [f'{i % 10}.csv'])
+    assert not os.path.exists(store.manifest_path(record_dir))
+    assert other.list(record_dir) is None
+    _write(os.path.join(record_dir, 'a.csv'), b'a')
+    store.add(os.path.join(record_dir, 'a.csv'))
+    assert [entry['name'] for entry in other.list(record_dir)] == ['a.csv']
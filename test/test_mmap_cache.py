@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Test code for the memory-map cache."""
+
+import os
+
+from api.mmap_cache import MmapCache
+
+
+def _write(path, content: bytes):
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def _get(cache, path):
+    """Look up a map the way the server does: from memory, then by mapping the file."""
+    stat = os.stat(path)
+    mapped = cache.get(path, stat)
+    if mapped is None:
+        mapped = cache.load(path, stat)
+        if mapped is not None:
+            cache.add(path, stat, mapped)
+    return mapped
+
+
+def test_mmap_cache_returns_same_map(tmp_path):
+    path = str(tmp_path / 'a.json')
+    _write(path, b'{"a": 1}')
+    cache = MmapCache(max_file_size=1024, max_entries=4, roots=[str(tmp_path)])
+    mapped = _get(cache, path)
+    assert mapped[:] == b'{"a": 1}'
+    assert cache.get(path, os.stat(path)) is mapped
+
+
+def test_mmap_cache_invalidated_on_mtime_change(tmp_path):
+    path = str(tmp_path / 'a.json')
+    _write(path, b'{"a": 1}')
+    cache = MmapCache(max_file_size=1024, max_entries=4, roots=[str(tmp_path)])
+    mapped = _get(cache, path)
+
+    _write(path, b'{"a": 22}')
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert cache.get(path, os.stat(path)) is None
+    remapped = _get(cache, path)
+    assert remapped is not mapped
+    assert remapped[:] == b'{"a": 22}'
+
+
+def test_mmap_cache_does_not_map_a_changed_file(tmp_path):
+    path = str(tmp_path / 'a.json')
+    _write(path, b'{"a": 1}')
+    stat = os.stat(path)
+    _write(path, b'{"a": 22}')
+    cache = MmapCache(max_file_size=1024, max_entries=4, roots=[str(tmp_path)])
+    assert cache.load(path, stat) is None
+
+
+def test_mmap_cache_skips_large_and_empty_files(tmp_path):
+    large = str(tmp_path / 'large.bag')
+    empty = str(tmp_path / 'empty.csv')
+    _write(large, b'x' * 2048)
+    _write(empty, b'')
+    cache = MmapCache(max_file_size=1024, max_entries=4, roots=[str(tmp_path)])
+    assert _get(cache, large) is None
+    assert _get(cache, empty) is None
+    assert len(cache) == 0
+
+
+def test_mmap_cache_evicts_least_recently_used(tmp_path):
+    cache = MmapCache(max_file_size=1024, max_entries=2, roots=[str(tmp_path)])
+    paths = [str(tmp_path / f'{i}.csv') for i in range(3)]
+    for path in paths:
+        _write(path, b'0,1,2')
+    first = _get(cache, paths[0])
+    _get(cache, paths[1])
+    _get(cache, paths[0])
+    _get(cache, paths[2])
+    assert len(cache) == 2
+    assert _get(cache, paths[0]) is first
+    assert first.closed is False
+
+
+def test_mmap_cache_maps_only_write_once_trees(tmp_path):
+    uploaded = tmp_path / 'uploaded_data'
+    (uploaded / 'record_a').mkdir(parents=True)
+    (uploaded / '.manifests').mkdir()
+    paths = [str(uploaded / 'record_a' / 'a.csv'), str(uploaded / '.manifests' / 'a.json'),
+             str(tmp_path / 'elsewhere.csv')]
+    for path in paths:
+        _write(path, b'0,1,2')
+    cache = MmapCache(max_file_size=1024, max_entries=4, roots=[str(uploaded)])
+    assert _get(cache, paths[0]) is not None
+    assert _get(cache, paths[1]) is None
+    assert _get(cache, paths[2]) is None
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Test code for offloading file transfers to a proxy."""
+
+import pytest
+
+from api.offload import X_ACCEL_REDIRECT, X_SENDFILE, Offloader, parse_locations
+
+
+def test_parse_locations():
+    assert parse_locations('/data/=/_offload/data/, /opt/a=/_a') == {'/data': '/_offload/data', '/opt/a': '/_a'}
+    assert parse_locations('') == {}
+    with pytest.raises(ValueError):
+        parse_locations('/data')
+
+
+def test_x_accel_redirect():
+    offloader = Offloader(X_ACCEL_REDIRECT, {'/data': '/_data', '/data/hot': '/_hot'})
+    assert offloader.header_for('/data/record_a/a b.bag') == ('X-Accel-Redirect', '/_data/record_a/a%20b.bag')
+    assert offloader.header_for('/data/hot/a.bag') == ('X-Accel-Redirect', '/_hot/a.bag')
+    assert offloader.header_for('/data-old/a.bag') is None
+
+
+def test_x_sendfile():
+    offloader = Offloader(X_SENDFILE, {'/data': '/mnt/data'})
+    assert offloader.header_for('/data/a.bag') == ('X-Sendfile', '/mnt/data/a.bag')
+    assert offloader.header_for('/other/a.bag') == ('X-Sendfile', '/other/a.bag')
+
+
+def test_disabled():
+    assert not Offloader('').enabled
+    assert Offloader('').header_for('/data/a.bag') is None
+    with pytest.raises(ValueError):
+        Offloader('x-unknown')
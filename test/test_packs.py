@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Test code for packing small uploaded files."""
+
+import os
+
+import pytest
+
+from api.packs import INDEX_NAME, LOCK_NAME, PackStore
+
+
+@pytest.fixture
+def stores(tmp_path):
+    root = str(tmp_path / 'uploaded_data')
+    pack_dir = str(tmp_path / 'packs')
+    # Two stores sharing the directories behave like two workers
+    return [PackStore(root, pack_dir, max_file_size=1024, compact_min_bytes=0) for _ in range(2)]
+
+
+def _path(store, name, record='record_a'):
+    return os.path.join(store.root, 'database_a', record, name)
+
+
+def test_add_and_lookup(stores):
+    store, other = stores
+    assert store.should_pack(1024)
+    assert not store.should_pack(1025)
+    entries = [store.add(_path(store, f'{i}.json'), f'content-{i}'.encode()) for i in range(3)]
+    assert [entry.offset for entry in entries] == [0, 9, 18]
+    assert os.path.isdir(os.path.dirname(_path(store, '0.json')))
+    assert not os.path.exists(_path(store, '0.json'))
+
+    assert store.lookup(_path(store, '1.json')) == entries[1]
+    assert store.read(_path(store, '2.json')) == b'content-2'
+    assert store.lookup(_path(store, 'unknown.json')) is None
+    assert store.lookup(_path(store, '0.json', record='record_b')) is None
+    assert store.lookup('/elsewhere/0.json') is None
+    assert entries[0].stat().st_size == len(b'content-0')
+
+    # Appends by another worker are followed incrementally
+    assert other.read(_path(store, '0.json')) == b'content-0'
+    other.add(_path(store, '3.json'), b'content-3')
+    assert store.read(_path(store, '3.json')) == b'content-3'
+    assert store.paths(os.path.dirname(_path(store, '0.json'))) == [_path(store, f'{i}.json') for i in range(4)]
+
+
+def test_add_conflicts(stores):
+    store, other = stores
+    store.add(_path(store, 'a.json'), b'a')
+    with pytest.raises(FileExistsError):
+        other.add(_path(store, 'a.json'), b'b')
+    with open(_path(store, 'b.json'), 'wb') as f:
+        f.write(b'b')
+    with pytest.raises(FileExistsError):
+        store.add(_path(store, 'b.json'), b'b')
+
+
+def test_remove_and_compact(stores):
+    store, other = stores
+    record_dir = os.path.dirname(_path(store, 'a.json'))
+    for name in ['a.json', 'b.json', 'c.json']:
+        store.add(_path(store, name), name.encode() * 10)
+    f, entry = other.open(_path(store, 'c.json'))
+
+    assert store.remove(_path(store, 'a.json'))
+    assert not store.remove(_path(store, 'a.json'))
+    assert store.lookup(_path(store, 'a.json')) is None
+    assert other.lookup(_path(store, 'a.json')) is None
+    assert not store.needs_compaction(record_dir)
+    assert store.remove(_path(store, 'b.json'))
+    assert store.needs_compaction(record_dir)
+
+    assert store.compact(record_dir) == 2 * 60
+    assert store.read(_path(store, 'c.json')) == b'c.json' * 10
+    # Readers of the old pack are not affected, and the others find the file in the new pack
+    with f:
+        assert os.pread(f.fileno(), entry.size, entry.offset) == b'c.json' * 10
+    assert other.read(_path(store, 'c.json')) == b'c.json' * 10
+    assert other.lookup(_path(store, 'c.json')).offset == 0
+    assert len([name for name in os.listdir(store.pack_dir_for(record_dir)) if name.endswith('.bin')]) == 1
+
+    # Files are appended to the new pack
+    other.add(_path(store, 'd.json'), b'd')
+    assert store.read(_path(store, 'd.json')) == b'd'
+
+    # Packs without files are removed
+    store.remove(_path(store, 'c.json'))
+    store.remove(_path(store, 'd.json'))
+    store.compact(record_dir)
+    # The lock file is kept, since other workers may be waiting for it
+    assert os.listdir(store.pack_dir_for(record_dir)) == [LOCK_NAME]
+    assert store.files(record_dir) == {}
+
+
+def test_partial_index_line_is_ignored(stores):
+    store, other = stores
+    store.add(_path(store, 'a.json'), b'a')
+    index_path = os.path.join(store.pack_dir_for(os.path.dirname(_path(store, 'a.json'))), INDEX_NAME)
+    with open(index_path, 'ab') as f:
+        f.write(b'{"name": "b.js')
+    assert other.read(_path(store, 'a.json')) == b'a'
+    assert other.lookup(_path(store, 'b.json')) is None
+
+
+def test_torn_index_line_is_truncated_on_append(stores):
+    store, other = stores
+    store.add(_path(store, 'a.json'), b'a')
+    index_path = os.path.join(store.pack_dir_for(os.path.dirname(_path(store, 'a.json'))), INDEX_NAME)
+    # A worker crashed in the middle of an append
+    with open(index_path, 'ab') as f:
+        f.write(b'{"name": "b.js')
+    other.add(_path(store, 'c.json'), b'c')
+
+    fresh = PackStore(store.root, store.pack_dir, max_file_size=1024)
+    for s in [store, other, fresh]:
+        assert s.read(_path(store, 'a.json')) == b'a'
+        assert s.read(_path(store, 'c.json')) == b'c'
+        assert s.lookup(_path(store, 'b.json')) is None
+
+
+def test_lookup_without_packs_when_disabled(tmp_path):
+    store = PackStore(str(tmp_path / 'uploaded_data'), str(tmp_path / 'packs'))
+    assert not store.should_pack(1)
+    assert store.lookup(os.path.join(store.root, 'database_a', 'record_a', 'a.json')) is None
+    assert not store.remove(os.path.join(store.root, 'database_a', 'record_a', 'a.json'))
+    assert not os.path.exists(store.pack_dir)
+
+    # Packs left from when packing was enabled are still served
+    enabled = PackStore(store.root, store.pack_dir, max_file_size=1024)
+    enabled.add(os.path.join(store.root, 'database_a', 'record_a', 'a.json'), b'a')
+    disabled = PackStore(store.root, store.pack_dir)
+    assert disabled.read(os.path.join(store.root, 'database_a', 'record_a', 'a.json')) == b'a'
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Test code for the validation of paths."""
+
+import json
+import os
+
+from api.paths import INVALIDATION_KEY_PREFIX, PathResolver, is_allowed, is_within, parse_roots
+from api.shared_cache import SharedCache
+from api.utils import is_file_in_directory
+
+
+def test_is_within():
+    assert is_within('/data/a/b.csv', '/data/a')
+    assert is_within('/data/a', '/data/a')
+    assert not is_within('/data/a-b/c.csv', '/data/a')
+    assert not is_within('/data', '/data/a')
+
+
+def test_is_file_in_directory_compares_components(tmp_path):
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'a-b').mkdir()
+    (tmp_path / 'a-b' / 'c.csv').write_text('c')
+    assert not is_file_in_directory(str(tmp_path / 'a-b' / 'c.csv'), str(tmp_path / 'a'))
+    assert is_file_in_directory(str(tmp_path / 'a' / '..' / 'a-b' / 'c.csv'), str(tmp_path / 'a-b'))
+
+
+def test_is_allowed():
+    assert parse_roots('/mnt/data, /opt/uploaded_data/,') == ['/mnt/data', '/opt/uploaded_data']
+    assert is_allowed('/opt/data/a.csv')
+    assert not is_allowed('/etc/passwd')
+    assert is_allowed('/mnt/data/a.csv', ['/mnt/data'])
+    assert not is_allowed('/opt/data/a.csv', ['/mnt/data'])
+
+
+def test_path_resolver(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    (root / 'a.csv').write_text('a')
+    (tmp_path / 'secret.csv').write_text('secret')
+    os.symlink(str(tmp_path / 'secret.csv'), str(root / 'link.csv'))
+    resolver = PathResolver(allowed_roots=[str(root)], ttl=60)
+
+    assert resolver.is_valid(str(root / 'a.csv'), check_existence=True)
+    assert not resolver.is_valid(str(root / 'b.csv'), check_existence=True)
+    assert resolver.is_valid(str(root / 'b.csv'))
+    assert not resolver.is_valid(str(root / '..' / 'secret.csv'))
+    assert not resolver.is_valid(str(root / 'link.csv'))
+    assert not resolver.is_valid(None)
+
+    # Resolutions are cached until they are invalidated
+    misses = resolver.counters['misses']
+    assert resolver.is_valid(str(root / 'a.csv'), check_existence=True)
+    assert resolver.counters['misses'] == misses
+    (root / 'b.csv').write_text('b')
+    assert not resolver.is_valid(str(root / 'b.csv'), check_existence=True)
+    resolver.invalidate(str(root / 'b.csv'))
+    assert resolver.is_valid(str(root / 'b.csv'), check_existence=True)
+
+
+def test_opened_file_is_checked_without_the_cache(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    (root / 'a.csv').write_text('a')
+    (tmp_path / 'secret.csv').write_text('secret')
+    link = root / 'link.csv'
+    os.symlink(str(root / 'a.csv'), str(link))
+    resolver = PathResolver(allowed_roots=[str(root)], ttl=60)
+    assert resolver.is_valid(str(link), check_existence=True)
+
+    # The cached resolution goes stale when the symlink is swapped
+    link.unlink()
+    os.symlink(str(tmp_path / 'secret.csv'), str(link))
+    assert resolver.is_valid(str(link), check_existence=True)
+    with open(str(link), 'rb') as f:
+        assert not resolver.is_opened_file_allowed(f.fileno(), str(link))
+    with open(str(root / 'a.csv'), 'rb') as f:
+        assert resolver.is_opened_file_allowed(f.fileno(), str(root / 'a.csv'))
+
+
+def test_invalidations_reach_other_workers(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    shared_cache = SharedCache()
+    resolver = PathResolver(allowed_roots=[str(root)], ttl=60, shared_cache=shared_cache)
+    assert not resolver.is_valid(str(root / 'a.csv'), check_existence=True)
+    (root / 'a.csv').write_text('a')
+
+    # Another worker published the invalidation of the path
+    keys = json.dumps([INVALIDATION_KEY_PREFIX + str(root / 'a.csv')]).encode()
+    shared_cache._handle_message([b'message', shared_cache.channel.encode(), keys])
+    assert resolver.is_valid(str(root / 'a.csv'), check_existence=True)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Test code for inspecting workers."""
+
+import asyncio
+import threading
+import time
+import tracemalloc
+
+import pytest
+
+from api.profiling import MemoryTracer, SamplingProfiler, dump_tasks
+
+
+def _busy_function(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_sampling_profiler():
+    stop = threading.Event()
+    thread = threading.Thread(target=_busy_function, args=(stop,), name='busy-thread')
+    thread.start()
+    try:
+        collapsed = asyncio.get_event_loop().run_until_complete(SamplingProfiler(0.001).profile(0.1))
+    finally:
+        stop.set()
+        thread.join()
+
+    lines = collapsed.splitlines()
+    assert lines
+    stack, count = lines[0].rsplit(' ', 1)
+    assert int(count) > 0
+    assert any(line.startswith('busy-thread;') and '_busy_function (test_profiling.py:' in line for line in lines)
+    assert not any('sampling-profiler' in line for line in lines)
+
+
+def test_sampling_profiler_is_stopped():
+    profiler = SamplingProfiler(0.001)
+    profiler.start()
+    with pytest.raises(RuntimeError):
+        profiler.start()
+    profiler.stop()
+    assert not profiler.running
+    samples = profiler.samples
+    time.sleep(0.01)
+    assert profiler.samples == samples
+
+
+def test_dump_tasks():
+    async def sleeper():
+        await asyncio.sleep(10)
+
+    async def run():
+        task = asyncio.ensure_future(sleeper())
+        await asyncio.sleep(0)
+        dumped = dump_tasks()
+        task.cancel()
+        return dumped
+
+    dumped = asyncio.get_event_loop().run_until_complete(run())
+    sleepers = [task for task in dumped if task['coro'].endswith('sleeper')]
+    assert len(sleepers) == 1
+    assert 'in sleeper' in sleepers[0]['stack'][0]
+
+
+def test_memory_tracer():
+    tracer = MemoryTracer(frames=5)
+    tracer.start()
+    try:
+        leaked = [bytearray(1024) for _ in range(1000)]
+        diff = tracer.diff(limit=5, group_by='lineno')
+        assert diff['traced_memory'] > 0
+        assert any(stat['size_diff'] >= 1000 * 1024 and 'test_profiling.py' in stat['traceback'][0]
+                   for stat in diff['top'])
+    finally:
+        tracer.stop()
+    assert not tracemalloc.is_tracing()
+    with pytest.raises(RuntimeError):
+        tracer.diff()
+    del leaked
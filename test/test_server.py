@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Test code for the serving modes of api/server.py."""
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+import requests
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _serve(env):
+    port = _free_port()
+    env = {
+        **os.environ,
+        **env,
+        'SERVER_HOST': '127.0.0.1',
+        'PORT': str(port),
+        'PYTHONPATH': os.pathsep.join([ROOT_DIR, os.environ.get('PYTHONPATH', '')]),
+    }
+    process = subprocess.Popen([sys.executable, os.path.join('api', 'server.py')], cwd=ROOT_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    try:
+        for _ in range(200):
+            try:
+                return requests.get(f'http://127.0.0.1:{port}/healthz', timeout=1)
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        pytest.fail('The server did not start')
+    finally:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def test_serve_with_reuse_port():
+    r = _serve({'SERVER_REUSE_PORT': 'true', 'NUM_WORKERS': '2', 'SERVER_LOOP': 'asyncio', 'SERVER_HTTP': 'h11'})
+    assert r.text == 'ok'
+
+
+def test_serve_with_hypercorn():
+    pytest.importorskip('hypercorn')
+    r = _serve({'SERVER_IMPLEMENTATION': 'hypercorn', 'SERVER_LOOP': 'asyncio'})
+    assert r.text == 'ok'
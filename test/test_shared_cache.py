@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Test code for the shared cache, run against a local stand-in for Redis."""
+
+import socketserver
+import threading
+import time
+
+import pytest
+
+from api.shared_cache import KEY_PREFIX, RedisClient, SharedCache
+from api.utils import CachedCheckPermissionClient
+
+
+class _RedisStandIn(socketserver.ThreadingTCPServer):
+    """Tiny in-memory server speaking the subset of RESP the cache uses."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        self.data = {}
+        self.subscribers = []
+        self.lock = threading.Lock()
+        super().__init__(('127.0.0.1', 0), _RedisHandler)
+
+    @property
+    def url(self):
+        return 'redis://127.0.0.1:{}/1'.format(self.server_address[1])
+
+
+class _RedisHandler(socketserver.StreamRequestHandler):
+    def _write(self, reply):
+        if reply is None:
+            self.wfile.write(b'$-1\r\n')
+        elif isinstance(reply, int):
+            self.wfile.write(b':%d\r\n' % reply)
+        elif isinstance(reply, list):
+            self.wfile.write(b'*%d\r\n' % len(reply))
+            for item in reply:
+                self._write(item)
+        elif isinstance(reply, bytes):
+            self.wfile.write(b'$%d\r\n%s\r\n' % (len(reply), reply))
+        else:
+            self.wfile.write(b'+%s\r\n' % reply.encode())
+        self.wfile.flush()
+
+    def handle(self):
+        server = self.server
+        while True:
+            try:
+                command = RedisClient.read_reply(self.rfile)
+            except ConnectionError:
+                return
+            name, args = command[0].upper(), command[1:]
+            with server.lock:
+                if name in (b'AUTH', b'SELECT'):
+                    reply = 'OK'
+                elif name == b'GET':
+                    value, expires_at = server.data.get(args[0], (None, None))
+                    reply = value if expires_at is None or expires_at > time.time() else None
+                elif name == b'SET':
+                    expires_at = time.time() + int(args[3]) / 1000 if len(args) > 3 else None
+                    server.data[args[0]] = (args[1], expires_at)
+                    reply = 'OK'
+                elif name == b'DEL':
+                    reply = sum(1 for key in args if server.data.pop(key, None) is not None)
+                elif name == b'PUBLISH':
+                    for subscriber in server.subscribers:
+                        subscriber._write([b'message', args[0], args[1]])
+                    reply = len(server.subscribers)
+                elif name == b'SUBSCRIBE':
+                    server.subscribers.append(self)
+                    reply = [b'subscribe', args[0], 1]
+                else:
+                    reply = None
+                self._write(reply)
+
+
+@pytest.fixture
+def redis_server():
+    server = _RedisStandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _wait_until(condition, timeout=2.0):
+    started = time.monotonic()
+    while not condition():
+        assert time.monotonic() - started < timeout
+        time.sleep(0.01)
+
+
+def test_local_cache_ttl_and_size():
+    cache = SharedCache(local_size=2, local_ttl=0.05)
+    cache.set('a', '/path/a', ttl=60)
+    cache.set('b', '/path/b', ttl=60)
+    cache.set('c', '/path/c', ttl=60)
+    assert cache.get('a') is None
+    assert cache.get('c') == '/path/c'
+    time.sleep(0.06)
+    assert cache.get('c') is None
+    cache.set('large', 'x' * 100000, ttl=60)
+    assert cache.get('large') is None
+
+
+def test_shared_cache_across_workers(redis_server):
+    worker_1 = SharedCache(url=redis_server.url, local_ttl=60)
+    worker_2 = SharedCache(url=redis_server.url, local_ttl=60)
+    worker_2.start()
+    _wait_until(lambda: len(redis_server.subscribers) == 1)
+
+    worker_1.set('file_path:db:uuid', '/opt/uploaded_data/a.csv', ttl=60)
+    assert worker_2.get('file_path:db:uuid') == '/opt/uploaded_data/a.csv'
+
+    worker_1.invalidate('file_path:db:uuid')
+    _wait_until(lambda: worker_2.get('file_path:db:uuid') is None)
+    assert worker_1.get('file_path:db:uuid') is None
+
+
+def test_shared_cache_drops_undecodable_values(redis_server):
+    cache = SharedCache(url=redis_server.url)
+    redis_server.data[(KEY_PREFIX + 'a').encode()] = (b'{"truncated', None)
+    assert cache.get('a') is None
+    assert cache.stats()['errors'] == 1
+    assert (KEY_PREFIX + 'a').encode() not in redis_server.data
+
+
+def test_shared_cache_survives_unreachable_store():
+    cache = SharedCache(url='redis://127.0.0.1:1/0')
+    cache.set('a', 'b', ttl=60)
+    assert cache.get('a') == 'b'
+    cache.invalidate('a')
+    assert cache.get('a') is None
+    assert cache.stats()['errors'] > 0
+
+
+def test_shared_cache_skips_store_after_connection_error(redis_server):
+    cache = SharedCache(url='redis://127.0.0.1:1/0', retry_interval=0.1)
+    assert cache.get('a') is None
+    assert cache.stats()['errors'] == 1
+    assert not cache.remote_available
+
+    # Only the local tier is used until the retry interval has passed
+    cache.set('a', 'b', ttl=60)
+    cache.local.delete('a')
+    assert cache.get('a') is None
+    assert cache.stats()['errors'] == 1
+    assert cache.stats()['skipped'] == 2
+
+    cache.client = RedisClient(redis_server.url)
+    time.sleep(0.1)
+    cache.set('a', 'b', ttl=60)
+    cache.local.delete('a')
+    assert cache.get('a') == 'b'
+
+
+class _PermissionClient:
+    def __init__(self, allowed):
+        self.allowed = allowed
+        self.calls = 0
+
+    def check_permissions(self, action, database_id=None):
+        self.calls += 1
+        if not self.allowed:
+            raise PermissionError
+        return True
+
+
+@pytest.mark.parametrize('allowed', [True, False])
+def test_cached_check_permission_client(allowed):
+    cache = SharedCache()
+    client = _PermissionClient(allowed)
+    for _ in range(3):
+        cached_client = CachedCheckPermissionClient(client, cache, 'Bearer token', ttl=60)
+        if allowed:
+            assert cached_client.check_permissions('file:read', 'database')
+        else:
+            with pytest.raises(PermissionError):
+                cached_client.check_permissions('file:read', 'database')
+    assert client.calls == 1
+
+    # Another user is checked separately
+    other_client = CachedCheckPermissionClient(client, cache, 'Bearer another', ttl=60)
+    if allowed:
+        other_client.check_permissions('file:read', 'database')
+    else:
+        with pytest.raises(PermissionError):
+            other_client.check_permissions('file:read', 'database')
+    assert client.calls == 2
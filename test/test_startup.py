@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Test code for the startup time."""
+
+import json
+import os
+import subprocess
+import sys
+
+# Seconds from starting the interpreter until the first response can be served
+STARTUP_TIME_BUDGET = float(os.environ.get('STARTUP_TIME_BUDGET', '1.5'))
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHILD = '''
+import json
+import sys
+import time
+started = time.perf_counter()
+from api import main
+imported = time.perf_counter()
+from starlette.testclient import TestClient
+with TestClient(main.api) as client:
+    assert client.get('/healthz').text == 'ok'
+ready = time.perf_counter()
+print(json.dumps({
+    'import': imported - started,
+    'ready': ready - started,
+    'openapi_built': main.openapi._schema is not None or main.openapi._docs is not None,
+}))
+'''
+
+
+def test_startup_time_within_budget():
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [ROOT_DIR, os.environ.get('PYTHONPATH')]))}
+    process = subprocess.run([sys.executable, '-c', CHILD], cwd=ROOT_DIR, env=env,
+                             stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    assert result['ready'] < STARTUP_TIME_BUDGET
+    assert result['openapi_built'] is False
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# Copyright API authors
+"""Test code for the upload pipeline."""
+
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from api.io_scheduler import IOScheduler
+from api.uploads import (
+    FAILED,
+    FSYNCED,
+    RECEIVING,
+    REGISTERED,
+    TEMP_SUFFIX,
+    UploadPipeline,
+    temp_path_for,
+    write_durably,
+)
+
+
+def _dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def test_write_durably(tmp_path):
+    save_file_path = str(tmp_path / 'record_a' / 'a.csv')
+    temp_path = temp_path_for(save_file_path, 'abc')
+    write_durably(temp_path, save_file_path, b'0,1,2')
+    with open(save_file_path, 'rb') as f:
+        assert f.read() == b'0,1,2'
+    assert os.listdir(str(tmp_path / 'record_a')) == ['a.csv']
+
+    with pytest.raises(FileExistsError):
+        write_durably(temp_path, save_file_path, b'3,4,5')
+    with open(save_file_path, 'rb') as f:
+        assert f.read() == b'0,1,2'
+    assert not os.path.exists(temp_path)
+
+
+def test_sweep_cleans_up_interrupted_uploads(tmp_path):
+    record_dir = tmp_path / 'database_a' / 'record_a'
+    record_dir.mkdir(parents=True)
+    pipeline = UploadPipeline(str(tmp_path / '.uploads'), io_scheduler=IOScheduler(1, 1, 1), status_ttl=60)
+
+    def create(filename, **status):
+        save_file_path = str(record_dir / filename)
+        upload_id = asyncio.get_event_loop().run_until_complete(pipeline.create(save_file_path, 'a', 'a'))
+        status = pipeline._set_status(upload_id, {**pipeline.get_status(upload_id), **status})
+        temp_path = temp_path_for(save_file_path, upload_id, host=status['host'], pid=status['pid'])
+        with open(temp_path if status['state'] == RECEIVING else save_file_path, 'wb') as f:
+            f.write(b'0')
+        return upload_id, temp_path, save_file_path
+
+    orphaned, orphaned_temp, _ = create('a.csv', pid=_dead_pid())
+    saved, _, saved_path = create('b.csv', pid=_dead_pid(), state=FSYNCED)
+    alive, alive_temp, _ = create('c.csv', pid=os.getppid())
+    other_host, other_host_temp, _ = create('d.csv', host='another-host', pid=1)
+    finished, _, _ = create('e.csv', state=REGISTERED)
+    os.utime(pipeline._status_path(finished), (time.time() - 120, time.time() - 120))
+    # The tree is not walked: temp files without a state are left alone
+    unknown_temp = record_dir / f'.f.csv.another-host.1.abc{TEMP_SUFFIX}'
+    unknown_temp.write_bytes(b'0')
+
+    pipeline.sweep()
+    assert not os.path.exists(orphaned_temp)
+    assert pipeline.get_status(orphaned)['state'] == FAILED
+    # The file may already be in the metastore
+    assert os.path.exists(saved_path)
+    assert pipeline.get_status(saved)['state'] == FAILED
+    assert os.path.exists(alive_temp)
+    assert pipeline.get_status(alive)['state'] == RECEIVING
+    assert os.path.exists(other_host_temp)
+    assert pipeline.get_status(other_host)['state'] == RECEIVING
+    assert pipeline.get_status(finished) is None
+    assert unknown_temp.exists()
+
+
+def test_get_status_rejects_paths(tmp_path):
+    pipeline = UploadPipeline(str(tmp_path / '.uploads'), io_scheduler=None)
+    assert pipeline.get_status('../secret') is None
+    assert pipeline.get_status('unknown') is None
+
+
+def test_run_marks_unexpected_errors_as_failed(tmp_path):
+    pipeline = UploadPipeline(str(tmp_path / '.uploads'), io_scheduler=IOScheduler(1, 1, 1), status_ttl=60)
+    save_file_path = str(tmp_path / 'record_a' / 'a.csv')
+
+    def register():
+        raise RuntimeError('unreachable metastore')
+
+    async def scenario():
+        upload_id = await pipeline.create(save_file_path, 'a', 'a')
+        return upload_id, await pipeline.run(upload_id, b'0', register)
+
+    upload_id, (status, fetch_res) = asyncio.get_event_loop().run_until_complete(scenario())
+    assert fetch_res is None
+    assert status['state'] == FAILED
+    assert status['status_code'] == 500
+    assert 'unreachable metastore' in status['detail']
+    assert pipeline.get_status(upload_id)['state'] == FAILED